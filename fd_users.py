@@ -1,17 +1,24 @@
-#!/usr/bin/python -tt
+#!/usr/bin/python3
 """
 Libusers - a script that finds users of files that have been deleted/replaced
 """
 # Released under the GPL-2
 # -*- coding: utf8 -*-
 import argparse
+import atexit
 import sys
-import glob
 import fnmatch
 import os
+import tarfile
 
 from collections import defaultdict
 from lib_users_util import common
+from lib_users_util import config
+from lib_users_util import daemon
+from lib_users_util import observe
+from lib_users_util import pidfd
+from lib_users_util import procarchive
+from lib_users_util import state
 
 DELSUFFIX = " (deleted)"
 PERMWARNING = """Warning: Some files could not be read."""
@@ -36,27 +43,35 @@ def get_deleted_files(fddir, ign_patterns, ign_literals):
     """
     deletedfds = []
     literals = set(ign_literals)
-    allfds = glob.glob(os.path.join(fddir, "*"))
-    for onefd in allfds:
-        # We can't use os.path.exists() since that simply does not work
-        # correctly on /proc files (broken links look like working ones).
-        target = os.readlink(onefd)
+    observer = observe.OBSERVER
+    size = 0
+    # We can't use os.path.exists() since that simply does not work
+    # correctly on /proc files (broken links look like working ones).
+    for target in common.iter_links(fddir):
+        if observer is not None:
+            size += len(target)
         if target.endswith(DELSUFFIX):
             actual_target = target[:-len(DELSUFFIX)]
             if actual_target in literals:
-                continue
-            if match_any(actual_target, ign_patterns):
+                rule = actual_target
+            else:
+                rule = first_match(actual_target, ign_patterns)
+            if rule is not None:
+                if observer is not None:
+                    observer.ignored(actual_target, rule)
                 continue
             deletedfds.append(actual_target)
+    if observer is not None:
+        observer.file_read(fddir, size)
     return deletedfds
 
 
-def match_any(name, patterns):
-    """Return if name matches any of the patterns (globs)"""
+def first_match(name, patterns):
+    """Return the first of the patterns (globs) that name matches, or None"""
     for pattern in patterns:
         if fnmatch.fnmatch(name, pattern):
-            return True
-    return False
+            return pattern
+    return None
 
 
 def main(argv):
@@ -78,39 +93,154 @@ def main(argv):
                         metavar="LITERAL", action='append',
                         help="Ignore deleted files named %(metavar)s. "
                         "Can be specified multiple times.")
+    parser.add_argument("-g", "--group-by", choices=common.GROUPINGS,
+                        default="argv",
+                        help="List processes by command line, executable or "
+                        "systemd unit (default: %(default)s)")
+    parser.add_argument("-c", "--config", metavar="FILE",
+                        help="Load ignore rules from %%(metavar)s "
+                        "(default: %s if it exists)" % config.CONFIGFILE)
+    parser.add_argument("--capture", metavar="FILE",
+                        help="Save the files from /proc that lib_users and "
+                        "fd_users read to the archive %(metavar)s, then exit")
+    parser.add_argument("--replay", metavar="FILE",
+                        help="Read from an archive made with --capture "
+                        "instead of /proc")
+    parser.add_argument("--pin", action="store_true",
+                        help="Hold a pidfd on every process while it is "
+                        "read, so that a reused PID is not mistaken for it. "
+                        "In daemon mode, also forget processes as soon as "
+                        "they exit.")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="Write a trace of the scan to %(metavar)s, in "
+                        "the Chrome trace event format")
+    parser.add_argument("--daemon", action="store_true",
+                        help="Keep running and report changes as processes "
+                        "start and exit")
+    parser.add_argument("--full-scan-interval", type=float,
+                        metavar="SECONDS",
+                        default=daemon.DEFAULT_FULL_SCAN_INTERVAL,
+                        help="In daemon mode, scan all processes every "
+                        "%(metavar)s (default: %(default)s)")
+    parser.add_argument("--rescan-delay", type=float, metavar="SECONDS",
+                        default=daemon.DEFAULT_RESCAN_DELAY,
+                        help="In daemon mode, scan new processes after "
+                        "%(metavar)s (default: %(default)s)")
 
     options = parser.parse_args(argv)
     options.showitems = options.showfiles
 
-    users = defaultdict(lambda: (set(), set()))
-    read_failure = False
+    if options.pin and not pidfd.SUPPORTED:
+        parser.error("--pin needs Python 3.9 or later")
+    if options.replay:
+        # These look at the live system, which the PIDs in the archive don't
+        # belong to.
+        for flag, given in (("--pin", options.pin),
+                            ("-S", options.services),
+                            ("-g %s" % options.group_by,
+                             options.group_by != "argv"),
+                            ("--daemon", options.daemon)):
+            if given:
+                parser.error("--replay can't be used with %s" % flag)
+    if options.daemon and options.capture:
+        parser.error("--daemon can't be used with --capture")
 
-    for fddir in glob.glob(common.FDPROCFSPAT):
-        if (fddir.startswith("/proc/self/fd") or
-                fddir.startswith("/proc/thread-self/fd") or
-                fddir.startswith("/proc/%s/fd" % (os.getpid()))):
-            continue
+    if options.trace:
+        if options.daemon:
+            parser.error("--trace can only be used for single scans")
+        tracer = observe.ChromeTrace(options.trace)
+        observe.register(tracer)
+        atexit.register(tracer.close)
 
+    if options.capture:
+        count = procarchive.capture(options.capture)
+        sys.stderr.write("Captured %d processes to %s\n" %
+                         (count, options.capture))
+        return
+    if options.replay:
         try:
-            pid = os.path.normpath(fddir).split("/")[2]
-        except IndexError:
-            # This happens if the filenames look different
-            # than we expect (e.g. the user changed common.FDPROCFSPAT)
-            pid = "unknown"
+            procarchive.replay(options.replay)
+        except (IOError, tarfile.TarError) as this_exc:
+            parser.error("Could not read %s: %s" % (options.replay, this_exc))
+
+    try:
+        globalrules, exerules = config.load_config(options.config)
+    except config.ConfigError as this_exc:
+        parser.error(str(this_exc))
+    grouper = common.Grouper(options.group_by)
+    ign_patterns = options.ignore_pattern + globalrules.patterns
+    ign_literals = options.ignore_literal + list(globalrules.literals)
+
+    if options.daemon:
+        def scan_pid(pid, _):
+            """Scan one process for the daemon"""
+            deletedfiles = get_deleted_files(
+                "%s/%s/fd" % (common.PROCFSBASE, pid), ign_patterns,
+                ign_literals)
+            deletedfiles = config.filter_for_pid(pid, deletedfiles, exerules)
+            argv = grouper.key(pid) if deletedfiles else None
+            return (argv, set(deletedfiles)) if argv else None
 
+        def report(appeared, disappeared):
+            """Print changes as soon as they are found"""
+            changes = state.fmt_changes(appeared, disappeared, options)
+            if changes:
+                print(changes)
+            if appeared and options.services:
+                print()
+                print(common.get_services(appeared))
+            sys.stdout.flush()
+
+        watcher = pidfd.ExitWatcher() if options.pin else None
+        daemon.run(daemon.ProcTable(scan_pid, watcher), options, report)
+        return
+
+    users = defaultdict(lambda: (set(), set()))
+    starttimes = {}
+    read_failure = False
+
+    observer = observe.OBSERVER
+    for pid in common.iter_pids():
+        fddir = "%s/%s/fd" % (common.PROCFSBASE, pid)
+        if observer is not None:
+            observer.pid_start(pid)
+        pin = None
         try:
-            deletedfiles = get_deleted_files(fddir, options.ignore_pattern,
-                                             options.ignore_literal)
-        except IOError:
-            read_failure = True
+            if options.pin:
+                pin = pidfd.pin(pid)
+            deletedfiles = get_deleted_files(fddir, ign_patterns,
+                                             ign_literals)
+        except IOError as this_exc:
+            if this_exc.errno in common.FDEXHAUSTED:
+                raise
+            if this_exc.errno not in common.VANISHED:
+                read_failure = True
+                if observer is not None:
+                    observer.permission_denied(fddir, this_exc)
+            if pin is not None:
+                pin.close()
+            if observer is not None:
+                observer.pid_end(pid, 0)
             continue
 
-        if deletedfiles:
-            argv = common.get_progargs(pid)
-            if not argv:
-                continue
+        deletedfiles = config.filter_for_pid(pid, deletedfiles, exerules)
+        argv = grouper.key(pid) if deletedfiles else None
+        if pin is not None:
+            # Only keep the pin while reading, so that we don't run out of
+            # file descriptors if many processes are affected. The start
+            # time tells later if the process is still the same.
+            starttime = common.get_starttime(pid) if argv else None
+            if not pin.alive():
+                # The PID may have been reused since we read the fd directory
+                argv = None
+            pin.close()
+        if argv:
             users[argv][0].add(pid)
             users[argv][1].update(deletedfiles)
+            if pin is not None:
+                starttimes[pid] = starttime
+        if observer is not None:
+            observer.pid_end(pid, len(deletedfiles) if argv else 0)
 
     if read_failure:
         if os.geteuid() == 0:
@@ -125,7 +255,7 @@ def main(argv):
             print(common.fmt_human(users, options))
         if options.services:
             print()
-            print(common.get_services(users))
+            print(common.get_services(users, starttimes))
 
 
 if __name__ == "__main__":
@@ -1,4 +1,4 @@
-#!/usr/bin/python -tt
+#!/usr/bin/python3
 """
 Libusers - a script that finds users of libs that have been deleted/replaced
 """
@@ -7,15 +7,34 @@ Libusers - a script that finds users of libs that have been deleted/replaced
 # -*- coding: utf8 -*-
 
 import argparse
+import atexit
+import errno
 import sys
-import glob
 import fnmatch
 import os
+import tarfile
+import time
 
 from os.path import normpath
 from collections import defaultdict
 from lib_users_util import common
+from lib_users_util import config
+from lib_users_util import daemon
+from lib_users_util import fastcheck
+from lib_users_util import procarchive
+from lib_users_util import mapindex
+from lib_users_util import memory
+from lib_users_util import observe
+from lib_users_util import pacing
+from lib_users_util import pidfd
+from lib_users_util import pkgindex
+from lib_users_util import procmap
+from lib_users_util import server
+from lib_users_util import state
 
+STALEWARNING = """\
+Warning: The index was built before the last reboot, so none of the processes
+in it are running anymore.\n"""
 PERMWARNINGUID0 = """Warning: Some files could not be read.\n"""
 PERMWARNING = """\
 Warning: Some files could not be read. Note that lib_users has to be run as
@@ -36,7 +55,51 @@ NOLIBSNP = set(["/dev/zero", "/drm", "object",
 def get_deleted_libs(map_file):
     """
     Get all deleted libs from a given map file and return them as a set.
+
+    If map_file is an actual /proc/PID/maps file and the kernel supports it,
+    the PROCMAP_QUERY ioctl is used to only look at file-backed mappings.
+    Otherwise, the file is parsed as text.
     """
+    try:
+        return _get_deleted_libs_ioctl(map_file)
+    except procmap.Unsupported:
+        return _get_deleted_libs_text(map_file)
+
+
+def _is_lib(lib):
+    """Return whether lib is not one of the known non-libraries"""
+    if lib in NOLIBSNP:
+        rule = lib
+    else:
+        for rule in NOLIBSPT:
+            if fnmatch.fnmatch(lib, rule):
+                break
+        else:
+            return True
+    if observe.OBSERVER is not None:
+        observe.OBSERVER.ignored(lib, rule)
+    return False
+
+
+def _get_deleted_libs_ioctl(map_file):
+    """Implementation of get_deleted_libs() using procmap.file_vmas()"""
+    deletedlibs = set()
+
+    for vma in procmap.file_vmas(map_file):
+        name = vma[-1]
+        if name.endswith("(deleted)"):
+            # Pick the same token as the text parser would from the
+            # corresponding maps line, so both yield identical results even
+            # for names with spaces in them.
+            lib = ("%s %s" % (vma[-2], name)).split()[-2]
+            if _is_lib(lib):
+                deletedlibs.add(lib)
+
+    return deletedlibs
+
+
+def _get_deleted_libs_text(map_file):
+    """Implementation of get_deleted_libs() that parses the maps file"""
     deletedlibs = set()
 
     for line in map_file:
@@ -44,22 +107,192 @@ def get_deleted_libs(map_file):
         # Normal Linux maps file
         if line.endswith("(deleted)"):
             lib = line.split()[-2]
-            is_lib = all(not fnmatch.fnmatch(lib, pattern)
-                         for pattern in NOLIBSPT)
-            if is_lib and lib not in NOLIBSNP:
+            if _is_lib(lib):
                 deletedlibs.add(lib)
 
         # OpenVZ maps file
         elif line.split()[-1].startswith("(deleted)"):
             lib = line.split()[-1][9:]
-            is_lib = all(not fnmatch.fnmatch(lib, pattern)
-                         for pattern in NOLIBSPT)
-            if is_lib and lib not in NOLIBSNP:
+            if _is_lib(lib):
                 deletedlibs.add(lib)
 
     return deletedlibs
 
 
+def _file_mappings(map_file):
+    """
+    Iterate over the file-backed mappings in map_file.
+
+    Yields:
+     Tuples of (inode, name), name including " (deleted)" if applicable.
+    """
+    try:
+        for vma in procmap.file_vmas(map_file):
+            yield vma[-2], vma[-1]
+        return
+    except procmap.Unsupported:
+        pass
+    for line in map_file:
+        fields = line.split(None, 5)
+        if len(fields) == 6 and fields[4] != "0":
+            yield int(fields[4]), fields[5].rstrip("\n")
+
+
+def get_mapped_files(map_filename):
+    """
+    Get all files (not marked as deleted) mapped in a given maps file and
+    return them as a set.
+
+    Raises:
+     IOError if the maps file can't be read
+    """
+    with open(map_filename) as mapsfile:
+        return set(name for _, name in _file_mappings(mapsfile)
+                   if name.startswith("/") and
+                   not name.endswith("(deleted)"))
+
+
+def get_replaced_libs(map_file, pid, statcache):
+    """
+    Get all libs from a given map file that have been replaced without being
+    marked as deleted, and return them as a set.
+
+    This catches files that were replaced on a bind mount, an overlay layer or
+    a network file system, by comparing the inode of each mapping with what
+    the path now points to as seen by the process. Device numbers are not
+    compared, since btrfs subvolumes and overlayfs report different ones in
+    maps and stat().
+    Files outside the root directory of a chroot()'ed process in another
+    mount namespace are skipped.
+
+    Args:
+     map_file: an open /proc/PID/maps file
+     pid: the PID (as string) the map file belongs to
+     statcache: a dict shared between calls to cache the results of stat()
+     for processes that see the same files.
+    """
+    replacedlibs = set()
+    fsview = common.get_fsview(pid)
+    try:
+        root, prefix = common.get_view_root(pid)
+    except OSError:
+        return replacedlibs
+    seen = set()
+
+    for inode, name in _file_mappings(map_file):
+        if (inode, name) in seen:
+            continue
+        seen.add((inode, name))
+        if not name.startswith("/") or name.endswith("(deleted)"):
+            continue
+        if prefix and not name.startswith(prefix + "/"):
+            continue
+
+        key = (fsview or pid, name)
+        if key not in statcache:
+            try:
+                statcache[key] = os.stat(root + name[len(prefix):]).st_ino
+            except OSError as this_exc:
+                # If the path is gone, whatever was mapped has been replaced.
+                # If we can't tell for other reasons, don't report anything.
+                if this_exc.errno == errno.ENOENT:
+                    statcache[key] = None
+                else:
+                    statcache[key] = inode
+        if statcache[key] != inode and _is_lib(name):
+            replacedlibs.add(name)
+
+    return replacedlibs
+
+
+def scan_maps(map_filename, pid, options, exerules, statcache):
+    """
+    Get all deleted libs used by a given PID and return them as a set.
+
+    Args:
+     map_filename: the maps file of pid
+     pid: PID (as string)
+     options: the parsed command line options
+     exerules: per-executable ignore rules as returned by load_config()
+     statcache: the cache for get_replaced_libs()
+    Raises:
+     IOError if the maps file can't be read
+    """
+    observer = observe.OBSERVER
+    with open(map_filename) as mapsfile:
+        deletedlibs = get_deleted_libs(mapsfile)
+        if observer is not None:
+            # The position of the file descriptor (not of the buffer) is how
+            # much was read from the kernel, nothing if the ioctl was used.
+            size = os.lseek(mapsfile.fileno(), 0, os.SEEK_CUR)
+        if options.replaced:
+            mapsfile.seek(0)
+            deletedlibs.update(get_replaced_libs(mapsfile, pid, statcache))
+            if observer is not None:
+                size += os.lseek(mapsfile.fileno(), 0, os.SEEK_CUR)
+    if observer is not None:
+        observer.file_read(map_filename, size)
+    return config.filter_for_pid(pid, deletedlibs, exerules)
+
+
+def needs_full_scan(pid, exerules):
+    """
+    Do the fast check of a given PID: return whether it runs a deleted
+    executable or ELF interpreter that is not ignored, so that its maps file
+    has to be scanned.
+
+    Raises:
+     IOError if the process can't be read
+    """
+    deleted = set(name for name in fastcheck.check(pid) if _is_lib(name))
+    return bool(config.filter_for_pid(pid, deleted, exerules))
+
+
+def report_changes(appeared, disappeared, options, index):
+    """Print the changes found with --state or in daemon mode"""
+    if index is not None:
+        appeared = pkgindex.tag_users(appeared, index)
+        disappeared = pkgindex.tag_users(disappeared, index)
+    changes = state.fmt_changes(appeared, disappeared, options)
+    if changes:
+        print(changes)
+    if appeared and options.services:
+        print()
+        print(common.get_services(appeared))
+
+
+def query_mapped_files(options, grouper, parser):
+    """Build, save, load and query an index of all mapped files"""
+    if options.load_index:
+        try:
+            mapidx = mapindex.MapIndex.load(options.load_index)
+        except (IOError, ValueError) as this_exc:
+            parser.error("Could not load %s: %s" %
+                         (options.load_index, this_exc))
+        if mapidx.boot_id != common.get_boot_id():
+            sys.stderr.write(STALEWARNING)
+    else:
+        mapidx, read_failure = mapindex.build(
+            common.get_pids(),
+            lambda pid: get_mapped_files(
+                "%s/%s/maps" % (common.PROCFSBASE, pid)),
+            grouper.key)
+        if read_failure:
+            if os.geteuid() == 0:
+                sys.stderr.write(PERMWARNINGUID0)
+            else:
+                sys.stderr.write(PERMWARNING)
+        if options.save_index:
+            mapidx.save(options.save_index)
+
+    users = mapidx.query(options.query)
+    if users:
+        if options.machine_readable:
+            print(common.fmt_machine(users))
+        else:
+            print(common.fmt_human(users, options))
+
+
 def main(argv):
     """Main program"""
     parser = argparse.ArgumentParser()
@@ -79,39 +312,286 @@ def main(argv):
                         metavar="LITERAL", action='append',
                         help="Ignore deleted files named %(metavar)s. "
                         "Can be specified multiple times.")
+    parser.add_argument("-g", "--group-by", choices=common.GROUPINGS,
+                        default="argv",
+                        help="List processes by command line, executable or "
+                        "systemd unit (default: %(default)s)")
+    parser.add_argument("-c", "--config", metavar="FILE",
+                        help="Load ignore rules from %%(metavar)s "
+                        "(default: %s if it exists)" % config.CONFIGFILE)
+    parser.add_argument("--state", metavar="FILE",
+                        help="Only report changes since the last run that "
+                        "used the same state %(metavar)s, then update it")
+    parser.add_argument("-r", "--replaced", action="store_true",
+                        help="Also find libs that were replaced without "
+                        "being marked as deleted")
+    parser.add_argument("-M", "--memory", action="store_true",
+                        help="Show how much memory the deleted libs take up")
+    parser.add_argument("-P", "--packages", action="store_true",
+                        help="Show the package each deleted file belongs to")
+    parser.add_argument("--package-index", metavar="FILE",
+                        default=pkgindex.INDEXFILE,
+                        help="Keep the file to package index in %(metavar)s "
+                        "(default: %(default)s)")
+    parser.add_argument("--dpkg-info", metavar="DIR",
+                        default=pkgindex.DPKGINFODIR,
+                        help="Read dpkg file lists from %(metavar)s "
+                        "(default: %(default)s)")
+    parser.add_argument("--fast", action="store_true",
+                        help="Only scan the maps of processes whose "
+                        "executable or ELF interpreter was deleted")
+    parser.add_argument("--full-interval", type=float, metavar="SECONDS",
+                        help="With --fast and --state, do a full scan if the "
+                        "last one is older than %(metavar)s, and otherwise "
+                        "keep what it found in processes that still run")
+    parser.add_argument("--gentle", action="store_true",
+                        help="Pace reads of maps files to limit the impact "
+                        "on latency-sensitive processes")
+    parser.add_argument("--gentle-window", type=float, metavar="SECONDS",
+                        default=pacing.DEFAULT_WINDOW,
+                        help="In gentle mode, spread the scan over "
+                        "%(metavar)s (default: %(default)s)")
+    parser.add_argument("--gentle-backoff", type=float, metavar="FACTOR",
+                        default=pacing.DEFAULT_BACKOFF,
+                        help="In gentle mode, wait at least %(metavar)s times "
+                        "as long as each read took (default: %(default)s)")
+    parser.add_argument("-q", "--query", default=[], metavar="GLOB",
+                        action="append",
+                        help="Instead of deleted libs, list the processes "
+                        "that map files matching %(metavar)s, i.e. those "
+                        "that need a restart if they are updated. Can be "
+                        "specified multiple times.")
+    parser.add_argument("--save-index", metavar="FILE",
+                        help="Save an index of all mapped files to "
+                        "%(metavar)s, for use with --load-index")
+    parser.add_argument("--load-index", metavar="FILE",
+                        help="Answer --query from the index in %(metavar)s "
+                        "instead of scanning all processes")
+    parser.add_argument("--capture", metavar="FILE",
+                        help="Save the files from /proc that lib_users and "
+                        "fd_users read to the archive %(metavar)s, then exit")
+    parser.add_argument("--replay", metavar="FILE",
+                        help="Read from an archive made with --capture "
+                        "instead of /proc")
+    parser.add_argument("--pin", action="store_true",
+                        help="Hold a pidfd on every process while it is "
+                        "read, so that a reused PID is not mistaken for it. "
+                        "In daemon and server modes, also forget processes "
+                        "as soon as they exit.")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="Write a trace of the scan to %(metavar)s, in "
+                        "the Chrome trace event format")
+    parser.add_argument("--daemon", action="store_true",
+                        help="Keep running and report changes as processes "
+                        "start and exit")
+    parser.add_argument("--full-scan-interval", type=float,
+                        metavar="SECONDS",
+                        default=daemon.DEFAULT_FULL_SCAN_INTERVAL,
+                        help="In daemon mode, scan all processes every "
+                        "%(metavar)s (default: %(default)s)")
+    parser.add_argument("--rescan-delay", type=float, metavar="SECONDS",
+                        default=daemon.DEFAULT_RESCAN_DELAY,
+                        help="In daemon mode, scan new processes after "
+                        "%(metavar)s (default: %(default)s)")
+    parser.add_argument("--serve", metavar="SOCKET",
+                        help="Keep running and answer queries on the Unix "
+                        "socket %(metavar)s")
+    parser.add_argument("--refresh", type=float, metavar="SECONDS",
+                        default=server.DEFAULT_REFRESH,
+                        help="In server mode, scan all processes every "
+                        "%(metavar)s (default: %(default)s)")
+    parser.add_argument("--min-rescan-interval", type=float,
+                        metavar="SECONDS",
+                        default=server.DEFAULT_MIN_RESCAN_INTERVAL,
+                        help="In server mode, ignore rescan requests within "
+                        "%(metavar)s of the last scan (default: %(default)s)")
 
     options = parser.parse_args(argv)
     options.showitems = options.showlibs
 
+    if options.pin and not pidfd.SUPPORTED:
+        parser.error("--pin needs Python 3.9 or later")
+    if options.replay:
+        # These look at the live system, which the PIDs in the archive don't
+        # belong to.
+        for flag, given in (("--pin", options.pin),
+                            ("-r", options.replaced),
+                            ("-S", options.services),
+                            ("-g %s" % options.group_by,
+                             options.group_by != "argv"),
+                            ("--daemon", options.daemon),
+                            ("--serve", options.serve)):
+            if given:
+                parser.error("--replay can't be used with %s" % flag)
+
+    # Options that only make sense for single scans
+    single = (("--state", options.state),
+              ("-M", options.memory),
+              ("--gentle", options.gentle),
+              ("-q", options.query),
+              ("--save-index", options.save_index),
+              ("--load-index", options.load_index),
+              ("--capture", options.capture))
+    if options.serve:
+        for flag, given in (("--daemon", options.daemon),
+                            ("-P", options.packages),
+                            ("-S", options.services)) + single:
+            if given:
+                parser.error("--serve can't be used with %s" % flag)
+    if options.daemon:
+        for flag, given in single:
+            if given:
+                parser.error("--daemon can't be used with %s" % flag)
+
+    if options.fast and (options.daemon or options.serve):
+        parser.error("--fast can only be used for single scans")
+    if options.full_interval is not None and not (options.fast and
+                                                  options.state):
+        parser.error("--full-interval needs --fast and --state")
+
+    if options.trace:
+        if options.daemon or options.serve:
+            parser.error("--trace can only be used for single scans")
+        tracer = observe.ChromeTrace(options.trace)
+        observe.register(tracer)
+        atexit.register(tracer.close)
+
+    if options.capture:
+        count = procarchive.capture(options.capture)
+        sys.stderr.write("Captured %d processes to %s\n" %
+                         (count, options.capture))
+        return
+    if options.replay:
+        try:
+            procarchive.replay(options.replay)
+        except (IOError, tarfile.TarError) as this_exc:
+            parser.error("Could not read %s: %s" % (options.replay, this_exc))
+
+    try:
+        globalrules, exerules = config.load_config(options.config)
+    except config.ConfigError as this_exc:
+        parser.error(str(this_exc))
+    grouper = common.Grouper(options.group_by)
+
+    if options.query or options.save_index or options.load_index:
+        query_mapped_files(options, grouper, parser)
+        return
+
     NOLIBSPT.update(options.ignore_pattern)
     NOLIBSNP.update(options.ignore_literal)
+    NOLIBSPT.update(globalrules.patterns)
+    NOLIBSNP.update(globalrules.literals)
+
+    index = None
+    if options.packages:
+        index = pkgindex.load_index(options.package_index, options.dpkg_info)
+
+    def scan_pid(pid, statcache):
+        """Scan one process for the daemon and server modes"""
+        deletedlibs = scan_maps("%s/%s/maps" % (common.PROCFSBASE, pid),
+                                pid, options, exerules, statcache)
+        argv = grouper.key(pid) if deletedlibs else None
+        return (argv, deletedlibs) if argv else None
+
+    def make_watcher():
+        """Get an ExitWatcher for the resident modes, if asked to pin"""
+        return pidfd.ExitWatcher() if options.pin else None
+
+    if options.serve:
+        cache = server.ScanCache(daemon.ProcTable(scan_pid, make_watcher()),
+                                 options.min_rescan_interval)
+        try:
+            srv = server.make_server(cache, options.serve)
+        except OSError as this_exc:
+            parser.error("Could not listen on %s: %s" %
+                         (options.serve, this_exc))
+        server.run(srv, options.refresh)
+        return
+
+    if options.daemon:
+        def report(appeared, disappeared):
+            """Print changes as soon as they are found"""
+            report_changes(appeared, disappeared, options, index)
+            sys.stdout.flush()
+
+        daemon.run(daemon.ProcTable(scan_pid, make_watcher()), options,
+                   report)
+        return
 
     users = defaultdict(lambda: (set(), set()))
+    procs = {}
+    starttimes = {}
+    statcache = {}
     read_failure = False
 
-    for map_filename in glob.glob(common.LIBPROCFSPAT):
+    previous = state.load_state(options.state) if options.state else None
+    fast = options.fast
+    if fast and options.full_interval is not None:
+        last_full = state.last_full_scan(previous)
+        if last_full is None or \
+                time.time() - last_full >= options.full_interval:
+            fast = False
+    scanned = time.time()
+
+    map_filenames = ("%s/%s/maps" % (common.PROCFSBASE, pid)
+                     for pid in common.iter_pids())
+    pacer = None
+    if options.gentle:
+        map_filenames = pacing.interleave(map_filenames)
+        pacer = pacing.Pacer(len(map_filenames), options.gentle_window,
+                             options.gentle_backoff)
+
+    observer = observe.OBSERVER
+    for map_filename in map_filenames:
         deletedlibs = set()
-        try:
-            pid = normpath(map_filename).split("/")[2]
-        except IndexError:
-            # This happens if the filenames look different
-            # than we expect (e.g. the user changed common.LIBPROCFSPAT)
-            pid = "unknown"
+        pid = os.path.basename(os.path.dirname(normpath(map_filename)))
 
+        if observer is not None:
+            observer.pid_start(pid)
+        started = time.time()
+        pin = None
         try:
-            mapsfile = open(map_filename)
-            deletedlibs = get_deleted_libs(mapsfile)
-        except IOError:
-            read_failure = True
+            if options.pin:
+                pin = pidfd.pin(pid)
+            if not fast or needs_full_scan(pid, exerules):
+                deletedlibs = scan_maps(map_filename, pid, options, exerules,
+                                        statcache)
+        except IOError as this_exc:
+            if this_exc.errno in common.FDEXHAUSTED:
+                raise
+            # Processes that exited since we listed them are no reason to
+            # warn about missing permissions.
+            if this_exc.errno not in common.VANISHED:
+                read_failure = True
+                if observer is not None:
+                    observer.permission_denied(map_filename, this_exc)
+            if pin is not None:
+                pin.close()
+            if observer is not None:
+                observer.pid_end(pid, 0)
             continue
-        mapsfile.close()
+        finally:
+            if pacer:
+                pacer.pace(time.time() - started)
 
-        if deletedlibs:
-            argv = common.get_progargs(pid)
-            if not argv:
-                continue
+        argv = grouper.key(pid) if deletedlibs else None
+        if pin is not None:
+            # Only keep the pin while reading, so that we don't run out of
+            # file descriptors if many processes are affected. The start
+            # time tells later if the process is still the same.
+            starttime = common.get_starttime(pid) if argv else None
+            if not pin.alive():
+                # The PID may have been reused since we read the maps file
+                argv = None
+            pin.close()
+        if argv:
             users[argv][0].add(pid)
             users[argv][1].update(deletedlibs)
+            procs[pid] = (argv, deletedlibs)
+            if pin is not None:
+                starttimes[pid] = starttime
+        if observer is not None:
+            observer.pid_end(pid, len(deletedlibs) if argv else 0)
 
     if read_failure:
         if os.geteuid() == 0:
@@ -119,14 +599,43 @@ def main(argv):
         else:
             sys.stderr.write(PERMWARNING)
 
+    if options.state:
+        if fast:
+            # Keep what the last full scan found in the processes that the
+            # fast check did not flag.
+            for pid, result in state.still_running(previous,
+                                                   grouper.key).items():
+                procs.setdefault(pid, result)
+            full_scan = state.last_full_scan(previous)
+        else:
+            full_scan = scanned
+        snapshot = state.make_snapshot(procs, full_scan)
+        appeared, disappeared = state.diff_snapshots(previous, snapshot)
+        state.save_state(options.state, snapshot)
+        report_changes(appeared, disappeared, options, index)
+        if appeared and options.memory:
+            changed = set(pid for pids, _ in appeared.values()
+                          for pid in pids)
+            memprocs = dict((pid, procs[pid]) for pid in changed
+                            if pid in procs)
+            print()
+            print(memory.fmt_memory(memprocs, memory.collect(memprocs),
+                                    options))
+        return
+
     if len(users) > 0:
+        if index is not None:
+            users = pkgindex.tag_users(users, index)
         if options.machine_readable:
             print(common.fmt_machine(users))
         else:
             print(common.fmt_human(users, options))
         if options.services:
             print()
-            print(common.get_services(users))
+            print(common.get_services(users, starttimes))
+        if options.memory:
+            print()
+            print(memory.fmt_memory(procs, memory.collect(procs), options))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,224 @@
+#!/usr/bin/python3
+"""
+Lib_users_fleet - aggregate lib_users/fd_users results from many hosts
+"""
+
+# Released under the GPL-2
+# -*- coding: utf8 -*-
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+
+from collections import Counter
+
+__version__ = "0.15"
+
+
+def parse_machine(lines):
+    """
+    Parse the output of lib_users -m or fd_users -m.
+
+    Lines that don't start with a list of PIDs (e.g. the output of -M or -S)
+    are skipped.
+
+    Returns:
+     A tuple of two sets: the deleted files and the commands using them.
+    """
+    files = set()
+    commands = set()
+    for line in lines:
+        fields = line.rstrip("\n").split(";", 2)
+        if len(fields) != 3:
+            continue
+        if not all(pid.isdigit() for pid in fields[0].split(",")):
+            continue
+        files.update(name for name in fields[1].split(",") if name)
+        commands.add(_command(fields[2]))
+    return files, commands
+
+
+def parse_state(text):
+    """
+    Parse the contents of a lib_users state file (as written with --state).
+
+    Returns:
+     A tuple of two sets: the deleted files and the commands using them.
+    Raises:
+     ValueError if text is not a complete state file
+    """
+    files = set()
+    commands = set()
+    snapshot = json.loads(text)
+    procs = snapshot.get("procs") if isinstance(snapshot, dict) else None
+    if not isinstance(procs, dict):
+        raise ValueError("Not a lib_users state file")
+    for entry in procs.values():
+        if not (isinstance(entry, list) and len(entry) == 2 and
+                isinstance(entry[0], str) and isinstance(entry[1], list) and
+                all(isinstance(name, str) for name in entry[1])):
+            raise ValueError("Malformed process entry: %r" % (entry,))
+        argv, procfiles = entry
+        files.update(procfiles)
+        commands.add(_command(argv))
+    return files, commands
+
+
+def _command(argv):
+    """Return the program name of argv, which is what hosts are counted by"""
+    fields = argv.split()
+    return fields[0] if fields else ""
+
+
+def parse_stream(stream):
+    """
+    Parse one host's results from stream, detecting the format.
+
+    Raises:
+     ValueError if a state file can't be parsed
+    """
+    first = stream.readline()
+    if first.lstrip().startswith("{"):
+        return parse_state(first + stream.read())
+    return parse_machine(itertools.chain([first], stream))
+
+
+def parse_file(filename):
+    """
+    Parse the results in filename.
+
+    Returns:
+     A tuple of (filename, files, commands, error), where error is None or a
+     string describing why the file could not be read or parsed.
+    """
+    try:
+        with open(filename, errors="replace") as stream:
+            files, commands = parse_stream(stream)
+    except (IOError, OSError, ValueError) as this_exc:
+        return filename, set(), set(), str(this_exc)
+    return filename, files, commands, None
+
+
+def expand_dirs(names):
+    """Replace directories in names with the files in them"""
+    for name in names:
+        if os.path.isdir(name):
+            for entry in sorted(os.listdir(name)):
+                yield os.path.join(name, entry)
+        else:
+            yield name
+
+
+def aggregate(results):
+    """
+    Count the hosts per file and per command.
+
+    Args:
+     results: iterable of (filename, files, commands, error) tuples as
+     returned by parse_file(). Only one of them is held in memory at a time.
+    Returns:
+     A tuple of (hosts, filecounts, commandcounts, errors), where hosts is the
+     number of hosts that could be read and errors a list of error messages.
+    """
+    hosts = 0
+    filecounts = Counter()
+    commandcounts = Counter()
+    errors = []
+    for filename, files, commands, error in results:
+        if error is not None:
+            errors.append("%s: %s" % (filename, error))
+            continue
+        hosts += 1
+        filecounts.update(files)
+        commandcounts.update(commands)
+    return hosts, filecounts, commandcounts, errors
+
+
+def fmt_human(hosts, filecounts, commandcounts):
+    """Format the counts for human consumption"""
+    res = ["%d hosts" % hosts, "", "Hosts per deleted file:"]
+    res.extend("%8d %s" % (count, name)
+               for name, count in _sorted(filecounts))
+    res.extend(["", "Hosts per command:"])
+    res.extend("%8d %s" % (count, name)
+               for name, count in _sorted(commandcounts))
+    return "\n".join(res)
+
+
+def fmt_machine(hosts, filecounts, commandcounts):
+    """
+    Format the counts for machine consumption, one per line:
+    hosts;<number of hosts>
+    file;<count>;<name>
+    command;<count>;<name>
+    """
+    res = ["hosts;%d" % hosts]
+    res.extend("file;%d;%s" % (count, name)
+               for name, count in _sorted(filecounts))
+    res.extend("command;%d;%s" % (count, name)
+               for name, count in _sorted(commandcounts))
+    return "\n".join(res)
+
+
+def _sorted(counts):
+    """Sort counts by decreasing count, then name"""
+    return sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+
+
+def main(argv):
+    """Main program"""
+    parser = argparse.ArgumentParser(
+        description="Aggregate the output of lib_users -m, fd_users -m or "
+        "lib_users --state files. Every FILE holds the results of one host.")
+    parser.add_argument('--version', action='version',
+                        version='%%(prog)s %s' % (__version__))
+    parser.add_argument("-m", "--machine-readable", action="store_true",
+                        help="Output machine readable info")
+    parser.add_argument("-j", "--jobs", type=int, metavar="N",
+                        default=os.cpu_count() or 1,
+                        help="Parse %(metavar)s files in parallel "
+                        "(default: %(default)s)")
+    parser.add_argument("files", nargs="+", metavar="FILE",
+                        help="Result file, directory of result files, or - "
+                        "to read one host from stdin")
+
+    options = parser.parse_args(argv)
+
+    filenames = list(expand_dirs(name for name in options.files
+                                 if name != "-"))
+    results = []
+    if "-" in options.files:
+        try:
+            files, commands = parse_stream(sys.stdin)
+        except ValueError as this_exc:
+            results.append(("-", set(), set(), str(this_exc)))
+        else:
+            results.append(("-", files, commands, None))
+
+    if options.jobs > 1 and len(filenames) > 1:
+        pool = multiprocessing.Pool(options.jobs)
+        chunksize = max(1, min(64, len(filenames) // (options.jobs * 4)))
+        try:
+            counts = aggregate(itertools.chain(results, pool.imap_unordered(
+                parse_file, filenames, chunksize)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        counts = aggregate(itertools.chain(results,
+                                           map(parse_file, filenames)))
+
+    hosts, filecounts, commandcounts, errors = counts
+    for error in errors:
+        sys.stderr.write("Warning: could not read %s\n" % error)
+    if options.machine_readable:
+        print(fmt_machine(hosts, filecounts, commandcounts))
+    else:
+        print(fmt_human(hosts, filecounts, commandcounts))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
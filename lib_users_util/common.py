@@ -1,13 +1,82 @@
 # -*- coding: utf-8 -*-
 """Common utility functions for both lib_users and fd_users"""
+import errno
+import os
 import subprocess
 import sys
 
 from collections import defaultdict
+from lib_users_util import observe
+from lib_users_util import systemdbus
 
-FDPROCFSPAT = "/proc/*/fd"
-LIBPROCFSPAT = "/proc/*/maps"
+DELSUFFIX = " (deleted)"
 PROCFSBASE = "/proc/"
+BOOTIDFILE = "/proc/sys/kernel/random/boot_id"
+# Whether PROCFSBASE lists our own process, which is then left out
+SKIPOWNPID = True
+GROUPINGS = ["argv", "exe", "unit"]
+# Kinds of systemd units that processes can belong to (i.e. not slices)
+UNITSUFFIXES = (".service", ".scope", ".socket", ".mount", ".swap")
+# What reading /proc/PID/... fails with if the process is gone
+VANISHED = (errno.ENOENT, errno.ESRCH)
+# What anything fails with if we ran out of file descriptors. Unlike other
+# read errors, these are not about the process read.
+FDEXHAUSTED = (errno.EMFILE, errno.ENFILE)
+
+
+def iter_pids():
+    """
+    Yield the PIDs (as strings) of all processes except our own, while
+    walking PROCFSBASE.
+
+    Non-numeric entries (including self and thread-self) are skipped.
+    """
+    ownpid = str(os.getpid()) if SKIPOWNPID else None
+    with os.scandir(PROCFSBASE) as entries:
+        for entry in entries:
+            if entry.name.isdigit() and entry.name != ownpid:
+                yield entry.name
+
+
+def get_pids():
+    """Get the PIDs (as strings) of all processes except our own"""
+    return list(iter_pids())
+
+
+def iter_links(dirname):
+    """
+    Yield the targets of all symlinks in dirname, e.g. /proc/PID/fd.
+
+    The directory is opened once and the links are read relative to it, so
+    the kernel does not have to look up the whole path for every link. Links
+    that disappear while we read them (because the file was closed) are
+    skipped, and nothing is yielded if the process has exited.
+
+    Raises:
+     OSError (IOError) if dirname can't be read for other reasons, e.g.
+     missing permissions.
+    """
+    try:
+        dirfd = os.open(dirname, os.O_RDONLY | os.O_DIRECTORY)
+    except OSError as this_exc:
+        if this_exc.errno in VANISHED:
+            return
+        raise
+    try:
+        with os.scandir(dirfd) as entries:
+            for entry in entries:
+                try:
+                    target = os.readlink(entry.name, dir_fd=dirfd)
+                except OSError as this_exc:
+                    if this_exc.errno in VANISHED:
+                        continue
+                    raise
+                yield target
+    except OSError as this_exc:
+        if this_exc.errno not in VANISHED:
+            raise
+    finally:
+        os.close(dirfd)
 
 
 def get_progargs(pid):
@@ -22,20 +91,179 @@ def get_progargs(pid):
     return argv.replace('\x00', ' ')
 
 
+def get_exe(pid):
+    """
+    Get the path of the executable of a given PID.
+
+    If the executable has been deleted or replaced, this is still the path it
+    had when the process started.
+    """
+    try:
+        exe = os.readlink("%s/%s/exe" % (PROCFSBASE, pid))
+    except OSError:
+        return None
+    if exe.endswith(DELSUFFIX):
+        exe = exe[:-len(DELSUFFIX)]
+    return exe
+
+
+def get_unit(pid):
+    """
+    Get the systemd unit a given PID belongs to, as recorded in its cgroup.
+
+    Returns None if the process does not belong to a unit (or systemd is not
+    in use).
+    """
+    try:
+        with open("%s/%s/cgroup" % (PROCFSBASE, pid)) as fd:
+            lines = fd.read().splitlines()
+    except IOError:
+        return None
+    # Lines look like "0::/system.slice/sshd.service" (cgroup v2) or
+    # "1:name=systemd:/system.slice/sshd.service" (v1).
+    for line in lines:
+        fields = line.split(":", 2)
+        if len(fields) == 3 and fields[1] in ("", "name=systemd"):
+            # Units may create cgroups below their own one, so take the
+            # innermost unit, not the last component.
+            units = [name for name in fields[2].split("/")
+                     if name.endswith(UNITSUFFIXES)]
+            if units:
+                return units[-1]
+    return None
+
+
+class Grouper(object):
+    """
+    Find the key a process is listed under in a lib_users dict.
+
+    Depending on mode, processes are grouped by their argv (as string), their
+    executable, or the systemd unit they belong to (falling back to the
+    executable if there is none). Processes are grouped by the identity of the
+    executable (device and inode), so if different executables have the same
+    path, all but the first one are listed with their device and inode.
+    """
+
+    def __init__(self, mode="argv"):
+        self.mode = mode
+        # path: [(dev, inode), ...]
+        self._exes = {}
+
+    def key(self, pid):
+        """Return the key for pid, or None if it can't be determined"""
+        if self.mode == "argv":
+            return get_progargs(pid)
+        if self.mode == "unit":
+            unit = get_unit(pid)
+            if unit is not None:
+                return unit
+        return self._exe_key(pid)
+
+    def _exe_key(self, pid):
+        """Return the key for pid by its executable"""
+        exe = "%s/%s/exe" % (PROCFSBASE, pid)
+        try:
+            path = os.readlink(exe)
+        except OSError:
+            return None
+        try:
+            stat = os.stat(exe)
+            identity = (stat.st_dev, stat.st_ino)
+        except OSError:
+            identity = None
+        identities = self._exes.setdefault(path, [identity])
+        if identity not in identities:
+            identities.append(identity)
+        if identity is None or identities.index(identity) == 0:
+            return path
+        return "%s (device %d, inode %d)" % ((path,) + identity)
+
+
+def get_starttime(pid):
+    """
+    Get the start time of a given PID (in clock ticks since boot) as a string.
+
+    Together with the PID, this identifies a process across PID reuse.
+    """
+    try:
+        with open("%s/%s/stat" % (PROCFSBASE, pid)) as fd:
+            stat = fd.read()
+    except IOError:
+        return None
+    # The command name (field 2) may contain spaces and parentheses, so split
+    # after the last closing paren. Field 22 (starttime) then is at index 19.
+    fields = stat.rsplit(")", 1)[-1].split()
+    if len(fields) < 20:
+        return None
+    return fields[19]
+
+
+def get_fsview(pid):
+    """
+    Identify the file system view of a given PID.
+
+    Processes with the same mount namespace and root directory see the same
+    files under the same paths. Returns None if this can't be determined.
+    """
+    base = "%s/%s" % (PROCFSBASE, pid)
+    try:
+        mntns = os.readlink("%s/ns/mnt" % base)
+        root = os.stat("%s/root" % base)
+    except OSError:
+        return None
+    return (mntns, root.st_dev, root.st_ino)
+
+
+def get_view_root(pid):
+    """
+    Find out how to reach the files a given PID maps under the paths its maps
+    file shows.
+
+    The kernel shows these paths relative to our root directory if the
+    process shares our mount namespace, and relative to the root of its own
+    mount namespace otherwise. Neither is the root directory of the process
+    if it was chroot()'ed.
+
+    Returns:
+     A tuple of (directory, prefix): strip prefix from a path, then prepend
+     directory to it. Paths that don't start with prefix are outside the
+     root directory of the process.
+    Raises:
+     OSError if the process can't be inspected
+    """
+    base = "%s/%s" % (PROCFSBASE, pid)
+    if os.readlink("%s/ns/mnt" % base) == \
+            os.readlink("%s/self/ns/mnt" % PROCFSBASE):
+        return "", ""
+    return "%s/root" % base, os.readlink("%s/root" % base).rstrip("/")
+
+
+def get_boot_id():
+    """Get the kernel's boot ID, or None if it can't be read"""
+    try:
+        with open(BOOTIDFILE) as fd:
+            return fd.read().strip()
+    except IOError:
+        return None
+
+
 def fmt_human(lib_users, options):
     """
     Format a list of library users into a human-readable table.
 
     Args:
-     lib_users: Dict of library users, keys are argvs (as string), values are
-     tuples of two sets, first listing the libraries used, second listing the
-     PIDs: { argv: ({pid, pid, ...}, {lib, lib, ...}), argv: ... }
+     lib_users: Dict of library users, keys are argvs (as string) or other
+     keys from Grouper, values are tuples of two sets, first listing the
+     PIDs, second listing the libraries used:
+     { argv: ({pid, pid, ...}, {lib, lib, ...}), argv: ... }
      options: an object that has a showfiles bool that determines whether the
      libraries in use should be shown. usually the return value of argparse's
      parse_args().
     Returns:
      A multiline string for human consumption
     """
+    if observe.OBSERVER is not None:
+        observe.OBSERVER.format_start("human")
     res = []
     for argv, pidsfiles in lib_users.items():
         pidlist = ",".join(sorted(list(pidsfiles[0])))
@@ -44,6 +272,8 @@ def fmt_human(lib_users, options):
             res.append('%s "%s" uses %s' % (pidlist, argv.strip(), files))
         else:
             res.append('%s "%s"' % (pidlist, argv.strip()))
+    if observe.OBSERVER is not None:
+        observe.OBSERVER.format_end("human")
     return "\n".join(res)
 
 
@@ -58,11 +288,15 @@ def fmt_machine(lib_users):
     Returns:
      A multiline string for machine consumption
     """
+    if observe.OBSERVER is not None:
+        observe.OBSERVER.format_start("machine")
     res = []
     for argv, pidsfiles in lib_users.items():
         pidlist = ",".join(sorted(pidsfiles[0]))
         files = ",".join(sorted(pidsfiles[1]))
         res.append("%s;%s;%s" % (pidlist, files, argv.strip()))
+    if observe.OBSERVER is not None:
+        observe.OBSERVER.format_end("machine")
     return "\n".join(res)
 
 
@@ -106,17 +340,34 @@ def query_systemctl(pid, output=None):
     return svc
 
 
-def get_services(lib_users):
+def get_services(lib_users, starttimes=None):
     """
-    Run systemctl status for the PIDs in the lib_users list and return a
+    Ask systemd for the units of the PIDs in the lib_users list and return a
     list of PIDs to service names as a string for human consumption.
+
+    The units are looked up over D-Bus if possible, otherwise by running
+    systemctl status for every PID. If starttimes (a dict of PID: start time
+    of the process that was scanned) is given, processes that exited before
+    the answer came are left out, since it may be about a process that reused
+    the PID.
     """
     svc4pid = defaultdict(list)
+    try:
+        units = systemdbus.get_units(
+            sorted(set(pid for pids, _ in lib_users.values() for pid in pids)))
+    except (systemdbus.BusError, OSError):
+        units = None
     try:
         for _, pidsfiles in lib_users.items():
             pidlist = sorted(pidsfiles[0])
             for pid in pidlist:
-                unit = query_systemctl(pid)
+                if units is not None:
+                    unit = units.get(pid)
+                else:
+                    unit = query_systemctl(pid)
+                if starttimes and pid in starttimes and \
+                        get_starttime(pid) != starttimes[pid]:
+                    continue
                 if unit:
                     svc4pid[unit].append(pid)
     except OSError as this_exc:
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Ignore rules loaded from a config file
+
+The file has one [global] section for rules that apply to all processes and
+one section per executable (named by its full path) for rules that only apply
+to processes running that executable. Each section can have ignore_pattern
+(globs) and ignore_literal (fixed strings) options, with one value per line:
+
+    [global]
+    ignore_literal = /var/lib/foo/cache.db
+
+    [/usr/bin/python2.7]
+    ignore_pattern = /tmp/orcexec.*
+                     /run/user/*/orcexec*
+"""
+import configparser
+import fnmatch
+
+from lib_users_util import common
+from lib_users_util import observe
+
+CONFIGFILE = "/etc/lib_users.conf"
+GLOBALSECTION = "global"
+
+
+class ConfigError(Exception):
+    """The config file could not be read or parsed"""
+
+
+class Rules(object):
+    """A set of globs and literals for files that should be ignored"""
+
+    def __init__(self, patterns=(), literals=()):
+        self.patterns = list(patterns)
+        self.literals = set(literals)
+
+    def match(self, name):
+        """Return the rule that says to ignore name, or None"""
+        if name in self.literals:
+            return name
+        for pattern in self.patterns:
+            if fnmatch.fnmatch(name, pattern):
+                return pattern
+        return None
+
+
+def load_config(filename=None):
+    """
+    Load ignore rules from filename.
+
+    Args:
+     filename: the file to load. If None, CONFIGFILE is loaded if it exists.
+    Returns:
+     A tuple of the global Rules and a dict that maps executable paths to the
+     Rules for that executable.
+    Raises:
+     ConfigError if the file can't be read or parsed.
+    """
+    parser = configparser.ConfigParser(interpolation=None)
+    try:
+        if filename is None:
+            parser.read(CONFIGFILE)
+        else:
+            with open(filename) as fd:
+                parser.read_file(fd)
+    except (IOError, configparser.Error) as this_exc:
+        raise ConfigError("Could not load %s: %s" %
+                          (filename or CONFIGFILE, this_exc))
+
+    globalrules = Rules()
+    exerules = {}
+    for section in parser.sections():
+        if section == GLOBALSECTION:
+            rules = globalrules
+        elif section.startswith("/"):
+            rules = exerules.setdefault(section, Rules())
+        else:
+            raise ConfigError("Unknown section in %s: %s" %
+                              (filename or CONFIGFILE, section))
+        rules.patterns.extend(_getlines(parser, section, "ignore_pattern"))
+        rules.literals.update(_getlines(parser, section, "ignore_literal"))
+    return globalrules, exerules
+
+
+def _getlines(parser, section, option):
+    """Get a multi-line option as a list of non-empty lines"""
+    value = parser.get(section, option, fallback="")
+    return [line.strip() for line in value.splitlines() if line.strip()]
+
+
+def filter_for_pid(pid, files, exerules):
+    """
+    Remove files that the rules for the executable of pid say to ignore.
+
+    Args:
+     pid: PID (as string) of the process that uses files
+     files: a set of deleted files
+     exerules: the per-executable dict as returned by load_config()
+    Returns:
+     The files that should not be ignored, as a set
+    """
+    if not exerules:
+        return files
+    rules = exerules.get(common.get_exe(pid))
+    if rules is None:
+        return files
+    kept = set()
+    for name in files:
+        rule = rules.match(name)
+        if rule is None:
+            kept.add(name)
+        elif observe.OBSERVER is not None:
+            observe.OBSERVER.ignored(name, rule)
+    return kept
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+Resident mode that follows process events instead of rescanning all of /proc
+
+Only processes that were started (forked or exec'd) since the last scan are
+scanned again, processes that exit are dropped. A full scan is still done
+every now and then, in case events were missed.
+"""
+import errno
+import select
+import sys
+import time
+
+from lib_users_util import common
+from lib_users_util import pidfd
+from lib_users_util import procconn
+from lib_users_util import state
+
+DEFAULT_FULL_SCAN_INTERVAL = 3600.0
+# Give new processes some time to map their libraries before scanning them
+DEFAULT_RESCAN_DELAY = 1.0
+
+NOCONNWARNING = """\
+Warning: Could not listen to process events (%s), falling back to full scans
+only. Note that this needs to be run as root.\n"""
+
+
+class ProcTable(object):
+    """
+    The most recent scan results, by PID.
+
+    Args:
+     scan_pid: a function that takes a PID (as string) and a dict that is
+     shared between all calls of the same scan, for caching. It returns a
+     tuple of argv (as string) and a set of deleted files, or None if the
+     process does not use any. It may raise IOError if the process can't be
+     read.
+     watcher: a pidfd.ExitWatcher, or None. If given, every process is pinned
+     while it is scanned, and those that use deleted files stay in the
+     watcher (as long as it has room), so the caller can drop them as soon as
+     they exit.
+    Raises:
+     OSError from the scans if we ran out of file descriptors
+    """
+
+    def __init__(self, scan_pid, watcher=None):
+        self.procs = {}
+        self.watcher = watcher
+        self._scan_pid = scan_pid
+
+    def full_scan(self):
+        """Scan all processes, return the changes like diff_snapshots()"""
+        new = self._scan(common.get_pids())
+        old = self.procs
+        self.procs = new
+        self._unwatch(pid for pid in old if pid not in new)
+        return _diff(old, new)
+
+    def rescan(self, pids):
+        """Scan pids again, return the changes like diff_snapshots()"""
+        new = self._scan(pids)
+        old = dict((pid, self.procs[pid]) for pid in pids
+                   if pid in self.procs)
+        # Replace the dict as a whole, so readers in other threads never see
+        # it change under them.
+        procs = dict(self.procs)
+        for pid in old:
+            del procs[pid]
+        procs.update(new)
+        self.procs = procs
+        self._unwatch(pid for pid in old if pid not in new)
+        return _diff(old, new)
+
+    def drop(self, pids):
+        """Forget pids, return the changes like diff_snapshots()"""
+        old = dict((pid, self.procs[pid]) for pid in pids
+                   if pid in self.procs)
+        if old:
+            self.procs = dict((pid, result)
+                              for pid, result in self.procs.items()
+                              if pid not in old)
+        self._unwatch(pids)
+        return _diff(old, {})
+
+    def _scan(self, pids):
+        """Scan pids, return the results as a dict"""
+        cache = {}
+        results = {}
+        for pid in pids:
+            pin = None
+            try:
+                if self.watcher is not None:
+                    pin = pidfd.pin(pid)
+                result = self._scan_pid(pid, cache)
+            except (IOError, OSError) as this_exc:
+                if this_exc.errno in common.FDEXHAUSTED:
+                    if pin is not None:
+                        pin.close()
+                    raise
+                result = None
+            if pin is not None and not pin.alive():
+                # What we read may belong to a process that reused the PID
+                result = None
+            if result:
+                results[pid] = result
+                if pin is not None and self.watcher.add(pin):
+                    continue
+            if pin is not None:
+                pin.close()
+        return results
+
+    def _unwatch(self, pids):
+        """Stop watching pids"""
+        if self.watcher is not None:
+            for pid in pids:
+                self.watcher.discard(pid)
+
+
+def _diff(old, new):
+    """Compare two dicts of PID: (argv, files)"""
+    return state.diff_snapshots(_snapshot(old), _snapshot(new))
+
+
+def _snapshot(procs):
+    """Turn a dict of PID: (argv, files) into a snapshot of one boot"""
+    return {"boot_id": None,
+            "procs": dict((pid, [argv, files])
+                          for pid, (argv, files) in procs.items())}
+
+
+def run(table, options, report):
+    """
+    Keep table up to date, forever.
+
+    Args:
+     table: a ProcTable
+     options: an object with full_scan_interval and rescan_delay (seconds),
+     usually the return value of argparse's parse_args().
+     report: a function that is called with the appeared and disappeared
+     dicts after every update.
+    """
+    # Subscribe before the first scan, so that the events of processes that
+    # start while it runs are queued, and these processes rescanned after it.
+    try:
+        conn = procconn.ProcConnector()
+    except (IOError, OSError) as this_exc:
+        sys.stderr.write(NOCONNWARNING % this_exc)
+        conn = None
+
+    report(*table.full_scan())
+    next_full = time.time() + options.full_scan_interval
+
+    # poll() rather than select(), which fails for descriptors above
+    # FD_SETSIZE, as with many processes pinned by the watcher
+    poller = select.poll()
+    # fd: conn or watcher
+    sources = {}
+    for source in (conn, table.watcher):
+        if source is not None:
+            poller.register(source, select.POLLIN)
+            sources[source.fileno()] = source
+
+    # PID: time we learned it was started
+    started = {}
+    while True:
+        now = time.time()
+        timeout = next_full - now
+        if started:
+            timeout = min(timeout,
+                          min(started.values()) + options.rescan_delay - now)
+        timeout = max(timeout, 0)
+
+        if sources:
+            ready = [sources[fd] for fd, _ in poller.poll(timeout * 1000)]
+        else:
+            time.sleep(timeout)
+            ready = []
+
+        if table.watcher is not None and table.watcher in ready:
+            exited = table.watcher.exited()
+            for pid in exited:
+                started.pop(pid, None)
+            if exited:
+                report(*table.drop(exited))
+
+        if conn is not None and conn in ready:
+            try:
+                events = conn.read_events()
+            except (IOError, OSError) as this_exc:
+                if this_exc.errno != errno.ENOBUFS:
+                    raise
+                # We lost events, so only a full scan can tell what happened
+                next_full = now
+                events = []
+            exited = []
+            for event, pid in events:
+                if event == procconn.EXIT:
+                    started.pop(pid, None)
+                    exited.append(pid)
+                else:
+                    started.setdefault(pid, now)
+            if exited:
+                report(*table.drop(exited))
+
+        now = time.time()
+        if now >= next_full:
+            started.clear()
+            report(*table.full_scan())
+            next_full = now + options.full_scan_interval
+            continue
+
+        due = [pid for pid, when in started.items()
+               if now - when >= options.rescan_delay]
+        if due:
+            for pid in due:
+                del started[pid]
+            report(*table.rescan(due))
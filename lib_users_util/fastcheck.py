@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+The fast tier of a scan: find processes whose executable or ELF interpreter
+(the dynamic loader, e.g. ld-linux-x86-64.so.2) was deleted, without reading
+their maps files.
+
+The executable takes one readlink() of /proc/PID/exe. The interpreter takes a
+read of the small auxv file to find where it was loaded and, if the kernel
+supports PROCMAP_QUERY (see procmap), one ioctl to look up that mapping. On
+older kernels, only the executable is checked.
+
+Libraries other than the interpreter are only found by a full scan of the
+maps file. So are scripts: for them, the executable is the script
+interpreter (e.g. python3), which is checked like any other executable, but
+the script itself is neither the executable nor mapped.
+"""
+import os
+import struct
+
+from lib_users_util import common
+from lib_users_util import procmap
+
+# The auxiliary vector is a list of (type, value) pairs of unsigned longs
+_AUXVENTRY = struct.Struct("@LL")
+AT_NULL = 0
+AT_BASE = 7
+
+
+def get_deleted_exe(pid):
+    """
+    Get the path of the executable of pid if it was deleted.
+
+    Returns:
+     The path, or None if the executable was not deleted, the process has
+     exited or it has no executable (kernel threads).
+    Raises:
+     OSError (IOError) if /proc/PID/exe can't be read for other reasons.
+    """
+    try:
+        exe = os.readlink("%s/%s/exe" % (common.PROCFSBASE, pid))
+    except OSError as this_exc:
+        if this_exc.errno in common.VANISHED:
+            return None
+        raise
+    if exe.endswith(common.DELSUFFIX):
+        return exe[:-len(common.DELSUFFIX)]
+    return None
+
+
+def get_interp_base(auxv):
+    """Get the load address of the ELF interpreter from an auxv file, or 0"""
+    for offset in range(0, len(auxv) - _AUXVENTRY.size + 1, _AUXVENTRY.size):
+        key, value = _AUXVENTRY.unpack_from(auxv, offset)
+        if key == AT_BASE:
+            return value
+        if key == AT_NULL:
+            break
+    return 0
+
+
+def get_interp(pid):
+    """
+    Get the name of the mapping of the ELF interpreter of pid, as it would be
+    shown in the maps file.
+
+    Returns:
+     The name, or None if the process has no interpreter (static binaries,
+     kernel threads), has exited or the kernel does not support PROCMAP_QUERY.
+    Raises:
+     OSError (IOError) if the process can't be read for other reasons.
+    """
+    base = "%s/%s" % (common.PROCFSBASE, pid)
+    try:
+        with open("%s/auxv" % base, "rb") as fd:
+            interp_base = get_interp_base(fd.read())
+        if not interp_base:
+            return None
+        with open("%s/maps" % base) as fd:
+            return procmap.file_vma_name(fd, interp_base)
+    except procmap.Unsupported:
+        return None
+    except OSError as this_exc:
+        if this_exc.errno in common.VANISHED:
+            return None
+        raise
+
+
+def check(pid):
+    """
+    Find out if pid runs a deleted executable or ELF interpreter.
+
+    Returns:
+     A set of the deleted files, named like in the maps file.
+    Raises:
+     OSError (IOError) if the process can't be read.
+    """
+    deleted = set()
+    exe = get_deleted_exe(pid)
+    if exe is not None:
+        deleted.add(exe)
+    interp = get_interp(pid)
+    if interp is not None and interp.endswith("(deleted)"):
+        # Split like get_deleted_libs() does
+        deleted.add(interp.split()[-2])
+    return deleted
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+An index of all mapped files, to find out which processes would have to be
+restarted if a given file was updated.
+"""
+import fnmatch
+import json
+import os
+import sys
+
+from collections import defaultdict
+from lib_users_util import common
+
+INDEXVERSION = 2
+
+
+class MapIndex(object):
+    """
+    All files mapped by processes, with the PIDs that map them.
+
+    Paths and PIDs are interned, so every distinct one is only stored once no
+    matter how many processes map it. Saved indexes identify processes by PID
+    and start time, so a reused PID is not mistaken for the process that had
+    it before.
+    """
+
+    def __init__(self):
+        # path: set of PIDs
+        self.pids = defaultdict(set)
+        # PID: argv (or other key from Grouper)
+        self.keys = {}
+        # PID: start time
+        self.starttimes = {}
+        self.boot_id = None
+
+    def add(self, pid, starttime, key, paths):
+        """Record that pid (started at starttime, listed as key) maps paths"""
+        pid = sys.intern(pid)
+        self.keys[pid] = key
+        self.starttimes[pid] = starttime
+        for path in paths:
+            self.pids[sys.intern(path)].add(pid)
+
+    def query(self, patterns):
+        """
+        Find the processes mapping files that match any of patterns.
+
+        The kernel lists mapped files by their canonical paths, so patterns
+        are also tried with symlinks in them resolved (e.g. /lib/libc.so.6
+        as /usr/lib/libc.so.6 with a merged /usr). For globs, only the
+        directory part is resolved.
+
+        Args:
+         patterns: paths or globs
+        Returns:
+         A dict of users as taken by fmt_human(), listing the matching files
+        """
+        matches = set()
+        for pattern in patterns:
+            for candidate in _resolve(pattern):
+                if any(char in candidate for char in "*?["):
+                    matches.update(fnmatch.filter(self.pids, candidate))
+                elif candidate in self.pids:
+                    matches.add(candidate)
+
+        users = defaultdict(lambda: (set(), set()))
+        for path in matches:
+            for pid in self.pids[path]:
+                key = self.keys[pid]
+                users[key][0].add(pid)
+                users[key][1].add(path)
+        return users
+
+    def _procid(self, pid):
+        """Get the "pid:starttime" a process is saved as"""
+        return "%s:%s" % (pid, self.starttimes[pid])
+
+    def save(self, filename):
+        """Atomically write the index to filename"""
+        data = {"version": INDEXVERSION, "boot_id": self.boot_id,
+                "keys": dict((self._procid(pid), key)
+                             for pid, key in self.keys.items()),
+                "paths": dict((path, sorted(self._procid(pid)
+                                            for pid in pids))
+                              for path, pids in self.pids.items())}
+        tmpname = "%s.tmp.%s" % (filename, os.getpid())
+        with open(tmpname, "w") as fd:
+            json.dump(data, fd, separators=(",", ":"))
+        os.rename(tmpname, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Read an index written by save().
+
+        Only the processes that still run are loaded, i.e. none if the index
+        was built before the last reboot.
+
+        Raises:
+         IOError or ValueError if the file can't be read or parsed.
+        """
+        with open(filename) as fd:
+            data = json.load(fd)
+        if not isinstance(data, dict) or data.get("version") != INDEXVERSION:
+            raise ValueError("Not a lib_users index: %s" % filename)
+        index = cls()
+        index.boot_id = data["boot_id"]
+        if index.boot_id != common.get_boot_id():
+            return index
+        procpaths = defaultdict(list)
+        for path, procids in data["paths"].items():
+            for procid in procids:
+                procpaths[procid].append(path)
+        for procid, key in data["keys"].items():
+            pid, _, starttime = procid.partition(":")
+            if common.get_starttime(pid) == starttime:
+                index.add(pid, starttime, key, procpaths[procid])
+        return index
+
+
+def _resolve(pattern):
+    """Get pattern and, if it differs, pattern with symlinks resolved"""
+    if any(char in pattern for char in "*?["):
+        dirname, basename = os.path.split(pattern)
+        if any(char in dirname for char in "*?["):
+            return [pattern]
+        resolved = os.path.join(os.path.realpath(dirname), basename)
+    else:
+        resolved = os.path.realpath(pattern)
+    if resolved == pattern:
+        return [pattern]
+    return [pattern, resolved]
+
+
+def build(pids, get_paths, get_key):
+    """
+    Build an index of pids.
+
+    Args:
+     pids: the PIDs to index
+     get_paths: a function that returns the files mapped by a PID. It may
+     raise IOError if they can't be read. Processes that exited in the
+     meantime are skipped without counting as a failure.
+     get_key: a function that returns the key (e.g. argv) a PID is listed
+     under, or None if it can't be determined.
+    Returns:
+     A tuple of the MapIndex and a bool that is True if any PID could not be
+     read.
+    """
+    index = MapIndex()
+    index.boot_id = common.get_boot_id()
+    read_failure = False
+    for pid in pids:
+        starttime = common.get_starttime(pid)
+        if starttime is None:
+            # The process is already gone
+            continue
+        try:
+            paths = get_paths(pid)
+        except IOError as this_exc:
+            if this_exc.errno not in common.VANISHED:
+                read_failure = True
+            continue
+        key = get_key(pid)
+        if paths and key:
+            index.add(pid, starttime, key, paths)
+    return index, read_failure
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""Memory held by deleted mappings, from /proc/PID/smaps"""
+from collections import defaultdict
+from lib_users_util import common
+from lib_users_util import observe
+
+# Lines that start a mapping in smaps begin with its (lower-case hex) start
+# address, field lines with a capitalised field name.
+_HEXDIGITS = frozenset("0123456789abcdef")
+_FIELDS = {"Rss:": 0, "Pss:": 1}
+
+
+def get_deleted_memory(smaps_file, libs):
+    """
+    Sum up Rss and Pss of the mappings of libs in a given smaps file.
+
+    Only the fields of mappings of libs are looked at, all others are skipped
+    after checking their first character.
+
+    Args:
+     smaps_file: an open /proc/PID/smaps file
+     libs: the set of deleted (or replaced) files, as found in the maps file
+    Returns:
+     A dict of lib: [rss, pss], in kB
+    """
+    usage = {}
+    current = None
+    for line in smaps_file:
+        if line[:1] in _HEXDIGITS:
+            name = _mapped_name(line)
+            current = usage.setdefault(name, [0, 0]) if name in libs \
+                else None
+        elif current is not None:
+            fields = line.split()
+            idx = _FIELDS.get(fields[0]) if fields else None
+            if idx is not None:
+                current[idx] += int(fields[1])
+    return usage
+
+
+def _mapped_name(line):
+    """Get the name of a mapping like get_deleted_libs() would"""
+    line = line.strip()
+    if line.endswith("(deleted)"):
+        return line.split()[-2]
+    fields = line.split(None, 5)
+    if len(fields) < 6:
+        return None
+    if fields[5].startswith("(deleted)"):
+        # OpenVZ
+        return fields[5][9:]
+    return fields[5]
+
+
+def collect(procs):
+    """
+    Get the memory held by deleted mappings for every process in procs.
+
+    Args:
+     procs: Dict of pid: (argv, {lib, lib, ...})
+    Returns:
+     A dict of pid: {lib: [rss, pss], ...}. Processes whose smaps can't be
+     read are left out.
+    """
+    res = {}
+    for pid, (_, libs) in procs.items():
+        try:
+            with open("%s/%s/smaps" % (common.PROCFSBASE, pid)) as fd:
+                res[pid] = get_deleted_memory(fd, libs)
+        except IOError:
+            continue
+    return res
+
+
+def fmt_memory(procs, usage, options):
+    """
+    Format memory usage per process, per lib and in total.
+
+    Args:
+     procs: Dict of pid: (argv, {lib, lib, ...})
+     usage: Dict as returned by collect()
+     options: an object with a machine_readable bool
+    Returns:
+     A multiline string
+    """
+    if observe.OBSERVER is not None:
+        observe.OBSERVER.format_start("memory")
+    perlib = defaultdict(lambda: [0, 0])
+    perpid = {}
+    for pid, libs in usage.items():
+        perpid[pid] = [sum(rss for rss, _ in libs.values()),
+                       sum(pss for _, pss in libs.values())]
+        for lib, (rss, pss) in libs.items():
+            perlib[lib][0] += rss
+            perlib[lib][1] += pss
+    total = [sum(rss for rss, _ in perpid.values()),
+             sum(pss for _, pss in perpid.values())]
+
+    res = []
+    if options.machine_readable:
+        # Starting with "#" tells these apart from the records of
+        # common.fmt_machine(), which precede them in the same output.
+        for pid in sorted(perpid, key=int):
+            res.append("#pid;%s;%d;%d" % (pid, perpid[pid][0],
+                                          perpid[pid][1]))
+        for lib in sorted(perlib):
+            res.append("#lib;%s;%d;%d" % (lib, perlib[lib][0],
+                                          perlib[lib][1]))
+        res.append("#total;%d;%d" % tuple(total))
+    else:
+        res.append("Memory held by deleted mappings (Rss/Pss in kB):")
+        for pid in sorted(perpid, key=lambda pid: -perpid[pid][1]):
+            res.append('%s "%s" %d/%d' % (pid, procs[pid][0].strip(),
+                                          perpid[pid][0], perpid[pid][1]))
+        for lib in sorted(perlib, key=lambda lib: -perlib[lib][1]):
+            res.append("%s %d/%d" % (lib, perlib[lib][0], perlib[lib][1]))
+        res.append("Total %d/%d" % tuple(total))
+    if observe.OBSERVER is not None:
+        observe.OBSERVER.format_end("memory")
+    return "\n".join(res)
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Hooks for watching scans from the outside, e.g. for profiling or metrics.
+
+Subclass Observer, override the events of interest and register() an instance.
+The scan loops check OBSERVER against None before calling a hook, so without
+an observer, every hook point costs one global lookup.
+
+Only single scans report events, not the daemon and server modes.
+"""
+import json
+import os
+import time
+
+# The registered observer, if any
+OBSERVER = None
+
+
+class Observer(object):
+    """The events of a scan. All of them do nothing by default."""
+
+    def pid_start(self, pid):
+        """Scanning pid (a string) starts"""
+
+    def pid_end(self, pid, found):
+        """Scanning pid ends, having found found deleted files"""
+
+    def file_read(self, path, size):
+        """path (a file or directory in /proc) was read, size bytes of it"""
+
+    def ignored(self, name, rule):
+        """A deleted file name was ignored because of rule (glob or literal)"""
+
+    def permission_denied(self, path, error):
+        """path could not be read because of error (an OSError)"""
+
+    def format_start(self, kind):
+        """Formatting output of kind (e.g. "human") starts"""
+
+    def format_end(self, kind):
+        """Formatting output of kind ends"""
+
+
+def register(observer):
+    """Make observer receive all events, replacing any previous one"""
+    global OBSERVER
+    OBSERVER = observer
+
+
+def unregister():
+    """Stop sending events"""
+    register(None)
+
+
+class ChromeTrace(Observer):
+    """
+    Record events in the Chrome trace event format, as read by Perfetto or
+    chrome://tracing.
+
+    Scanned processes and formatting are shown as slices, everything else as
+    instant events, and the total number of bytes read as a counter. The file
+    is written by close().
+    """
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._events = []
+        self._started = time.perf_counter()
+        self._pid = os.getpid()
+        self._bytes = 0
+
+    def _add(self, phase, name, args=None, **extra):
+        event = {"name": name, "ph": phase, "pid": self._pid, "tid": 0,
+                 "ts": (time.perf_counter() - self._started) * 1000000}
+        if args is not None:
+            event["args"] = args
+        event.update(extra)
+        self._events.append(event)
+
+    def pid_start(self, pid):
+        self._add("B", "scan %s" % pid, {"pid": pid}, cat="scan")
+
+    def pid_end(self, pid, found):
+        self._add("E", "scan %s" % pid, {"found": found}, cat="scan")
+
+    def file_read(self, path, size):
+        self._bytes += size
+        self._add("i", "read", {"path": path, "bytes": size}, cat="io",
+                  s="t")
+        self._add("C", "bytes read", {"bytes": self._bytes})
+
+    def ignored(self, name, rule):
+        self._add("i", "ignored", {"file": name, "rule": rule},
+                  cat="rules", s="t")
+
+    def permission_denied(self, path, error):
+        self._add("i", "permission denied", {"path": path,
+                                             "error": str(error)},
+                  cat="io", s="t")
+
+    def format_start(self, kind):
+        self._add("B", "format %s" % kind, cat="output")
+
+    def format_end(self, kind):
+        self._add("E", "format %s" % kind, cat="output")
+
+    def close(self):
+        """Write the trace file. Does nothing if it was written already."""
+        if self._events is None:
+            return
+        with open(self._filename, "w") as fd:
+            json.dump({"traceEvents": self._events,
+                       "displayTimeUnit": "ms"}, fd)
+        self._events = None
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""Throttling of /proc reads for latency-sensitive hosts"""
+import os
+import time
+
+from collections import defaultdict
+
+# Spread a gentle scan over this many seconds
+DEFAULT_WINDOW = 10.0
+# Sleep at least this many times as long as the last read took
+DEFAULT_BACKOFF = 10.0
+
+
+def _get_comm(procfile):
+    """Get the command name of the process procfile belongs to"""
+    try:
+        with open(os.path.join(os.path.dirname(procfile), "comm")) as fd:
+            return fd.read().strip()
+    except IOError:
+        return None
+
+
+def interleave(procfiles):
+    """
+    Reorder a list of per-process files so that processes with the same
+    command name are not visited back to back.
+
+    Args:
+     procfiles: List of files like /proc/PID/maps or /proc/PID/fd
+    Returns:
+     A list of the same files, going round-robin over the command names,
+     starting with the most common one.
+    """
+    groups = defaultdict(list)
+    for procfile in procfiles:
+        groups[_get_comm(procfile)].append(procfile)
+    queues = sorted(groups.values(), key=len, reverse=True)
+    res = []
+    for idx in range(len(queues[0]) if queues else 0):
+        res.extend(queue[idx] for queue in queues if idx < len(queue))
+    return res
+
+
+class Pacer(object):
+    """
+    Spread a number of reads over a time window.
+
+    After each read, call pace() with the time the read took. It sleeps for
+    the remainder of the read's share of the window, but at least backoff
+    times as long as the read took, so reads that are slow because the target
+    process is busy make the scan back off further. If there is no time to
+    sleep, it still yields the CPU.
+    """
+
+    def __init__(self, count, window=DEFAULT_WINDOW, backoff=DEFAULT_BACKOFF):
+        self._slot = window / count if count else 0.0
+        self._backoff = backoff
+
+    def pace(self, elapsed):
+        """Wait after a read that took elapsed seconds"""
+        delay = max(self._slot - elapsed, elapsed * self._backoff)
+        if delay > 0:
+            time.sleep(delay)
+        elif hasattr(os, "sched_yield"):
+            os.sched_yield()
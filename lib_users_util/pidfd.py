@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Pinning processes with pidfds, so that a PID that is reused while we look at
+its process is not mistaken for that process.
+
+A pidfd refers to one process, not to its PID, and becomes readable when the
+process exits. So if a pidfd opened before reading something from /proc/PID
+is still not readable afterwards, what was read belongs to the same process.
+An epoll set of pidfds tells which processes exited without rescanning.
+
+pidfds need Linux 5.3 and Python 3.9.
+"""
+import errno
+import os
+import resource
+import select
+
+from lib_users_util import common
+
+SUPPORTED = hasattr(os, "pidfd_open")
+# File descriptors an ExitWatcher leaves for everything else (files in /proc,
+# sockets, pipes to child processes)
+RESERVED_FDS = 64
+
+
+class Pin(object):
+    """
+    A pidfd for one process.
+
+    Raises:
+     OSError with errno ESRCH if the process does not exist
+    """
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.fd = os.pidfd_open(int(pid))
+
+    def fileno(self):
+        return self.fd
+
+    def alive(self):
+        """Return if the process is still running"""
+        poller = select.poll()
+        poller.register(self.fd, select.POLLIN)
+        return not poller.poll(0)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def pin(pid):
+    """
+    Pin a process if possible.
+
+    Returns:
+     A Pin, or None if pidfds can't be used (e.g. because a seccomp filter
+     forbids them). The process can then still be scanned, just not pinned.
+    Raises:
+     OSError with errno ESRCH if the process does not exist (anymore), or
+     with an errno in common.FDEXHAUSTED if we ran out of file descriptors.
+    """
+    try:
+        return Pin(pid)
+    except OSError as this_exc:
+        if this_exc.errno == errno.ESRCH or \
+                this_exc.errno in common.FDEXHAUSTED:
+            raise
+        return None
+
+
+class ExitWatcher(object):
+    """
+    An epoll set of Pins, to learn which processes exited as soon as they do.
+
+    Pins are closed when their processes exit or they are discarded. At most
+    max_pins are watched, by default as many as the limit of open files
+    allows, minus RESERVED_FDS.
+    """
+
+    def __init__(self, max_pins=None):
+        if max_pins is None:
+            limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+            if limit != resource.RLIM_INFINITY:
+                max_pins = max(limit - RESERVED_FDS, 0)
+        self.max_pins = max_pins
+        self._epoll = select.epoll()
+        # PID: Pin
+        self._pins = {}
+        # fd: PID
+        self._pids = {}
+
+    def fileno(self):
+        """The file descriptor to wait on for exits"""
+        return self._epoll.fileno()
+
+    def add(self, newpin):
+        """
+        Watch a Pin, replacing any previous one for the same PID.
+
+        Returns:
+         Whether the Pin is watched now. If not, because max_pins are watched
+         already, it is left to the caller.
+        """
+        self.discard(newpin.pid)
+        if self.max_pins is not None and len(self._pins) >= self.max_pins:
+            return False
+        self._epoll.register(newpin.fd, select.EPOLLIN)
+        self._pins[newpin.pid] = newpin
+        self._pids[newpin.fd] = newpin.pid
+        return True
+
+    def discard(self, pid):
+        """Stop watching pid, if it is watched"""
+        oldpin = self._pins.pop(pid, None)
+        if oldpin is not None:
+            self._epoll.unregister(oldpin.fd)
+            del self._pids[oldpin.fd]
+            oldpin.close()
+
+    def exited(self):
+        """
+        Get the watched processes that exited and stop watching them. Does
+        not block.
+
+        Returns:
+         A list of PIDs
+        """
+        pids = [self._pids[fd] for fd, _ in self._epoll.poll(0)]
+        for pid in pids:
+            self.discard(pid)
+        return pids
+
+    def __contains__(self, pid):
+        return pid in self._pins
+
+    def close(self):
+        for pid in list(self._pins):
+            self.discard(pid)
+        self._epoll.close()
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+Map deleted files to the packages that own them
+
+Asking the package manager about every file (dpkg -S, rpm -qf) is slow, so
+this keeps an index of all packaged files on disk. Refreshing it only rereads
+the file lists of packages that changed since the index was written.
+
+The index file is plain text: a header line, then for each package a line of
+the form "@<package> <signature>", followed by the files of that package, one
+per line.
+"""
+import os
+import subprocess
+
+from collections import defaultdict
+
+DPKGINFODIR = "/var/lib/dpkg/info"
+RPMDBDIRS = ["/var/lib/rpm", "/usr/lib/sysimage/rpm"]
+INDEXFILE = "/var/cache/lib_users/pkgindex"
+INDEXHEADER = "# lib_users pkgindex 1"
+RPMQUERY = ["rpm", "-qa", "--qf", "[%{FILENAMES}\t%{NAME}\n]"]
+
+
+def load_index(indexfile=INDEXFILE, dpkgdir=DPKGINFODIR):
+    """
+    Load the file to package index, refreshing it first if needed.
+
+    Args:
+     indexfile: where the index is kept. If it can't be written (e.g. when
+     not running as root), the refreshed index is only used in memory.
+     dpkgdir: the dpkg info directory. If it does not exist, the rpm database
+     is used instead, if any.
+    Returns:
+     A dict of file names to package names.
+    """
+    old = _read_index(indexfile)
+    if os.path.isdir(dpkgdir):
+        packages = _scan_dpkg(dpkgdir, old)
+    else:
+        packages = _scan_rpm(old)
+
+    if packages != old:
+        try:
+            _write_index(indexfile, packages)
+        except (IOError, OSError):
+            pass
+
+    index = {}
+    for package, (_, files) in packages.items():
+        for name in files:
+            index[name] = package
+    return index
+
+
+def lookup(index, name):
+    """
+    Find the package owning name.
+
+    Libraries are often mapped via /usr/lib while the package lists them
+    under /lib, or vice versa (merged /usr), so both are tried.
+    """
+    package = index.get(name)
+    if package is None:
+        if name.startswith("/usr/"):
+            package = index.get(name[4:])
+        else:
+            package = index.get("/usr" + name)
+    return package
+
+
+def tag_users(lib_users, index):
+    """
+    Append the owning package to every file in lib_users.
+
+    Args:
+     lib_users: Dict of library users as taken by fmt_human()
+     index: Dict of file names to package names as returned by load_index()
+    Returns:
+     A new dict of library users where each file that belongs to a package
+     is named "file [package]".
+    """
+    res = defaultdict(lambda: (set(), set()))
+    for argv, (pids, files) in lib_users.items():
+        res[argv][0].update(pids)
+        for name in files:
+            package = lookup(index, name)
+            if package is not None:
+                name = "%s [%s]" % (name, package)
+            res[argv][1].add(name)
+    return res
+
+
+def _read_index(indexfile):
+    """Read an index file into a dict of package: (signature, files)"""
+    packages = {}
+    try:
+        with open(indexfile) as fd:
+            if fd.readline().rstrip("\n") != INDEXHEADER:
+                return {}
+            files = None
+            for line in fd:
+                line = line.rstrip("\n")
+                if line.startswith("@"):
+                    package, signature = line[1:].rsplit(" ", 1)
+                    files = []
+                    packages[package] = (signature, files)
+                elif files is not None:
+                    files.append(line)
+    except (IOError, ValueError):
+        return {}
+    return packages
+
+
+def _write_index(indexfile, packages):
+    """Atomically write packages to indexfile"""
+    dirname = os.path.dirname(indexfile)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    tmpname = "%s.tmp.%s" % (indexfile, os.getpid())
+    with open(tmpname, "w") as fd:
+        fd.write("%s\n" % INDEXHEADER)
+        for package in sorted(packages):
+            signature, files = packages[package]
+            fd.write("@%s %s\n" % (package, signature))
+            for name in files:
+                fd.write("%s\n" % name)
+    os.rename(tmpname, indexfile)
+
+
+def _scan_dpkg(dpkgdir, old):
+    """
+    Get the file lists of all dpkg packages.
+
+    The signature of a package is the mtime of its .list file. Lists that
+    have not changed since old was built are not read again.
+    """
+    packages = {}
+    for entry in os.listdir(dpkgdir):
+        if not entry.endswith(".list"):
+            continue
+        package = entry[:-5]
+        listfile = os.path.join(dpkgdir, entry)
+        try:
+            signature = str(os.stat(listfile).st_mtime_ns)
+            if package in old and old[package][0] == signature:
+                packages[package] = old[package]
+                continue
+            with open(listfile) as fd:
+                files = [line.rstrip("\n") for line in fd
+                         if line.startswith("/") and line != "/.\n"]
+        except (IOError, OSError):
+            continue
+        packages[package] = (signature, files)
+    return packages
+
+
+def _scan_rpm(old):
+    """
+    Get the file lists of all rpm packages.
+
+    rpm has no per-package list files, so the signature is the newest mtime
+    in the database directory and everything is reread if it has changed.
+    """
+    signature = None
+    for dbdir in RPMDBDIRS:
+        try:
+            # The database files may be updated in place, which does not
+            # change the mtime of the directory.
+            mtimes = [os.stat(os.path.join(dbdir, entry)).st_mtime_ns
+                      for entry in os.listdir(dbdir)]
+        except OSError:
+            continue
+        signature = str(max(mtimes + [os.stat(dbdir).st_mtime_ns]))
+        break
+    if signature is None:
+        return {}
+    if old and all(sig == signature for sig, _ in old.values()):
+        return old
+
+    try:
+        pcomm = subprocess.Popen(RPMQUERY, stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE)
+        output, _ = pcomm.communicate()
+    except OSError:
+        return {}
+    packages = {}
+    for line in output.decode("utf-8", "replace").splitlines():
+        name, _, package = line.partition("\t")
+        if package:
+            packages.setdefault(package, (signature, []))[1].append(name)
+    return packages
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Capture the parts of /proc that lib_users and fd_users read into a compressed
+archive, and run against such an archive instead of the live system.
+
+The archive is a gzip'ed tar file that mirrors /proc: one directory per PID
+with copies of the files listed in PROCFILES, the exe link and the links in
+the fd directory stored as symlinks, and the boot ID. The smaps file is only
+copied for processes that map deleted files, since the kernel has to walk
+the page tables of every mapping to produce it, and only -M reads it for
+those processes.
+"""
+import atexit
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+
+from lib_users_util import common
+
+PROCFILES = ["maps", "cmdline", "stat", "cgroup", "comm"]
+BOOTIDNAME = "sys/kernel/random/boot_id"
+
+
+def capture(filename):
+    """
+    Write the relevant files of all processes to filename.
+
+    Files that can't be read (e.g. because the process exited or we lack the
+    permissions) are left out.
+
+    Returns:
+     The number of processes captured.
+    """
+    count = 0
+    with tarfile.open(filename, "w:gz") as archive:
+        bootid = common.get_boot_id()
+        if bootid is not None:
+            _add_file(archive, BOOTIDNAME, ("%s\n" % bootid).encode())
+        for pid in common.get_pids():
+            base = "%s/%s" % (common.PROCFSBASE, pid)
+            _add_dir(archive, pid)
+            maps = None
+            for name in PROCFILES:
+                data = _add_procfile(archive, pid, name)
+                if name == "maps":
+                    maps = data
+            if maps is not None and b"(deleted)" in maps:
+                _add_procfile(archive, pid, "smaps")
+            _add_link(archive, "%s/exe" % pid, "%s/exe" % base)
+            try:
+                fds = os.listdir("%s/fd" % base)
+            except OSError:
+                continue
+            _add_dir(archive, "%s/fd" % pid)
+            for onefd in fds:
+                _add_link(archive, "%s/fd/%s" % (pid, onefd),
+                          "%s/fd/%s" % (base, onefd))
+            count += 1
+    return count
+
+
+def _add_procfile(archive, pid, name):
+    """
+    Add the file name of pid to archive, if it can be read.
+
+    Returns:
+     The contents of the file, or None if it can't be read.
+    """
+    try:
+        with open("%s/%s/%s" % (common.PROCFSBASE, pid, name), "rb") as fd:
+            data = fd.read()
+    except IOError:
+        return None
+    _add_file(archive, "%s/%s" % (pid, name), data)
+    return data
+
+
+def _add_file(archive, name, data):
+    """Add a regular file with the contents data to archive"""
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = time.time()
+    archive.addfile(info, io.BytesIO(data))
+
+
+def _add_dir(archive, name):
+    """Add a directory to archive"""
+    info = tarfile.TarInfo(name)
+    info.type = tarfile.DIRTYPE
+    info.mode = 0o755
+    info.mtime = time.time()
+    archive.addfile(info)
+
+
+def _add_link(archive, name, link):
+    """Add a symlink with the same target as link to archive"""
+    try:
+        target = os.readlink(link)
+    except OSError:
+        return
+    info = tarfile.TarInfo(name)
+    info.type = tarfile.SYMTYPE
+    info.linkname = target
+    info.mtime = time.time()
+    archive.addfile(info)
+
+
+def replay(filename):
+    """
+    Extract the archive filename and make all lookups in common use it
+    instead of /proc. The extracted files are removed when Python exits.
+
+    Raises:
+     IOError or tarfile.TarError if the archive can't be read.
+    """
+    tmpdir = tempfile.mkdtemp(prefix="lib_users-replay-")
+    atexit.register(shutil.rmtree, tmpdir, True)
+    with tarfile.open(filename, "r:*") as archive:
+        if hasattr(tarfile, "tar_filter"):
+            # The fd links point to absolute paths, so the "data" filter
+            # would refuse them.
+            archive.extractall(tmpdir, filter="tar")
+        else:
+            archive.extractall(tmpdir)
+
+    common.PROCFSBASE = tmpdir
+    common.BOOTIDFILE = os.path.join(tmpdir, BOOTIDNAME)
+    # Any process in the archive may happen to have our PID
+    common.SKIPOWNPID = False
+    return tmpdir
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Process events from the kernel's netlink proc connector
+
+The proc connector sends a message for every fork, exec and exit on the
+system. Listening to it requires CAP_NET_ADMIN.
+"""
+import os
+import socket
+import struct
+
+NETLINK_CONNECTOR = 11
+CN_IDX_PROC = 1
+CN_VAL_PROC = 1
+NLMSG_DONE = 3
+PROC_CN_MCAST_LISTEN = 1
+# Not in the socket module
+SO_RCVBUFFORCE = 33
+
+PROC_EVENT_FORK = 0x00000001
+PROC_EVENT_EXEC = 0x00000002
+PROC_EVENT_EXIT = 0x80000000
+
+FORK = "fork"
+EXEC = "exec"
+EXIT = "exit"
+
+# struct nlmsghdr, struct cn_msg and the header of struct proc_event
+_NLMSGHDR = struct.Struct("=IHHII")
+_CNMSG = struct.Struct("=IIIIHH")
+_EVENTHDR = struct.Struct("=IIQ")
+_TWOPIDS = struct.Struct("=II")
+_FOURPIDS = struct.Struct("=IIII")
+
+RECVBUFSIZE = 65536
+# The socket buffer, which queues events while we are busy scanning
+SOCKBUFSIZE = 4 * 1024 * 1024
+
+
+class ProcConnector(object):
+    """A subscription to the proc connector"""
+
+    def __init__(self):
+        self._sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM,
+                                   NETLINK_CONNECTOR)
+        try:
+            try:
+                # Beyond net.core.rmem_max, which needs CAP_NET_ADMIN like
+                # the subscription itself
+                self._sock.setsockopt(socket.SOL_SOCKET, SO_RCVBUFFORCE,
+                                      SOCKBUFSIZE)
+            except (IOError, OSError):
+                self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                                      SOCKBUFSIZE)
+            self._sock.bind((os.getpid(), CN_IDX_PROC))
+            op = struct.pack("=I", PROC_CN_MCAST_LISTEN)
+            cnmsg = _CNMSG.pack(CN_IDX_PROC, CN_VAL_PROC, 0, 0, len(op), 0)
+            nlmsghdr = _NLMSGHDR.pack(
+                _NLMSGHDR.size + len(cnmsg) + len(op), NLMSG_DONE, 0, 0,
+                os.getpid())
+            self._sock.send(nlmsghdr + cnmsg + op)
+        except (IOError, OSError):
+            self._sock.close()
+            raise
+
+    def fileno(self):
+        """The file descriptor to wait on for events"""
+        return self._sock.fileno()
+
+    def read_events(self):
+        """
+        Read one batch of events. Blocks if there are none.
+
+        Returns:
+         A list of (event, pid) tuples, where event is FORK (pid is the new
+         process), EXEC or EXIT. Threads are left out.
+        Raises:
+         IOError with errno ENOBUFS if events were lost because we did not
+         keep up with them.
+        """
+        return parse_events(self._sock.recv(RECVBUFSIZE))
+
+    def close(self):
+        """End the subscription"""
+        self._sock.close()
+
+
+def parse_events(data):
+    """Parse the events in a datagram received from the proc connector"""
+    events = []
+    offset = 0
+    while offset + _NLMSGHDR.size <= len(data):
+        msglen = _NLMSGHDR.unpack_from(data, offset)[0]
+        if msglen < _NLMSGHDR.size:
+            break
+        event = _parse_event(data, offset + _NLMSGHDR.size,
+                             offset + msglen)
+        if event is not None:
+            events.append(event)
+        # Netlink messages are aligned to 4 bytes
+        offset += (msglen + 3) & ~3
+    return events
+
+
+def _parse_event(data, start, end):
+    """Parse the cn_msg between start and end"""
+    end = min(end, len(data))
+    evstart = start + _CNMSG.size
+    pidstart = evstart + _EVENTHDR.size
+    if pidstart + _TWOPIDS.size > end:
+        return None
+    idx, val = _CNMSG.unpack_from(data, start)[:2]
+    if (idx, val) != (CN_IDX_PROC, CN_VAL_PROC):
+        return None
+    what = _EVENTHDR.unpack_from(data, evstart)[0]
+    if what == PROC_EVENT_FORK:
+        if pidstart + _FOURPIDS.size > end:
+            return None
+        # parent_pid, parent_tgid, child_pid, child_tgid
+        pids = _FOURPIDS.unpack_from(data, pidstart)
+        if pids[2] == pids[3]:
+            return FORK, str(pids[3])
+    elif what == PROC_EVENT_EXEC:
+        # process_pid, process_tgid
+        pids = _TWOPIDS.unpack_from(data, pidstart)
+        return EXEC, str(pids[1])
+    elif what == PROC_EVENT_EXIT:
+        # process_pid, process_tgid, exit_code, exit_signal
+        pids = _TWOPIDS.unpack_from(data, pidstart)
+        if pids[0] == pids[1]:
+            return EXIT, str(pids[1])
+    return None
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+Walk file-backed mappings of a process using the PROCMAP_QUERY ioctl
+
+Since Linux 6.11, /proc/PID/maps supports an ioctl that returns one VMA at a
+time in binary form. Asking only for file-backed VMAs means the kernel does
+not have to format (and we do not have to parse) the anonymous ones.
+"""
+import ctypes
+import errno
+import fcntl
+import os
+
+
+# struct procmap_query from include/uapi/linux/fs.h
+class _ProcmapQuery(ctypes.Structure):
+    _fields_ = [
+        ("size", ctypes.c_uint64),
+        ("query_flags", ctypes.c_uint64),
+        ("query_addr", ctypes.c_uint64),
+        ("vma_start", ctypes.c_uint64),
+        ("vma_end", ctypes.c_uint64),
+        ("vma_flags", ctypes.c_uint64),
+        ("vma_page_size", ctypes.c_uint64),
+        ("vma_offset", ctypes.c_uint64),
+        ("inode", ctypes.c_uint64),
+        ("dev_major", ctypes.c_uint32),
+        ("dev_minor", ctypes.c_uint32),
+        ("vma_name_size", ctypes.c_uint32),
+        ("build_id_size", ctypes.c_uint32),
+        ("vma_name_addr", ctypes.c_uint64),
+        ("build_id_addr", ctypes.c_uint64),
+    ]
+
+
+# _IOWR('f', 17, struct procmap_query)
+PROCMAP_QUERY = (3 << 30) | (ctypes.sizeof(_ProcmapQuery) << 16) | \
+    (ord("f") << 8) | 17
+PROCMAP_QUERY_COVERING_OR_NEXT_VMA = 0x10
+PROCMAP_QUERY_FILE_BACKED_VMA = 0x20
+
+# Linux limits path names to PATH_MAX, plus room for " (deleted)"
+NAMEBUFSIZE = 4096 + 16
+
+# None: unknown yet, True/False: (not) supported by the running kernel. Only
+# files on procfs tell, other files never support the ioctl.
+SUPPORTED = None
+# The device of procfs, to tell maps files from copies of them
+_PROCDEV = None
+
+
+class Unsupported(Exception):
+    """The file or the running kernel does not support PROCMAP_QUERY"""
+
+
+def file_vmas(map_file):
+    """
+    Iterate over the file-backed mappings of an open /proc/PID/maps file.
+
+    Args:
+     map_file: an open /proc/PID/maps file (anything with a fileno())
+    Yields:
+     Tuples of (start, end, offset, dev_major, dev_minor, inode, name), where
+     name is the path as it would be shown in the maps file, including a
+     trailing " (deleted)" if applicable.
+    Raises:
+     Unsupported if the ioctl is not available. This is only raised before
+     the first mapping has been yielded.
+     IOError if the process can not be queried.
+    """
+    fileno = _fileno(map_file)
+    namebuf = ctypes.create_string_buffer(NAMEBUFSIZE)
+    query = _ProcmapQuery()
+    addr = 0
+    while _query(fileno, addr, PROCMAP_QUERY_COVERING_OR_NEXT_VMA, query,
+                 namebuf):
+        yield (query.vma_start, query.vma_end, query.vma_offset,
+               query.dev_major, query.dev_minor, query.inode,
+               _name(query, namebuf))
+        addr = query.vma_end
+
+
+def file_vma_name(map_file, addr):
+    """
+    Get the name of the file-backed mapping that contains addr.
+
+    Args:
+     map_file: an open /proc/PID/maps file (anything with a fileno())
+     addr: an address in the process
+    Returns:
+     The name as file_vmas() would yield it, or None if no file-backed
+     mapping contains addr.
+    Raises:
+     Unsupported if the ioctl is not available.
+     IOError if the process can not be queried.
+    """
+    fileno = _fileno(map_file)
+    namebuf = ctypes.create_string_buffer(NAMEBUFSIZE)
+    query = _ProcmapQuery()
+    if not _query(fileno, addr, 0, query, namebuf):
+        return None
+    return _name(query, namebuf)
+
+
+def _fileno(map_file):
+    """Get the file descriptor to query, if the ioctl may work at all"""
+    if SUPPORTED is False:
+        raise Unsupported()
+    try:
+        return map_file.fileno()
+    except (AttributeError, IOError, ValueError):
+        raise Unsupported()
+
+
+def _on_procfs(fileno):
+    """Return whether the file open as fileno is on procfs"""
+    global _PROCDEV
+    if _PROCDEV is None:
+        try:
+            _PROCDEV = os.stat("/proc").st_dev
+        except OSError:
+            _PROCDEV = False
+    try:
+        return os.fstat(fileno).st_dev == _PROCDEV
+    except OSError:
+        return False
+
+
+def _query(fileno, addr, flags, query, namebuf):
+    """
+    Look up the file-backed VMA at (or with flags, after) addr.
+
+    Returns:
+     True if one was found and query filled in, False if there is none.
+    """
+    global SUPPORTED
+    query.size = ctypes.sizeof(query)
+    query.query_flags = flags | PROCMAP_QUERY_FILE_BACKED_VMA
+    query.query_addr = addr
+    query.vma_name_addr = ctypes.addressof(namebuf)
+    query.vma_name_size = NAMEBUFSIZE
+    query.build_id_addr = 0
+    query.build_id_size = 0
+    try:
+        fcntl.ioctl(fileno, PROCMAP_QUERY, query)
+    except IOError as this_exc:
+        if this_exc.errno == errno.ENOENT:
+            # No (more) mappings
+            return False
+        if this_exc.errno in (errno.ENOTTY, errno.EINVAL,
+                              errno.EOPNOTSUPP):
+            # Regular files (e.g. when replaying a capture) never support
+            # the ioctl, so only a maps file tells about the kernel.
+            if SUPPORTED is None and _on_procfs(fileno):
+                SUPPORTED = False
+            raise Unsupported()
+        raise
+    SUPPORTED = True
+    return True
+
+
+def _name(query, namebuf):
+    """Get the name of the VMA in query"""
+    if not query.vma_name_size:
+        return ""
+    return namebuf.value.decode("utf-8", "surrogateescape")
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+Resident mode that answers queries about the most recent scan on a Unix socket
+
+Clients send one request per line and get one JSON object per line back:
+
+    all            all processes that use deleted files
+    pid PID        the deleted files used by PID, if any
+    path PATH      all processes that use the deleted file PATH
+    rescan         scan all processes now (rate-limited), then like "all"
+
+Answers look like {"scanned": <time of the scan>, "procs": {PID: {"argv":
+ARGV, "files": [FILE, ...]}, ...}}, or {"error": MESSAGE}.
+"""
+import json
+import os
+import select
+import signal
+import socket
+import socketserver
+import stat
+import sys
+import threading
+import time
+
+DEFAULT_REFRESH = 60.0
+DEFAULT_MIN_RESCAN_INTERVAL = 5.0
+
+
+class ScanCache(object):
+    """
+    Keeps the results of a ProcTable and rescans it when asked to, but not
+    more often than every min_interval seconds.
+    """
+
+    def __init__(self, table, min_interval=DEFAULT_MIN_RESCAN_INTERVAL):
+        self.table = table
+        self.scanned = 0.0
+        self._min_interval = min_interval
+        self._lock = threading.Lock()
+
+    def rescan(self, force=False):
+        """
+        Scan all processes, unless that has been done very recently. With
+        force, only skip the scan if one finished since this was called.
+        """
+        requested = time.time()
+        with self._lock:
+            # If another client triggered a scan while we were waiting for
+            # the lock, its results are fresh enough.
+            if self.scanned >= requested:
+                return
+            if not force and requested - self.scanned < self._min_interval:
+                return
+            self.table.full_scan()
+            self.scanned = time.time()
+
+    def drop_exited(self):
+        """Forget the processes that the table's watcher saw exit"""
+        with self._lock:
+            self.table.drop(self.table.watcher.exited())
+
+    def query(self, request):
+        """
+        Answer one request.
+
+        Returns:
+         A dict as described in the module documentation
+        """
+        command, _, arg = request.strip().partition(" ")
+        if command == "rescan":
+            self.rescan()
+        elif command not in ("all", "pid", "path"):
+            return {"error": "Unknown request: %s" % command}
+        if command in ("pid", "path") and not arg:
+            return {"error": "Missing argument for %s" % command}
+
+        scanned = self.scanned
+        # The table replaces the dict as a whole, so this is consistent
+        procs = self.table.procs
+        if command == "pid":
+            procs = dict((pid, procs[pid]) for pid in [arg] if pid in procs)
+        elif command == "path":
+            procs = dict((pid, (argv, files))
+                         for pid, (argv, files) in procs.items()
+                         if arg in files)
+        return {"scanned": scanned,
+                "procs": dict((pid, {"argv": argv.strip(),
+                                     "files": sorted(files)})
+                              for pid, (argv, files) in procs.items())}
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    """Answer requests on one connection until the client closes it"""
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = line.decode("utf-8")
+            except UnicodeDecodeError:
+                answer = {"error": "Requests must be UTF-8"}
+            else:
+                answer = self.server.cache.query(request)
+            self.wfile.write(json.dumps(answer).encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def _remove_stale_socket(socket_path):
+    """Remove socket_path if it is the socket of a server that exited"""
+    try:
+        mode = os.lstat(socket_path).st_mode
+    except OSError:
+        return
+    if not stat.S_ISSOCK(mode):
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except ConnectionRefusedError:
+        os.unlink(socket_path)
+    except OSError:
+        pass
+    finally:
+        sock.close()
+
+
+def make_server(cache, socket_path):
+    """
+    Create a server that answers queries about cache on socket_path.
+
+    A socket left over from a server that exited is replaced.
+
+    Raises:
+     OSError if socket_path can't be used, e.g. because another server is
+     listening on it or it is not a socket.
+    """
+    _remove_stale_socket(socket_path)
+    oldumask = os.umask(0o077)
+    try:
+        server = _Server(socket_path, _Handler)
+    finally:
+        os.umask(oldumask)
+    server.cache = cache
+    server.socket_path = socket_path
+    return server
+
+
+def run(server, refresh=DEFAULT_REFRESH):
+    """
+    Answer queries with a server from make_server() forever, rescanning every
+    refresh seconds.
+    """
+    cache = server.cache
+    cache.rescan(force=True)
+
+    def refresher():
+        """Rescan regularly, in the background"""
+        while True:
+            time.sleep(max(0, cache.scanned + refresh - time.time()))
+            cache.rescan(force=True)
+
+    def exit_watcher():
+        """Drop processes as soon as they exit"""
+        poller = select.poll()
+        poller.register(cache.table.watcher, select.POLLIN)
+        while True:
+            poller.poll()
+            cache.drop_exited()
+
+    targets = [refresher]
+    if cache.table.watcher is not None:
+        targets.append(exit_watcher)
+    for target in targets:
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+    # Clean up the socket when asked to stop
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(server.socket_path)
+
+
+def query(socket_path, request):
+    """Send one request to a server on socket_path and return the answer"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        stream = sock.makefile("rwb")
+        stream.write(request.encode("utf-8") + b"\n")
+        stream.flush()
+        answer = stream.readline()
+    finally:
+        sock.close()
+    return json.loads(answer.decode("utf-8"))
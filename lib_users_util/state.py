@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""Persistent scan state, used to report only changes since the last run"""
+import json
+import os
+
+from collections import defaultdict
+from lib_users_util import common
+
+STATEVERSION = 1
+
+
+def make_snapshot(procs, full_scan=None):
+    """
+    Build a snapshot of the scan results that can be saved with save_state().
+
+    Args:
+     procs: Dict of affected processes, keys are PIDs (as string), values are
+     tuples of argv (as string) and a set of deleted files:
+     { pid: (argv, {file, file, ...}), pid: ... }
+     full_scan: the time of the last full scan the results are based on
+    Returns:
+     A dict that holds the boot ID and one entry per process. Processes are
+     keyed by "pid:starttime", so a reused PID is not mistaken for the process
+     that had it before.
+    """
+    entries = {}
+    for pid, (argv, files) in procs.items():
+        starttime = common.get_starttime(pid)
+        if starttime is None:
+            # The process is already gone.
+            continue
+        entries["%s:%s" % (pid, starttime)] = [argv, sorted(files)]
+    return {"version": STATEVERSION, "boot_id": common.get_boot_id(),
+            "full_scan": full_scan, "procs": entries}
+
+
+def last_full_scan(snapshot):
+    """
+    Get the time of the last full scan recorded in snapshot, or None if there
+    is none for the current boot.
+    """
+    if snapshot is None or snapshot.get("boot_id") != common.get_boot_id():
+        return None
+    return snapshot.get("full_scan")
+
+
+def still_running(snapshot, get_key):
+    """
+    Get the processes from snapshot that are still running unchanged.
+
+    Args:
+     snapshot: as returned by load_state(), or None
+     get_key: a function that returns the argv (or other key) of a PID. A
+     process whose key changed has exec'd since, and does not map what it
+     used to.
+    Returns:
+     A dict of pid: (argv, {file, file, ...}) like make_snapshot() takes
+    """
+    procs = {}
+    if last_full_scan(snapshot) is None:
+        return procs
+    for key, (argv, files) in snapshot.get("procs", {}).items():
+        pid, _, starttime = key.partition(":")
+        if common.get_starttime(pid) != starttime:
+            continue
+        if get_key(pid) == argv:
+            procs[pid] = (argv, set(files))
+    return procs
+
+
+def load_state(filename):
+    """
+    Load a snapshot from filename.
+
+    Returns None if the file does not exist or can't be parsed, so that a
+    missing or broken state file just means "everything is new".
+    """
+    try:
+        with open(filename) as fd:
+            snapshot = json.load(fd)
+    except (IOError, ValueError):
+        return None
+    if not isinstance(snapshot, dict) or \
+            snapshot.get("version") != STATEVERSION:
+        return None
+    return snapshot
+
+
+def save_state(filename, snapshot):
+    """Atomically replace filename with snapshot"""
+    tmpname = "%s.tmp.%s" % (filename, os.getpid())
+    with open(tmpname, "w") as fd:
+        json.dump(snapshot, fd, separators=(",", ":"), sort_keys=True)
+    os.rename(tmpname, filename)
+
+
+def diff_snapshots(old, new):
+    """
+    Compare two snapshots and find what appeared and what disappeared.
+
+    If old is None or was taken during a different boot, all of new is
+    considered to have appeared.
+
+    Returns:
+     A tuple of two dicts (appeared, disappeared), both in the same format as
+     the lib_users dict that fmt_human() and fmt_machine() take.
+    """
+    oldprocs = {}
+    if old is not None and old.get("boot_id") == new.get("boot_id"):
+        oldprocs = old.get("procs", {})
+    newprocs = new.get("procs", {})
+
+    appeared = _subtract(newprocs, oldprocs)
+    disappeared = _subtract(oldprocs, newprocs)
+    return appeared, disappeared
+
+
+def _subtract(procs, other):
+    """Return files in procs that are not in other, grouped by argv"""
+    users = defaultdict(lambda: (set(), set()))
+    for key, (argv, files) in procs.items():
+        otherfiles = set(other[key][1]) if key in other else set()
+        files = set(files) - otherfiles
+        if files:
+            users[argv][0].add(key.split(":")[0])
+            users[argv][1].update(files)
+    return users
+
+
+def fmt_changes(appeared, disappeared, options):
+    """
+    Format the result of diff_snapshots() for output.
+
+    Each line that fmt_machine() or fmt_human() produces is prefixed with "+"
+    for appeared and "-" for disappeared entries, separated by a semicolon
+    (machine-readable) or a space (human-readable).
+
+    Args:
+     appeared, disappeared: users dicts as returned by diff_snapshots()
+     options: an object with machine_readable and showitems bools, usually
+     the return value of argparse's parse_args().
+    Returns:
+     A multiline string, empty if nothing changed.
+    """
+    res = []
+    for prefix, users in (("+", appeared), ("-", disappeared)):
+        if not users:
+            continue
+        if options.machine_readable:
+            lines = common.fmt_machine(users).split("\n")
+            res.extend("%s;%s" % (prefix, line) for line in lines)
+        else:
+            lines = common.fmt_human(users, options).split("\n")
+            res.extend("%s %s" % (prefix, line) for line in lines)
+    return "\n".join(res)
@@ -0,0 +1,353 @@
+# -*- coding: utf-8 -*-
+"""
+A minimal D-Bus client, just enough to ask systemd which units processes
+belong to.
+
+All GetUnitByPID calls go over one connection, and they are sent in batches
+before any of their replies is read, so looking up many PIDs takes a few round
+trips instead of one per PID.
+"""
+import binascii
+import collections
+import os
+import re
+import socket
+import struct
+
+from urllib.parse import unquote
+
+SYSTEM_BUS_ADDRESS = "unix:path=/var/run/dbus/system_bus_socket"
+DEFAULT_TIMEOUT = 5.0
+# Calls sent before reading their replies. Bounded, so neither side can block
+# on a full socket buffer while the other one is waiting for it.
+PIPELINE_DEPTH = 256
+# The protocol limit
+MAX_MESSAGE_SIZE = 128 * 1024 * 1024
+
+SYSTEMD = "org.freedesktop.systemd1"
+SYSTEMDPATH = "/org/freedesktop/systemd1"
+MANAGER = "org.freedesktop.systemd1.Manager"
+# Errors that mean a PID does not belong to a unit, as opposed to the bus or
+# systemd not working.
+NOUNITERRORS = ("org.freedesktop.systemd1.NoUnitForPID",
+                "org.freedesktop.DBus.Error.UnixProcessIdUnknown")
+
+METHOD_CALL = 1
+METHOD_RETURN = 2
+ERROR = 3
+SIGNAL = 4
+
+# Header fields and their types
+PATH = 1
+INTERFACE = 2
+MEMBER = 3
+ERROR_NAME = 4
+REPLY_SERIAL = 5
+DESTINATION = 6
+SENDER = 7
+SIGNATURE = 8
+_FIELDTYPES = {PATH: "o", INTERFACE: "s", MEMBER: "s", ERROR_NAME: "s",
+               REPLY_SERIAL: "u", DESTINATION: "s", SENDER: "s",
+               SIGNATURE: "g"}
+
+# endianness, type, flags, version, body length, serial, header fields length
+_FIXEDHDR = "cBBBIII"
+_FIXEDHDRSIZE = 16
+
+Message = collections.namedtuple("Message", "type serial fields body")
+
+
+class BusError(Exception):
+    """The bus could not be used, or systemd did not answer as expected"""
+
+
+class _Writer(object):
+    """Marshals values, aligned relative to the start of the buffer"""
+
+    def __init__(self):
+        self.buf = bytearray()
+
+    def align(self, size):
+        self.buf.extend(b"\0" * (-len(self.buf) % size))
+
+    def value(self, sig, value):
+        if sig == "y":
+            self.buf.append(value)
+        elif sig == "u":
+            self.align(4)
+            self.buf.extend(struct.pack("<I", value))
+        elif sig in "so":
+            data = value.encode("utf-8")
+            self.value("u", len(data))
+            self.buf.extend(data + b"\0")
+        elif sig == "g":
+            data = value.encode("ascii")
+            self.buf.append(len(data))
+            self.buf.extend(data + b"\0")
+        else:
+            raise BusError("Can't marshal type %s" % sig)
+
+
+class _Reader(object):
+    """Unmarshals values, aligned relative to the start of data"""
+
+    def __init__(self, data, endian):
+        self._data = data
+        self._uint32 = struct.Struct(endian + "I")
+        self.pos = 0
+
+    def align(self, size):
+        self.pos += -self.pos % size
+
+    def value(self, sig):
+        if sig == "y":
+            self.pos += 1
+            return self._data[self.pos - 1]
+        if sig == "u":
+            self.align(4)
+            self.pos += 4
+            return self._uint32.unpack_from(self._data, self.pos - 4)[0]
+        if sig in "sog":
+            length = self.value("y" if sig == "g" else "u")
+            end = self.pos + length
+            if end >= len(self._data) or self._data[end] != 0:
+                raise BusError("Malformed string")
+            data = bytes(self._data[self.pos:end])
+            self.pos = end + 1
+            return data.decode("utf-8")
+        raise BusError("Can't unmarshal type %s" % sig)
+
+
+def marshal(msgtype, serial, fields, signature="", args=()):
+    """
+    Build a message.
+
+    Args:
+     msgtype: METHOD_CALL, METHOD_RETURN, ERROR or SIGNAL
+     serial: the serial number of the message, unique per connection
+     fields: dict of header field codes (PATH, MEMBER, ...) to their values
+     signature: the types of args, e.g. "u". Only y, u, s, o and g are
+     supported.
+     args: the arguments in the body
+    Returns:
+     The message as bytes
+    """
+    body = _Writer()
+    for sig, arg in zip(signature, args):
+        body.value(sig, arg)
+    if signature:
+        fields = dict(fields)
+        fields[SIGNATURE] = signature
+    # The fields start at offset 16, so aligning relative to their own start
+    # is the same as relative to the start of the message.
+    hdrfields = _Writer()
+    for code, value in sorted(fields.items()):
+        hdrfields.align(8)
+        hdrfields.value("y", code)
+        hdrfields.value("g", _FIELDTYPES[code])
+        hdrfields.value(_FIELDTYPES[code], value)
+    msg = _Writer()
+    msg.buf.extend(struct.pack("<" + _FIXEDHDR, b"l", msgtype, 0, 1,
+                               len(body.buf), serial, len(hdrfields.buf)))
+    msg.buf.extend(hdrfields.buf)
+    msg.align(8)
+    msg.buf.extend(body.buf)
+    return bytes(msg.buf)
+
+
+def read_message(stream):
+    """
+    Read one message from a binary file object.
+
+    Returns:
+     A Message. Its body is a list of the arguments, or None if their types
+     are not supported.
+    Raises:
+     BusError if the message is malformed or the stream ends, OSError if
+     reading from it fails.
+    """
+    fixed = _read_exactly(stream, _FIXEDHDRSIZE)
+    endian = {b"l": "<", b"B": ">"}.get(fixed[:1])
+    if endian is None:
+        raise BusError("Unknown byte order %r" % fixed[:1])
+    _, msgtype, _, _, bodylen, serial, fieldslen = struct.unpack(
+        endian + _FIXEDHDR, fixed)
+    hdrlen = _FIXEDHDRSIZE + fieldslen + (-fieldslen % 8)
+    if hdrlen + bodylen > MAX_MESSAGE_SIZE:
+        raise BusError("Message too long")
+    data = fixed + _read_exactly(stream, hdrlen - _FIXEDHDRSIZE + bodylen)
+
+    try:
+        reader = _Reader(data, endian)
+        reader.pos = _FIXEDHDRSIZE
+        fields = {}
+        while reader.pos < _FIXEDHDRSIZE + fieldslen:
+            reader.align(8)
+            code = reader.value("y")
+            fields[code] = reader.value(reader.value("g"))
+        reader = _Reader(data[hdrlen:], endian)
+        signature = fields.get(SIGNATURE, "")
+        if all(sig in "yusog" for sig in signature):
+            body = [reader.value(sig) for sig in signature]
+        else:
+            body = None
+    except (IndexError, struct.error, UnicodeDecodeError) as this_exc:
+        raise BusError("Malformed message: %s" % this_exc)
+    return Message(msgtype, serial, fields, body)
+
+
+def _read_exactly(stream, size):
+    """Read size bytes from stream"""
+    data = stream.read(size)
+    if len(data) < size:
+        raise BusError("Connection closed by the bus")
+    return data
+
+
+def _connect(address, timeout):
+    """Connect to the first reachable Unix socket in a D-Bus address"""
+    last_exc = BusError("No usable address in %s" % address)
+    for entry in address.split(";"):
+        transport, _, params = entry.partition(":")
+        params = dict(param.partition("=")[::2]
+                      for param in params.split(","))
+        if transport != "unix":
+            continue
+        if "path" in params:
+            target = unquote(params["path"])
+        elif "abstract" in params:
+            target = "\0" + unquote(params["abstract"])
+        else:
+            continue
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(target)
+        except OSError as this_exc:
+            sock.close()
+            last_exc = this_exc
+            continue
+        return sock
+    raise last_exc
+
+
+class Connection(object):
+    """A connection to a message bus, authenticated as our effective UID"""
+
+    def __init__(self, address=None, timeout=DEFAULT_TIMEOUT):
+        if address is None:
+            address = os.environ.get("DBUS_SYSTEM_BUS_ADDRESS",
+                                     SYSTEM_BUS_ADDRESS)
+        self._sock = _connect(address, timeout)
+        self._stream = self._sock.makefile("rb")
+        self._serial = 0
+        try:
+            self._authenticate()
+            error, _ = self.call_many(
+                "org.freedesktop.DBus", "/org/freedesktop/DBus",
+                "org.freedesktop.DBus", "Hello", "", [()])[0]
+            if error:
+                raise BusError("Hello failed: %s" % error)
+        except Exception:
+            self.close()
+            raise
+
+    def _authenticate(self):
+        """Authenticate with our UID, as is standard for Unix sockets"""
+        uid = binascii.hexlify(str(os.geteuid()).encode("ascii"))
+        self._sock.sendall(b"\0AUTH EXTERNAL " + uid + b"\r\n")
+        answer = self._stream.readline()
+        if not answer.startswith(b"OK "):
+            raise BusError("Authentication failed: %s" %
+                           answer.strip().decode("ascii", "replace"))
+        self._sock.sendall(b"BEGIN\r\n")
+
+    def call_many(self, destination, path, interface, member, signature,
+                  argslist):
+        """
+        Call a method once for every tuple of arguments in argslist.
+
+        Returns:
+         A list with a tuple of (error name, body) for every call, in the
+         order of argslist. The error name is None for successful calls.
+        """
+        replies = []
+        for start in range(0, len(argslist), PIPELINE_DEPTH):
+            replies.extend(self._call_batch(
+                {DESTINATION: destination, PATH: path, INTERFACE: interface,
+                 MEMBER: member}, signature,
+                argslist[start:start + PIPELINE_DEPTH]))
+        return replies
+
+    def _call_batch(self, fields, signature, argslist):
+        """Send all calls in argslist, then collect their replies"""
+        pending = {}
+        data = bytearray()
+        for idx, args in enumerate(argslist):
+            self._serial += 1
+            pending[self._serial] = idx
+            data.extend(marshal(METHOD_CALL, self._serial, fields, signature,
+                                args))
+        self._sock.sendall(data)
+
+        replies = [None] * len(argslist)
+        while pending:
+            msg = read_message(self._stream)
+            if msg.type not in (METHOD_RETURN, ERROR):
+                # e.g. the NameAcquired signal after Hello
+                continue
+            idx = pending.pop(msg.fields.get(REPLY_SERIAL), None)
+            if idx is None:
+                continue
+            error = msg.fields.get(ERROR_NAME, "") if msg.type == ERROR \
+                else None
+            replies[idx] = (error, msg.body)
+        return replies
+
+    def close(self):
+        """Close the connection"""
+        self._stream.close()
+        self._sock.close()
+
+
+def unit_name(path):
+    """
+    Get the name of a unit from its object path, e.g. sshd.service from
+    /org/freedesktop/systemd1/unit/sshd_2eservice
+    """
+    label = path.rsplit("/", 1)[-1].encode("ascii")
+    return re.sub(rb"_([0-9a-f]{2})",
+                  lambda match: bytes([int(match.group(1), 16)]),
+                  label).decode("utf-8", "replace")
+
+
+def get_units(pids, address=None):
+    """
+    Ask systemd for the units a number of processes belong to.
+
+    Args:
+     pids: the PIDs (as strings)
+     address: the bus address, the system bus by default
+    Returns:
+     A dict of pid: unit name. PIDs that do not belong to a unit are left out.
+    Raises:
+     BusError or OSError if the bus can't be reached or systemd can't be
+     asked.
+    """
+    conn = Connection(address)
+    try:
+        replies = conn.call_many(SYSTEMD, SYSTEMDPATH, MANAGER,
+                                 "GetUnitByPID", "u",
+                                 [(int(pid),) for pid in pids])
+    finally:
+        conn.close()
+    units = {}
+    for pid, (error, body) in zip(pids, replies):
+        if error in NOUNITERRORS:
+            continue
+        if error is not None:
+            raise BusError("GetUnitByPID failed: %s" % error)
+        if not body:
+            raise BusError("Unexpected reply to GetUnitByPID")
+        units[pid] = unit_name(body[0])
+    return units
@@ -7,6 +7,8 @@ To be run through nose2, not executed directly.
 import os
 import sys
 import locale
+import shutil
+import tempfile
 from lib_users_util import common
 import unittest
 
@@ -74,6 +76,131 @@ class TestGetProgargs(unittest.TestCase):
         self.assertEqual(common.get_progargs("this is not a pid"), None)
 
 
+class TestGetExe(unittest.TestCase):
+
+    def test_get_exe(self):
+        """The exe of our own process is the Python interpreter"""
+        self.assertEqual(common.get_exe(str(os.getpid())),
+                         os.path.realpath(sys.executable))
+
+    def test_inaccesible_proc(self):
+        self.assertEqual(common.get_exe("this is not a pid"), None)
+
+
+class TestWalkProcfs(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.mkdtemp()
+        self._orig_procfsbase = common.PROCFSBASE
+        common.PROCFSBASE = self._tmpdir
+        for name in ("1", "42", str(os.getpid()), "self", "thread-self",
+                     "sys"):
+            os.mkdir(os.path.join(self._tmpdir, name))
+        self._fddir = os.path.join(self._tmpdir, "1", "fd")
+        os.mkdir(self._fddir)
+        os.symlink("/dev/null", os.path.join(self._fddir, "0"))
+        os.symlink("/tmp/foo (deleted)", os.path.join(self._fddir, "3"))
+
+    def tearDown(self):
+        common.PROCFSBASE = self._orig_procfsbase
+        shutil.rmtree(self._tmpdir)
+
+    def test_iter_pids(self):
+        pids = common.iter_pids()
+        self.assertFalse(isinstance(pids, list))
+        self.assertEqual(sorted(pids), ["1", "42"])
+
+    def test_iter_links(self):
+        self.assertEqual(sorted(common.iter_links(self._fddir)),
+                         ["/dev/null", "/tmp/foo (deleted)"])
+
+    def test_iter_links_vanished(self):
+        """A process that exited has no links, but is no error either"""
+        self.assertEqual(list(common.iter_links(
+            os.path.join(self._tmpdir, "42", "fd"))), [])
+
+    def test_iter_links_unreadable(self):
+        with self.assertRaises(OSError):
+            list(common.iter_links(os.path.join(self._fddir, "0")))
+
+
+class TestGrouping(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.mkdtemp()
+        self._orig_procfsbase = common.PROCFSBASE
+        common.PROCFSBASE = self._tmpdir
+
+    def tearDown(self):
+        common.PROCFSBASE = self._orig_procfsbase
+        shutil.rmtree(self._tmpdir)
+
+    def _proc(self, pid, cgroup=None, exe=None):
+        os.mkdir(os.path.join(self._tmpdir, pid))
+        if cgroup is not None:
+            with open(os.path.join(self._tmpdir, pid, "cgroup"), "w") as fd:
+                fd.write(cgroup)
+        if exe is not None:
+            os.symlink(exe, os.path.join(self._tmpdir, pid, "exe"))
+
+    def test_unit_v2(self):
+        self._proc("1", "0::/system.slice/nginx.service\n")
+        self.assertEqual(common.get_unit("1"), "nginx.service")
+
+    def test_unit_v1(self):
+        self._proc("1", "2:cpu:/\n"
+                   "1:name=systemd:/user.slice/user-1000.slice/"
+                   "session-2.scope\n")
+        self.assertEqual(common.get_unit("1"), "session-2.scope")
+
+    def test_unit_nested(self):
+        """Cgroups below a unit belong to that unit"""
+        self._proc("1", "0::/system.slice/docker-1234.scope/init.scope\n"
+                   "0::/system.slice/foo.service/worker\n")
+        self.assertEqual(common.get_unit("1"), "init.scope")
+        self._proc("2", "0::/system.slice/foo.service/worker\n")
+        self.assertEqual(common.get_unit("2"), "foo.service")
+
+    def test_no_unit(self):
+        self._proc("1", "0::/\n")
+        self.assertEqual(common.get_unit("1"), None)
+        self.assertEqual(common.get_unit("2"), None)
+
+    def test_group_by_exe(self):
+        self._proc("1", exe="/usr/bin/postgres")
+        self._proc("2", exe="/usr/bin/postgres")
+        self._proc("3", exe="/usr/bin/nginx")
+        grouper = common.Grouper("exe")
+        self.assertEqual(grouper.key("1"), "/usr/bin/postgres")
+        self.assertEqual(grouper.key("2"), "/usr/bin/postgres")
+        self.assertEqual(grouper.key("3"), "/usr/bin/nginx")
+        self.assertEqual(grouper.key("4"), None)
+
+    def test_group_by_exe_collision(self):
+        """Different executables with the same path are kept apart"""
+        exe1 = os.path.join(self._tmpdir, "exe1")
+        exe2 = os.path.join(self._tmpdir, "exe2")
+        for exe in (exe1, exe2):
+            with open(exe, "w") as fd:
+                fd.write(exe)
+        self._proc("1", exe=exe1)
+        self._proc("2", exe=exe2)
+        grouper = common.Grouper("exe")
+        grouper._exes[exe2] = [(0, 0)]
+        stat = os.stat(exe2)
+        self.assertEqual(grouper.key("1"), exe1)
+        self.assertEqual(grouper.key("2"), "%s (device %d, inode %d)" %
+                         (exe2, stat.st_dev, stat.st_ino))
+
+    def test_group_by_unit(self):
+        """Processes without a unit are grouped by executable"""
+        self._proc("1", "0::/system.slice/nginx.service\n", "/bin/sh")
+        self._proc("2", "0::/\n", "/bin/sh")
+        grouper = common.Grouper("unit")
+        self.assertEqual(grouper.key("1"), "nginx.service")
+        self.assertEqual(grouper.key("2"), "/bin/sh")
+
+
 class TestFormatting(unittest.TestCase):
     # Input for these is { argv: ({pid, pid, ...}, {file, file, ...}), argv:
     # ... }
@@ -154,6 +281,10 @@ class Testsystemdintegration(unittest.TestCase):
         self.query = {"/usr/bin/foo": (("1", "2", "3"), ("libbar", "libbaz"))}
         self.golden = "1,2,3 belong to service.shmervice"
         self._orig_query_systemctl = self._comm.query_systemctl
+        self._orig_get_units = self._comm.systemdbus.get_units
+        # No bus, unless a test sets one up
+        self._comm.systemdbus.get_units = MagicMock(
+            side_effect=OSError("No bus"))
         self._orig_Popen = self._comm.subprocess.Popen
         self._orig_stderr = self._comm.sys.stderr
         self._orig_stdout = self._comm.sys.stderr
@@ -164,6 +295,7 @@ class Testsystemdintegration(unittest.TestCase):
     def tearDown(self):
         """Restore mocked out functions"""
         self._comm.query_systemctl = self._orig_query_systemctl
+        self._comm.systemdbus.get_units = self._orig_get_units
         self._comm.subprocess.Popen = self._orig_Popen
         self._comm.sys.stderr = self._orig_stderr
         self._comm.sys.stdout = self._orig_stdout
@@ -207,6 +339,29 @@ class Testsystemdintegration(unittest.TestCase):
         self._comm.query_systemctl = self._mock_query_systemctl
         self.assertEqual(common.get_services(self.query), self.golden)
 
+    def test_get_services_over_bus(self):
+        """With a working bus, systemctl is not needed"""
+        self._comm.systemdbus.get_units = MagicMock(
+            return_value={"1": "foo.service", "3": "foo.service"})
+        self._comm.query_systemctl = self._mock_query_systemctl_broken
+        self.assertEqual(common.get_services(self.query),
+                         "1,3 belong to foo.service")
+        self._comm.systemdbus.get_units.assert_called_once_with(
+            ["1", "2", "3"])
+
+    def test_get_services_reused_pid(self):
+        """Processes that exited before the answer came are left out"""
+        self._comm.systemdbus.get_units = MagicMock(
+            return_value={"1": "foo.service", "3": "foo.service"})
+        orig_get_starttime = self._comm.get_starttime
+        self._comm.get_starttime = {"1": "10", "3": "31"}.get
+        try:
+            self.assertEqual(
+                common.get_services(self.query, {"1": "10", "3": "30"}),
+                "1 belong to foo.service")
+        finally:
+            self._comm.get_starttime = orig_get_starttime
+
     def test_get_services_with_broken_systemctl(self):
         """Test get_services with broken systctl"""
         self._comm.query_systemctl = self._mock_query_systemctl_broken
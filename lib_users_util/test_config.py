@@ -0,0 +1,117 @@
+# -*- coding: utf8 -*-
+"""
+Test suite for config
+
+To be run through nose2, not executed directly.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+
+from lib_users_util import config
+
+MagicMock = unittest.mock.MagicMock
+
+TESTCONFIG = """\
+[global]
+ignore_literal = /var/lib/foo/cache.db
+
+[/usr/bin/python2.7]
+ignore_pattern = /tmp/orcexec.*
+    /run/user/*/orcexec*
+"""
+
+
+class TestLoadConfig(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.mkdtemp()
+        self._filename = os.path.join(self._tmpdir, "lib_users.conf")
+
+    def tearDown(self):
+        shutil.rmtree(self._tmpdir)
+
+    def _write(self, content):
+        with open(self._filename, "w") as fd:
+            fd.write(content)
+
+    def test_load(self):
+        self._write(TESTCONFIG)
+        globalrules, exerules = config.load_config(self._filename)
+        self.assertEqual(globalrules.patterns, [])
+        self.assertEqual(globalrules.literals,
+                         set(["/var/lib/foo/cache.db"]))
+        self.assertEqual(list(exerules), ["/usr/bin/python2.7"])
+        self.assertEqual(exerules["/usr/bin/python2.7"].patterns,
+                         ["/tmp/orcexec.*", "/run/user/*/orcexec*"])
+
+    def test_missing_default(self):
+        """A missing default config file is not an error"""
+        orig_configfile = config.CONFIGFILE
+        config.CONFIGFILE = self._filename
+        try:
+            globalrules, exerules = config.load_config()
+        finally:
+            config.CONFIGFILE = orig_configfile
+        self.assertEqual(globalrules.match("/some/file"), None)
+        self.assertEqual(exerules, {})
+
+    def test_missing_explicit(self):
+        """A missing config file given by the user is an error"""
+        with self.assertRaises(config.ConfigError):
+            config.load_config(self._filename)
+
+    def test_bad_section(self):
+        self._write("[python2.7]\nignore_literal = /foo\n")
+        with self.assertRaises(config.ConfigError):
+            config.load_config(self._filename)
+
+    def test_syntax_error(self):
+        self._write("ignore_literal = /foo\n")
+        with self.assertRaises(config.ConfigError):
+            config.load_config(self._filename)
+
+
+class TestFilterForPid(unittest.TestCase):
+
+    def setUp(self):
+        self._orig_get_exe = config.common.get_exe
+        config.common.get_exe = MagicMock(return_value="/usr/bin/python2.7")
+        self._exerules = {
+            "/usr/bin/python2.7": config.Rules(["/tmp/orcexec.*"])}
+
+    def tearDown(self):
+        config.common.get_exe = self._orig_get_exe
+
+    def test_matching_exe(self):
+        res = config.filter_for_pid(
+            "1", set(["/tmp/orcexec.sqa9cE", "/lib64/libc.so.6"]),
+            self._exerules)
+        self.assertEqual(res, set(["/lib64/libc.so.6"]))
+        config.common.get_exe.assert_called_once_with("1")
+
+    def test_other_exe(self):
+        config.common.get_exe.return_value = "/usr/bin/perl"
+        files = set(["/tmp/orcexec.sqa9cE"])
+        self.assertEqual(
+            config.filter_for_pid("1", files, self._exerules), files)
+
+    def test_no_rules(self):
+        """Without per-executable rules, the exe is not looked up"""
+        files = set(["/tmp/orcexec.sqa9cE"])
+        self.assertEqual(config.filter_for_pid("1", files, {}), files)
+        self.assertFalse(config.common.get_exe.called)
+
+    def test_observer(self):
+        """Ignored files are reported with the rule that matched"""
+        observer = MagicMock()
+        config.observe.register(observer)
+        try:
+            config.filter_for_pid("1", set(["/tmp/orcexec.sqa9cE"]),
+                                  self._exerules)
+        finally:
+            config.observe.unregister()
+        observer.ignored.assert_called_once_with("/tmp/orcexec.sqa9cE",
+                                                 "/tmp/orcexec.*")
@@ -0,0 +1,235 @@
+# -*- coding: utf8 -*-
+"""
+Test suite for daemon
+
+To be run through nose2, not executed directly.
+"""
+import errno
+import os
+import resource
+import unittest
+import unittest.mock
+
+from lib_users_util import daemon
+
+MagicMock = unittest.mock.MagicMock
+
+
+class TestProcTable(unittest.TestCase):
+
+    def setUp(self):
+        self._results = {"1": ("argv1", set(["l1"])),
+                         "2": ("argv2", set(["l2"])),
+                         "3": None}
+        self._caches = []
+        self._orig_get_pids = daemon.common.get_pids
+        daemon.common.get_pids = MagicMock(return_value=["1", "2", "3", "4"])
+        self._table = daemon.ProcTable(self._scan_pid)
+
+    def tearDown(self):
+        daemon.common.get_pids = self._orig_get_pids
+
+    def _scan_pid(self, pid, cache):
+        self._caches.append(cache)
+        if pid not in self._results:
+            raise IOError("No such file or directory")
+        return self._results[pid]
+
+    def test_full_scan(self):
+        appeared, disappeared = self._table.full_scan()
+        self.assertEqual(dict(appeared),
+                         {"argv1": (set(["1"]), set(["l1"])),
+                          "argv2": (set(["2"]), set(["l2"]))})
+        self.assertEqual(dict(disappeared), {})
+        self.assertEqual(sorted(self._table.procs), ["1", "2"])
+        # All PIDs of one scan share the cache
+        self.assertEqual(len(set(id(cache) for cache in self._caches)), 1)
+
+    def test_steady_state(self):
+        self._table.full_scan()
+        appeared, disappeared = self._table.full_scan()
+        self.assertEqual(dict(appeared), {})
+        self.assertEqual(dict(disappeared), {})
+
+    def test_rescan(self):
+        """Only the given PIDs are scanned again"""
+        self._table.full_scan()
+        self._results["1"] = None
+        self._results["3"] = ("argv3", set(["l3"]))
+        self._caches = []
+        appeared, disappeared = self._table.rescan(["1", "3"])
+        self.assertEqual(len(self._caches), 2)
+        self.assertEqual(dict(appeared), {"argv3": (set(["3"]), set(["l3"]))})
+        self.assertEqual(dict(disappeared),
+                         {"argv1": (set(["1"]), set(["l1"]))})
+        self.assertEqual(sorted(self._table.procs), ["2", "3"])
+
+    def test_drop(self):
+        self._table.full_scan()
+        appeared, disappeared = self._table.drop(["2", "5"])
+        self.assertEqual(dict(appeared), {})
+        self.assertEqual(dict(disappeared),
+                         {"argv2": (set(["2"]), set(["l2"]))})
+        self.assertEqual(sorted(self._table.procs), ["1"])
+
+
+class _Pin(object):
+    """A stand-in for pidfd.Pin"""
+
+    def __init__(self, pid, alive=True):
+        self.pid = pid
+        self.closed = False
+        self._alive = alive
+
+    def alive(self):
+        return self._alive
+
+    def close(self):
+        self.closed = True
+
+
+class _Watcher(object):
+    """A stand-in for pidfd.ExitWatcher"""
+
+    def __init__(self, max_pins=None):
+        self.pins = {}
+        self.max_pins = max_pins
+
+    def add(self, pin):
+        if self.max_pins is not None and len(self.pins) >= self.max_pins:
+            return False
+        self.pins[pin.pid] = pin
+        return True
+
+    def discard(self, pid):
+        self.pins.pop(pid, None)
+
+
+class TestProcTablePinned(unittest.TestCase):
+
+    def setUp(self):
+        self._results = {"1": ("argv1", set(["l1"])),
+                         "2": ("argv2", set(["l2"])),
+                         "3": None}
+        self._pins = {}
+        self._dead = set()
+        self._orig_get_pids = daemon.common.get_pids
+        self._orig_pin = daemon.pidfd.pin
+        daemon.common.get_pids = MagicMock(return_value=["1", "2", "3", "4"])
+        daemon.pidfd.pin = self._pin
+        self._watcher = _Watcher()
+        self._table = daemon.ProcTable(self._scan_pid, self._watcher)
+
+    def tearDown(self):
+        daemon.common.get_pids = self._orig_get_pids
+        daemon.pidfd.pin = self._orig_pin
+
+    def _pin(self, pid):
+        if pid == "4":
+            raise OSError("No such process")
+        self._pins[pid] = _Pin(pid)
+        return self._pins[pid]
+
+    def _scan_pid(self, pid, _):
+        if pid in self._dead:
+            # The process exits while it is scanned
+            self._pins[pid]._alive = False
+        return self._results[pid]
+
+    def test_full_scan(self):
+        self._table.full_scan()
+        self.assertEqual(sorted(self._watcher.pins), ["1", "2"])
+        self.assertTrue(self._pins["3"].closed)
+        self.assertFalse(self._pins["1"].closed)
+
+    def test_watcher_full(self):
+        """Processes that don't fit into the watcher are not pinned"""
+        self._watcher.max_pins = 1
+        appeared, _ = self._table.full_scan()
+        self.assertEqual(sorted(appeared), ["argv1", "argv2"])
+        self.assertEqual(sorted(self._watcher.pins), ["1"])
+        self.assertTrue(self._pins["2"].closed)
+
+    def test_out_of_fds(self):
+        """Running out of file descriptors is not a read failure"""
+        def scan_pid(pid, _):
+            raise OSError(errno.EMFILE, "Too many open files")
+        self._table = daemon.ProcTable(scan_pid, self._watcher)
+        with self.assertRaises(OSError):
+            self._table.full_scan()
+        self.assertTrue(self._pins["1"].closed)
+
+    def test_exited_while_scanned(self):
+        """What we read may be from a process that reused the PID"""
+        self._dead.add("2")
+        appeared, _ = self._table.full_scan()
+        self.assertEqual(list(appeared), ["argv1"])
+        self.assertEqual(sorted(self._watcher.pins), ["1"])
+        self.assertTrue(self._pins["2"].closed)
+
+    def test_unwatch(self):
+        self._table.full_scan()
+        self._results["1"] = None
+        self._table.full_scan()
+        self.assertEqual(sorted(self._watcher.pins), ["2"])
+        self._table.drop(["2"])
+        self.assertEqual(self._watcher.pins, {})
+
+
+class _Stop(Exception):
+    """Raised to leave daemon.run()"""
+
+
+class TestRun(unittest.TestCase):
+
+    def setUp(self):
+        self._calls = []
+        self._orig_procconnector = daemon.procconn.ProcConnector
+        daemon.procconn.ProcConnector = \
+            lambda: self._calls.append("subscribe")
+
+    def tearDown(self):
+        daemon.procconn.ProcConnector = self._orig_procconnector
+
+    def _full_scan(self):
+        self._calls.append("scan")
+        return {}, {}
+
+    def _report(self, *_):
+        raise _Stop()
+
+    def test_subscribe_first(self):
+        """Processes started during the first scan are not missed"""
+        table = MagicMock()
+        table.full_scan = self._full_scan
+        with self.assertRaises(_Stop):
+            daemon.run(table, MagicMock(), self._report)
+        self.assertEqual(self._calls, ["subscribe", "scan"])
+
+    def test_high_fd(self):
+        """Descriptors above FD_SETSIZE (1024) can be waited on"""
+        if resource.getrlimit(resource.RLIMIT_NOFILE)[0] <= 2000:
+            self.skipTest("RLIMIT_NOFILE too low")
+        readfd, writefd = os.pipe()
+        os.dup2(readfd, 2000)
+        os.close(readfd)
+        self.addCleanup(os.close, 2000)
+        self.addCleanup(os.close, writefd)
+        # The watcher signals an exit
+        os.write(writefd, b"x")
+        table = MagicMock()
+        table.full_scan.return_value = ({}, {})
+        table.watcher.fileno.return_value = 2000
+        table.watcher.exited.return_value = ["5"]
+        table.drop.return_value = ({}, {"5": None})
+        reports = []
+
+        def report(appeared, disappeared):
+            reports.append(disappeared)
+            if disappeared:
+                raise _Stop()
+        with self.assertRaises(_Stop):
+            daemon.run(table, MagicMock(full_scan_interval=60.0,
+                                        rescan_delay=1.0), report)
+        self.assertEqual(reports, [{}, {"5": None}])
+        table.drop.assert_called_once_with(["5"])
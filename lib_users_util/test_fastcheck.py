@@ -0,0 +1,78 @@
+# -*- coding: utf8 -*-
+"""
+Test suite for fastcheck
+
+To be run through nose2, not executed directly.
+"""
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from lib_users_util import common
+from lib_users_util import fastcheck
+from lib_users_util import procmap
+
+
+def _auxv(*entries):
+    return b"".join(struct.pack("@LL", key, value)
+                    for key, value in entries + ((fastcheck.AT_NULL, 0),))
+
+
+class TestFastCheck(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.mkdtemp()
+        self._orig_procfsbase = common.PROCFSBASE
+        common.PROCFSBASE = self._tmpdir
+        for pid, exe in (("1", "/usr/sbin/foo (deleted)"),
+                         ("2", "/usr/sbin/bar")):
+            os.mkdir(os.path.join(self._tmpdir, pid))
+            os.symlink(exe, os.path.join(self._tmpdir, pid, "exe"))
+            # A static binary
+            with open(os.path.join(self._tmpdir, pid, "auxv"), "wb") as fd:
+                fd.write(_auxv((6, 4096)))
+        # A kernel thread
+        os.mkdir(os.path.join(self._tmpdir, "3"))
+
+    def tearDown(self):
+        common.PROCFSBASE = self._orig_procfsbase
+        shutil.rmtree(self._tmpdir)
+
+    def test_deleted_exe(self):
+        self.assertEqual(fastcheck.get_deleted_exe("1"), "/usr/sbin/foo")
+        self.assertEqual(fastcheck.check("1"), set(["/usr/sbin/foo"]))
+
+    def test_current_exe(self):
+        self.assertEqual(fastcheck.get_deleted_exe("2"), None)
+        self.assertEqual(fastcheck.check("2"), set())
+
+    def test_no_exe(self):
+        self.assertEqual(fastcheck.get_deleted_exe("3"), None)
+        self.assertEqual(fastcheck.check("3"), set())
+        self.assertEqual(fastcheck.check("4"), set())
+
+    def test_interp_base(self):
+        self.assertEqual(fastcheck.get_interp_base(
+            _auxv((6, 4096), (fastcheck.AT_BASE, 0x7f0000000000))),
+            0x7f0000000000)
+        self.assertEqual(fastcheck.get_interp_base(_auxv((6, 4096))), 0)
+        self.assertEqual(fastcheck.get_interp_base(b""), 0)
+
+    def test_static(self):
+        self.assertEqual(fastcheck.get_interp("1"), None)
+
+
+class TestOwnInterp(unittest.TestCase):
+
+    def test_own_interp(self):
+        """Our own interpreter is the dynamic loader, and not deleted"""
+        with open("/proc/self/maps") as fd:
+            try:
+                list(procmap.file_vmas(fd))
+            except procmap.Unsupported:
+                self.skipTest("PROCMAP_QUERY is not supported")
+        interp = fastcheck.get_interp(str(os.getpid()))
+        self.assertIn("ld", os.path.basename(interp))
+        self.assertFalse(interp.endswith("(deleted)"))
@@ -0,0 +1,131 @@
+# -*- coding: utf8 -*-
+"""
+Test suite for mapindex
+
+To be run through nose2, not executed directly.
+"""
+import errno
+import os
+import shutil
+import tempfile
+import unittest
+
+from lib_users_util import mapindex
+
+PATHS = {"1": set(["/lib64/libc.so.6", "/lib64/libssl.so.3"]),
+         "2": set(["/lib64/libc.so.6"]),
+         "3": set(["/lib64/libc.so.6"])}
+KEYS = {"1": "nginx", "2": "nginx", "3": None}
+STARTTIMES = {"1": "100", "2": "200", "3": "300", "4": "400"}
+
+
+def _get_paths(pid):
+    if pid not in PATHS:
+        raise IOError("No such file or directory")
+    return PATHS[pid]
+
+
+class TestMapIndex(unittest.TestCase):
+
+    def setUp(self):
+        self._starttimes = dict(STARTTIMES)
+        self._orig_get_starttime = mapindex.common.get_starttime
+        self._orig_get_boot_id = mapindex.common.get_boot_id
+        mapindex.common.get_starttime = self._starttimes.get
+        mapindex.common.get_boot_id = lambda: "b1"
+        self._index, self._failed = mapindex.build(
+            ["1", "2", "3", "4", "5"], _get_paths, KEYS.get)
+
+    def tearDown(self):
+        mapindex.common.get_starttime = self._orig_get_starttime
+        mapindex.common.get_boot_id = self._orig_get_boot_id
+
+    def _save_load(self):
+        """Save the index and load it again"""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "index")
+            self._index.save(filename)
+            return mapindex.MapIndex.load(filename)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_build(self):
+        self.assertTrue(self._failed)
+        self.assertEqual(sorted(self._index.keys), ["1", "2"])
+        self.assertEqual(self._index.starttimes, {"1": "100", "2": "200"})
+        # Paths are shared, not copied per process
+        paths = [path for path in self._index.pids
+                 if path == "/lib64/libc.so.6"]
+        self.assertIs(paths[0], mapindex.sys.intern("/lib64/libc.so.6"))
+
+    def test_query_path(self):
+        self.assertEqual(dict(self._index.query(["/lib64/libssl.so.3"])),
+                         {"nginx": (set(["1"]), set(["/lib64/libssl.so.3"]))})
+
+    def test_query_glob(self):
+        self.assertEqual(
+            dict(self._index.query(["/lib64/lib*"])),
+            {"nginx": (set(["1", "2"]), set(["/lib64/libc.so.6",
+                                             "/lib64/libssl.so.3"]))})
+
+    def test_query_nomatch(self):
+        self.assertEqual(dict(self._index.query(["/lib64/libfoo.so",
+                                                 "/usr/*"])), {})
+
+    def test_build_vanished(self):
+        def get_paths(pid):
+            raise IOError(errno.ENOENT, "No such file or directory")
+        _, failed = mapindex.build(["1"], get_paths, KEYS.get)
+        self.assertFalse(failed)
+
+    def test_query_symlink(self):
+        tmpdir = os.path.realpath(tempfile.mkdtemp())
+        try:
+            libdir = os.path.join(tmpdir, "usr", "lib")
+            os.makedirs(libdir)
+            os.symlink("usr/lib", os.path.join(tmpdir, "lib"))
+            libc = os.path.join(libdir, "libc.so.6")
+            self._index.add("6", "600", "sshd", [libc])
+            expected = {"sshd": (set(["6"]), set([libc]))}
+            # Merged /usr: the file is mapped via usr/lib but asked for
+            # via lib
+            self.assertEqual(dict(self._index.query(
+                [os.path.join(tmpdir, "lib", "libc.so.6")])), expected)
+            self.assertEqual(dict(self._index.query(
+                [os.path.join(tmpdir, "lib", "libc*")])), expected)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_save_load(self):
+        loaded = self._save_load()
+        self.assertEqual(loaded.boot_id, self._index.boot_id)
+        self.assertEqual(loaded.keys, self._index.keys)
+        self.assertEqual(loaded.starttimes, self._index.starttimes)
+        self.assertEqual(dict(loaded.pids), dict(self._index.pids))
+
+    def test_load_reused_pid(self):
+        """Processes that exited are dropped, even if their PID was reused"""
+        self._starttimes["1"] = "500"
+        del self._starttimes["2"]
+        loaded = self._save_load()
+        self.assertEqual(loaded.keys, {})
+        self.assertEqual(dict(loaded.query(["/lib64/*"])), {})
+
+    def test_load_rebooted(self):
+        """After a reboot, start times say nothing"""
+        mapindex.common.get_boot_id = lambda: "b2"
+        loaded = self._save_load()
+        self.assertEqual(loaded.boot_id, "b1")
+        self.assertEqual(loaded.keys, {})
+
+    def test_load_garbage(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "index")
+            with open(filename, "w") as fd:
+                fd.write("[]")
+            with self.assertRaises(ValueError):
+                mapindex.MapIndex.load(filename)
+        finally:
+            shutil.rmtree(tmpdir)
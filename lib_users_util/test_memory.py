@@ -0,0 +1,85 @@
+# -*- coding: utf8 -*-
+"""
+Test suite for memory
+
+To be run through nose2, not executed directly.
+"""
+import io
+import unittest
+
+from lib_users_util import memory
+
+SMAPS = """\
+7f02a85f1000-7f02a85f2000 r-xp 00000000 09:01 32642 /lib64/libfoo.so (deleted)
+Size:                  4 kB
+Rss:                   4 kB
+Pss:                   2 kB
+VmFlags: rd ex mr mw me
+7f02a85f2000-7f02a85f4000 rw-p 00001000 09:01 32642 /lib64/libfoo.so (deleted)
+Size:                  8 kB
+Rss:                   8 kB
+Pss:                   8 kB
+AnonHugePages:         0 kB
+7f02a85f4000-7f02a85f5000 r-xp 00000000 09:01 32643 /lib64/libbar.so
+Rss:                 100 kB
+Pss:                 100 kB
+7f02a85f5000-7f02a85f6000 r-xp 00000000 09:01 32644 /lib64/libbaz.so (deleted)
+Rss:                  16 kB
+Pss:                   1 kB
+7ffd3a1b2000-7ffd3a1d3000 rw-p 00000000 00:00 0                  [stack]
+Rss:                  12 kB
+Pss:                  12 kB
+"""
+
+
+class _options(object):
+    """Mock options object that mimicks the bare necessities"""
+
+    def __init__(self):
+        self.machine_readable = False
+
+
+class TestGetDeletedMemory(unittest.TestCase):
+
+    def test_deleted(self):
+        res = memory.get_deleted_memory(
+            io.StringIO(SMAPS), set(["/lib64/libfoo.so", "/lib64/libbaz.so"]))
+        self.assertEqual(res, {"/lib64/libfoo.so": [12, 10],
+                               "/lib64/libbaz.so": [16, 1]})
+
+    def test_replaced(self):
+        """Replaced libs are not marked as deleted in smaps"""
+        res = memory.get_deleted_memory(
+            io.StringIO(SMAPS), set(["/lib64/libbar.so"]))
+        self.assertEqual(res, {"/lib64/libbar.so": [100, 100]})
+
+    def test_nothing(self):
+        self.assertEqual(memory.get_deleted_memory(io.StringIO(SMAPS), set()),
+                         {})
+
+
+class TestFmtMemory(unittest.TestCase):
+
+    def setUp(self):
+        self._procs = {"1": ("argv1 ", set(["l1", "l2"])),
+                       "2": ("argv2", set(["l1"]))}
+        self._usage = {"1": {"l1": [10, 5], "l2": [4, 4]},
+                       "2": {"l1": [10, 5]}}
+
+    def test_human(self):
+        self.assertEqual(
+            memory.fmt_memory(self._procs, self._usage, _options()),
+            "Memory held by deleted mappings (Rss/Pss in kB):\n"
+            '1 "argv1" 14/9\n'
+            '2 "argv2" 10/5\n'
+            "l1 20/10\n"
+            "l2 4/4\n"
+            "Total 24/14")
+
+    def test_machine(self):
+        options = _options()
+        options.machine_readable = True
+        self.assertEqual(
+            memory.fmt_memory(self._procs, self._usage, options),
+            "#pid;1;14;9\n#pid;2;10;5\n#lib;l1;20;10\n#lib;l2;4;4\n"
+            "#total;24;14")
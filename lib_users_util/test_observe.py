@@ -0,0 +1,74 @@
+# -*- coding: utf8 -*-
+"""
+Test suite for observe
+
+To be run through nose2, not executed directly.
+"""
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from lib_users_util import observe
+
+
+class TestRegister(unittest.TestCase):
+
+    def tearDown(self):
+        observe.unregister()
+
+    def test_register(self):
+        observer = observe.Observer()
+        observe.register(observer)
+        self.assertIs(observe.OBSERVER, observer)
+        observe.unregister()
+        self.assertIs(observe.OBSERVER, None)
+
+    def test_noop(self):
+        """The base class accepts all events"""
+        observer = observe.Observer()
+        observer.pid_start("1")
+        observer.file_read("/proc/1/maps", 100)
+        observer.ignored("/dev/zero", "/dev/zero")
+        observer.permission_denied("/proc/1/maps", OSError(13, "Denied"))
+        observer.pid_end("1", 0)
+        observer.format_start("human")
+        observer.format_end("human")
+
+
+class TestChromeTrace(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.mkdtemp()
+        self._filename = os.path.join(self._tmpdir, "trace.json")
+
+    def tearDown(self):
+        shutil.rmtree(self._tmpdir)
+
+    def test_trace(self):
+        tracer = observe.ChromeTrace(self._filename)
+        tracer.pid_start("1")
+        tracer.file_read("/proc/1/maps", 100)
+        tracer.file_read("/proc/1/maps", 50)
+        tracer.ignored("/dev/zero", "/dev/zero")
+        tracer.pid_end("1", 2)
+        tracer.permission_denied("/proc/2/maps", OSError(13, "Denied"))
+        tracer.format_start("human")
+        tracer.format_end("human")
+        tracer.close()
+        # Only written once
+        tracer.close()
+
+        with open(self._filename) as fd:
+            events = json.load(fd)["traceEvents"]
+        self.assertEqual([(event["ph"], event["name"]) for event in events],
+                         [("B", "scan 1"), ("i", "read"), ("C", "bytes read"),
+                          ("i", "read"), ("C", "bytes read"),
+                          ("i", "ignored"), ("E", "scan 1"),
+                          ("i", "permission denied"), ("B", "format human"),
+                          ("E", "format human")])
+        self.assertEqual(events[4]["args"], {"bytes": 150})
+        self.assertEqual(events[6]["args"], {"found": 2})
+        timestamps = [event["ts"] for event in events]
+        self.assertEqual(timestamps, sorted(timestamps))
@@ -0,0 +1,74 @@
+# -*- coding: utf8 -*-
+"""
+Test suite for pacing
+
+To be run through nose2, not executed directly.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+
+from lib_users_util import pacing
+
+MagicMock = unittest.mock.MagicMock
+
+
+class TestInterleave(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.mkdtemp()
+        for pid, comm in (("1", "postgres"), ("2", "postgres"),
+                          ("3", "postgres"), ("4", "nginx"), ("5", "sshd"),
+                          ("6", "nginx")):
+            os.mkdir(os.path.join(self._tmpdir, pid))
+            with open(os.path.join(self._tmpdir, pid, "comm"), "w") as fd:
+                fd.write("%s\n" % comm)
+
+    def tearDown(self):
+        shutil.rmtree(self._tmpdir)
+
+    def _maps(self, *pids):
+        return [os.path.join(self._tmpdir, pid, "maps") for pid in pids]
+
+    def test_interleave(self):
+        """Workers of the same program are spread out"""
+        res = pacing.interleave(self._maps("1", "2", "3", "4", "5", "6"))
+        self.assertEqual(res, self._maps("1", "4", "5", "2", "6", "3"))
+
+    def test_vanished(self):
+        """Processes that are gone don't break the ordering"""
+        res = pacing.interleave(self._maps("1", "7", "2"))
+        self.assertEqual(res, self._maps("1", "7", "2"))
+
+    def test_empty(self):
+        self.assertEqual(pacing.interleave([]), [])
+
+
+class TestPacer(unittest.TestCase):
+
+    def setUp(self):
+        self._orig_sleep = pacing.time.sleep
+        pacing.time.sleep = MagicMock()
+
+    def tearDown(self):
+        pacing.time.sleep = self._orig_sleep
+
+    def test_window(self):
+        """Reads are spread evenly over the window"""
+        pacer = pacing.Pacer(10, window=5.0, backoff=2.0)
+        pacer.pace(0.1)
+        pacing.time.sleep.assert_called_once_with(0.4)
+
+    def test_backoff(self):
+        """Slow reads make the pacer back off further"""
+        pacer = pacing.Pacer(10, window=5.0, backoff=2.0)
+        pacer.pace(1.0)
+        pacing.time.sleep.assert_called_once_with(2.0)
+
+    def test_yield(self):
+        """Without time to spare, the pacer does not sleep"""
+        pacer = pacing.Pacer(10, window=0.0, backoff=0.0)
+        pacer.pace(0.1)
+        self.assertFalse(pacing.time.sleep.called)
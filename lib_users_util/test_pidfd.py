@@ -0,0 +1,105 @@
+# -*- coding: utf8 -*-
+"""
+Test suite for pidfd
+
+To be run through nose2, not executed directly.
+"""
+import os
+import subprocess
+import sys
+import unittest
+
+from lib_users_util import pidfd
+
+
+def _start():
+    """Start a process that waits until it is told to exit"""
+    return subprocess.Popen([sys.executable, "-c", "input()"],
+                            stdin=subprocess.PIPE)
+
+
+def _stop(proc):
+    """Let a process from _start() exit, without reaping it"""
+    proc.stdin.close()
+    # A zombie has exited as far as the pidfd is concerned
+    os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)
+
+
+@unittest.skipUnless(pidfd.SUPPORTED, "pidfds are not supported")
+class TestPin(unittest.TestCase):
+
+    def setUp(self):
+        self._proc = _start()
+
+    def tearDown(self):
+        self._proc.stdin.close()
+        self._proc.wait()
+
+    def test_alive(self):
+        pin = pidfd.pin(str(self._proc.pid))
+        self.assertTrue(pin.alive())
+        _stop(self._proc)
+        self.assertFalse(pin.alive())
+        pin.close()
+
+    def test_no_such_process(self):
+        self._proc.stdin.close()
+        self._proc.wait()
+        with self.assertRaises(OSError):
+            pidfd.pin(str(self._proc.pid))
+
+
+@unittest.skipUnless(pidfd.SUPPORTED, "pidfds are not supported")
+class TestExitWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self._procs = [_start(), _start()]
+        self._pids = [str(proc.pid) for proc in self._procs]
+        self._watcher = pidfd.ExitWatcher()
+
+    def tearDown(self):
+        self._watcher.close()
+        for proc in self._procs:
+            proc.stdin.close()
+            proc.wait()
+
+    def test_exited(self):
+        for pid in self._pids:
+            self._watcher.add(pidfd.pin(pid))
+        self.assertEqual(self._watcher.exited(), [])
+        _stop(self._procs[0])
+        self.assertEqual(self._watcher.exited(), [self._pids[0]])
+        self.assertNotIn(self._pids[0], self._watcher)
+        self.assertIn(self._pids[1], self._watcher)
+        # Only reported once
+        self.assertEqual(self._watcher.exited(), [])
+
+    def test_full(self):
+        watcher = pidfd.ExitWatcher(max_pins=1)
+        try:
+            self.assertTrue(watcher.add(pidfd.pin(self._pids[0])))
+            pin = pidfd.pin(self._pids[1])
+            self.assertFalse(watcher.add(pin))
+            self.assertNotIn(self._pids[1], watcher)
+            pin.close()
+            # Replacing a watched Pin does not need more room
+            self.assertTrue(watcher.add(pidfd.pin(self._pids[0])))
+        finally:
+            watcher.close()
+
+    def test_default_size(self):
+        limit = pidfd.resource.getrlimit(pidfd.resource.RLIMIT_NOFILE)[0]
+        if limit == pidfd.resource.RLIM_INFINITY:
+            self.assertEqual(self._watcher.max_pins, None)
+        else:
+            self.assertEqual(self._watcher.max_pins,
+                             max(limit - pidfd.RESERVED_FDS, 0))
+
+    def test_discard(self):
+        pin = pidfd.pin(self._pids[0])
+        self._watcher.add(pin)
+        self._watcher.discard(self._pids[0])
+        self.assertNotIn(self._pids[0], self._watcher)
+        self.assertEqual(pin.fd, None)
+        _stop(self._procs[0])
+        self.assertEqual(self._watcher.exited(), [])
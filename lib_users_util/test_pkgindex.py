@@ -0,0 +1,83 @@
+# -*- coding: utf8 -*-
+"""
+Test suite for pkgindex
+
+To be run through nose2, not executed directly.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+
+from lib_users_util import pkgindex
+
+
+class TestPkgIndex(unittest.TestCase):
+    """Build the index from a stand-in dpkg info directory"""
+
+    def setUp(self):
+        self._tmpdir = tempfile.mkdtemp()
+        self._dpkgdir = os.path.join(self._tmpdir, "info")
+        self._indexfile = os.path.join(self._tmpdir, "cache", "pkgindex")
+        os.mkdir(self._dpkgdir)
+        self._write_list("libc6:amd64", ["/.", "/lib", "/lib/libc.so.6"])
+        self._write_list("openssl", ["/usr/lib/libssl.so.3"])
+        with open(os.path.join(self._dpkgdir, "openssl.md5sums"), "w") as fd:
+            fd.write("0123 usr/lib/libssl.so.3\n")
+
+    def tearDown(self):
+        shutil.rmtree(self._tmpdir)
+
+    def _write_list(self, package, files):
+        with open(os.path.join(self._dpkgdir, "%s.list" % package),
+                  "w") as fd:
+            fd.write("".join("%s\n" % name for name in files))
+
+    def test_build(self):
+        index = pkgindex.load_index(self._indexfile, self._dpkgdir)
+        self.assertEqual(index, {"/lib": "libc6:amd64",
+                                 "/lib/libc.so.6": "libc6:amd64",
+                                 "/usr/lib/libssl.so.3": "openssl"})
+        self.assertTrue(os.path.exists(self._indexfile))
+
+    def test_reuse(self):
+        """Unchanged file lists are taken from the index"""
+        pkgindex.load_index(self._indexfile, self._dpkgdir)
+        with unittest.mock.patch("lib_users_util.pkgindex.open",
+                                 side_effect=open, create=True) as mock_open:
+            index = pkgindex.load_index(self._indexfile, self._dpkgdir)
+        self.assertEqual(index["/lib/libc.so.6"], "libc6:amd64")
+        opened = [call[0][0] for call in mock_open.call_args_list]
+        self.assertEqual(opened, [self._indexfile])
+
+    def test_refresh(self):
+        """Changed and removed packages are picked up"""
+        pkgindex.load_index(self._indexfile, self._dpkgdir)
+        self._write_list("openssl", ["/usr/lib/libssl.so.4"])
+        listfile = os.path.join(self._dpkgdir, "openssl.list")
+        os.utime(listfile, ns=(0, 1))
+        os.unlink(os.path.join(self._dpkgdir, "libc6:amd64.list"))
+        index = pkgindex.load_index(self._indexfile, self._dpkgdir)
+        self.assertEqual(index, {"/usr/lib/libssl.so.4": "openssl"})
+
+    def test_unwritable_index(self):
+        """The index is still usable if it can't be saved"""
+        indexfile = os.path.join(self._dpkgdir, "openssl.list", "pkgindex")
+        index = pkgindex.load_index(indexfile, self._dpkgdir)
+        self.assertEqual(index["/usr/lib/libssl.so.3"], "openssl")
+
+    def test_lookup_merged_usr(self):
+        index = pkgindex.load_index(self._indexfile, self._dpkgdir)
+        self.assertEqual(pkgindex.lookup(index, "/usr/lib/libc.so.6"),
+                         "libc6:amd64")
+        self.assertEqual(pkgindex.lookup(index, "/lib/libssl.so.3"),
+                         "openssl")
+        self.assertEqual(pkgindex.lookup(index, "/opt/libfoo.so"), None)
+
+    def test_tag_users(self):
+        index = {"/lib/libc.so.6": "libc6"}
+        inp = {"argv1": (set(["1"]), set(["/lib/libc.so.6", "/opt/x.so"]))}
+        self.assertEqual(dict(pkgindex.tag_users(inp, index)),
+                         {"argv1": (set(["1"]), set(["/lib/libc.so.6 [libc6]",
+                                                     "/opt/x.so"]))})
@@ -0,0 +1,79 @@
+# -*- coding: utf8 -*-
+"""
+Test suite for procarchive
+
+To be run through nose2, not executed directly.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from lib_users_util import common
+from lib_users_util import procarchive
+
+MAPS = ("7f02a85f1000-7f02a85f2000 r-xp 00000000 09:01 32642 "
+        "/lib64/libfoo.so (deleted)\n")
+
+
+class TestCaptureReplay(unittest.TestCase):
+
+    def setUp(self):
+        self._saved = dict((name, getattr(common, name)) for name in
+                           ("PROCFSBASE", "BOOTIDFILE", "SKIPOWNPID"))
+        self._tmpdir = tempfile.mkdtemp()
+        self._proc = os.path.join(self._tmpdir, "proc")
+        piddir = os.path.join(self._proc, "1")
+        os.makedirs(os.path.join(piddir, "fd"))
+        with open(os.path.join(piddir, "maps"), "w") as fd:
+            fd.write(MAPS)
+        with open(os.path.join(piddir, "smaps"), "w") as fd:
+            fd.write(MAPS + "Rss: 4 kB\n")
+        # A process that maps no deleted files
+        os.makedirs(os.path.join(self._proc, "2", "fd"))
+        with open(os.path.join(self._proc, "2", "maps"), "w") as fd:
+            fd.write(MAPS.replace(" (deleted)", ""))
+        with open(os.path.join(self._proc, "2", "smaps"), "w") as fd:
+            fd.write(MAPS.replace(" (deleted)", "") + "Rss: 4 kB\n")
+        with open(os.path.join(piddir, "cmdline"), "w") as fd:
+            fd.write("/usr/sbin/foo\x00-d")
+        os.symlink("/usr/sbin/foo (deleted)", os.path.join(piddir, "exe"))
+        os.symlink("/var/log/foo.log (deleted)",
+                   os.path.join(piddir, "fd", "3"))
+        os.mkdir(os.path.join(self._proc, "self"))
+        bootid = os.path.join(self._tmpdir, "boot_id")
+        with open(bootid, "w") as fd:
+            fd.write("b1\n")
+        common.PROCFSBASE = self._proc
+        common.BOOTIDFILE = bootid
+        self._archive = os.path.join(self._tmpdir, "capture.tgz")
+
+    def tearDown(self):
+        for name, value in self._saved.items():
+            setattr(common, name, value)
+        shutil.rmtree(self._tmpdir)
+
+    def test_roundtrip(self):
+        self.assertEqual(procarchive.capture(self._archive), 2)
+        tmpdir = procarchive.replay(self._archive)
+        self.assertEqual(common.PROCFSBASE, tmpdir)
+        self.assertEqual(sorted(common.get_pids()), ["1", "2"])
+        self.assertEqual(common.get_progargs("1"), "/usr/sbin/foo -d")
+        self.assertEqual(common.get_exe("1"), "/usr/sbin/foo")
+        self.assertEqual(common.get_boot_id(), "b1")
+        with open(os.path.join(tmpdir, "1", "maps")) as fd:
+            self.assertEqual(fd.read(), MAPS)
+        fddir = os.path.join(tmpdir, "1", "fd")
+        self.assertEqual(os.readlink(os.path.join(fddir, "3")),
+                         "/var/log/foo.log (deleted)")
+        # smaps is only captured for processes that map deleted files
+        self.assertTrue(os.path.exists(os.path.join(tmpdir, "1", "smaps")))
+        self.assertFalse(os.path.exists(os.path.join(tmpdir, "2", "smaps")))
+        # An archived process that has our PID is not mistaken for us
+        os.mkdir(os.path.join(tmpdir, str(os.getpid())))
+        self.assertIn(str(os.getpid()), common.get_pids())
+        shutil.rmtree(tmpdir)
+
+    def test_missing_archive(self):
+        with self.assertRaises(IOError):
+            procarchive.replay(self._archive)
@@ -0,0 +1,56 @@
+# -*- coding: utf8 -*-
+"""
+Test suite for procconn
+
+To be run through nose2, not executed directly.
+"""
+import struct
+import unittest
+
+from lib_users_util import procconn
+
+
+def _message(what, *pids, **kwargs):
+    """Build a netlink message as the proc connector sends it"""
+    idx = kwargs.get("idx", procconn.CN_IDX_PROC)
+    event = struct.pack("=IIQ", what, 0, 12345) + \
+        struct.pack("=%dI" % len(pids), *pids)
+    cnmsg = struct.pack("=IIIIHH", idx, procconn.CN_VAL_PROC, 0, 0,
+                        len(event), 0) + event
+    return struct.pack("=IHHII", 16 + len(cnmsg), procconn.NLMSG_DONE, 0, 0,
+                       0) + cnmsg
+
+
+class TestParseEvents(unittest.TestCase):
+
+    def test_fork(self):
+        data = _message(procconn.PROC_EVENT_FORK, 1, 1, 42, 42)
+        self.assertEqual(procconn.parse_events(data), [("fork", "42")])
+
+    def test_thread(self):
+        """New threads are not new processes"""
+        data = _message(procconn.PROC_EVENT_FORK, 1, 1, 43, 42)
+        self.assertEqual(procconn.parse_events(data), [])
+
+    def test_exec(self):
+        data = _message(procconn.PROC_EVENT_EXEC, 43, 42)
+        self.assertEqual(procconn.parse_events(data), [("exec", "42")])
+
+    def test_exit(self):
+        data = _message(procconn.PROC_EVENT_EXIT, 42, 42, 0, 17)
+        self.assertEqual(procconn.parse_events(data), [("exit", "42")])
+        data = _message(procconn.PROC_EVENT_EXIT, 43, 42, 0, 17)
+        self.assertEqual(procconn.parse_events(data), [])
+
+    def test_ignored(self):
+        """Other events, other connectors and short messages are skipped"""
+        data = _message(0, 0, 0, 0, 0)
+        data += _message(procconn.PROC_EVENT_EXEC, 42, 42, idx=2)
+        data += _message(procconn.PROC_EVENT_EXEC, 42, 42)[:40]
+        self.assertEqual(procconn.parse_events(data), [])
+
+    def test_multiple(self):
+        data = _message(procconn.PROC_EVENT_EXEC, 42, 42) + \
+            _message(procconn.PROC_EVENT_EXIT, 43, 43, 0, 17)
+        self.assertEqual(procconn.parse_events(data),
+                         [("exec", "42"), ("exit", "43")])
@@ -0,0 +1,131 @@
+# -*- coding: utf8 -*-
+"""
+Test suite for server
+
+To be run through nose2, not executed directly.
+"""
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+from lib_users_util import server
+
+
+class _table(object):
+    """Stand-in for daemon.ProcTable that counts scans"""
+
+    def __init__(self):
+        self.procs = {}
+        self.scans = 0
+
+    def full_scan(self):
+        self.scans += 1
+        self.procs = {"1": ("argv1 ", set(["l2", "l1"])),
+                      "2": ("argv2", set(["l2"]))}
+
+
+class TestScanCache(unittest.TestCase):
+
+    def setUp(self):
+        self._table = _table()
+        self._cache = server.ScanCache(self._table, min_interval=3600)
+        self._cache.rescan(force=True)
+
+    def test_all(self):
+        answer = self._cache.query("all\n")
+        self.assertEqual(answer["scanned"], self._cache.scanned)
+        self.assertEqual(answer["procs"],
+                         {"1": {"argv": "argv1", "files": ["l1", "l2"]},
+                          "2": {"argv": "argv2", "files": ["l2"]}})
+
+    def test_pid(self):
+        self.assertEqual(list(self._cache.query("pid 2")["procs"]), ["2"])
+        self.assertEqual(self._cache.query("pid 3")["procs"], {})
+
+    def test_path(self):
+        self.assertEqual(sorted(self._cache.query("path l2")["procs"]),
+                         ["1", "2"])
+        self.assertEqual(list(self._cache.query("path l1")["procs"]), ["1"])
+
+    def test_errors(self):
+        self.assertIn("error", self._cache.query("frobnicate"))
+        self.assertIn("error", self._cache.query("pid"))
+
+    def test_rescan_rate_limited(self):
+        """Rescans within min_interval of the last one are skipped"""
+        self._cache.query("rescan")
+        self._cache.query("rescan")
+        self.assertEqual(self._table.scans, 1)
+        self._cache.rescan(force=True)
+        self.assertEqual(self._table.scans, 2)
+
+    def test_rescan(self):
+        cache = server.ScanCache(self._table, min_interval=0)
+        cache.query("rescan")
+        self.assertEqual(self._table.scans, 2)
+
+
+class TestServer(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.mkdtemp()
+        self._socket = os.path.join(self._tmpdir, "lib_users.sock")
+        cache = server.ScanCache(_table())
+        cache.rescan(force=True)
+        self._server = server.make_server(cache, self._socket)
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.start()
+
+    def tearDown(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        shutil.rmtree(self._tmpdir)
+
+    def test_query(self):
+        answer = server.query(self._socket, "pid 1")
+        self.assertEqual(answer["procs"],
+                         {"1": {"argv": "argv1", "files": ["l1", "l2"]}})
+
+    def test_permissions(self):
+        """Only the owner may talk to the server"""
+        self.assertEqual(os.stat(self._socket).st_mode & 0o777, 0o700)
+
+
+class TestMakeServer(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.mkdtemp()
+        self._socket = os.path.join(self._tmpdir, "lib_users.sock")
+        self._cache = server.ScanCache(_table())
+
+    def tearDown(self):
+        shutil.rmtree(self._tmpdir)
+
+    def test_stale_socket(self):
+        """The socket of a server that exited is replaced"""
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(self._socket)
+        stale.close()
+        server.make_server(self._cache, self._socket).server_close()
+
+    def test_running_server(self):
+        """The socket of a server that still runs is left alone"""
+        running = server.make_server(self._cache, self._socket)
+        try:
+            with self.assertRaises(OSError):
+                server.make_server(self._cache, self._socket)
+            self.assertTrue(os.path.exists(self._socket))
+        finally:
+            running.server_close()
+
+    def test_not_a_socket(self):
+        with open(self._socket, "w") as fd:
+            fd.write("precious")
+        with self.assertRaises(OSError):
+            server.make_server(self._cache, self._socket)
+        with open(self._socket) as fd:
+            self.assertEqual(fd.read(), "precious")
@@ -0,0 +1,150 @@
+# -*- coding: utf8 -*-
+"""
+Test suite for state
+
+To be run through nose2, not executed directly.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from lib_users_util import common
+from lib_users_util import state
+
+
+class _options(object):
+    """Mock options object that mimicks the bare necessities"""
+
+    def __init__(self):
+        self.machine_readable = False
+        self.showitems = False
+
+
+def _snapshot(boot_id, procs):
+    return {"version": state.STATEVERSION, "boot_id": boot_id,
+            "procs": procs}
+
+
+class TestSnapshots(unittest.TestCase):
+
+    def test_make_snapshot(self):
+        """Snapshot keys are pid:starttime, vanished PIDs are skipped"""
+        pid = str(os.getpid())
+        snap = state.make_snapshot({pid: ("argv1", set(["l2", "l1"])),
+                                    "this is not a pid": ("argv2", set())})
+        key = "%s:%s" % (pid, common.get_starttime(pid))
+        self.assertEqual(snap["procs"], {key: ["argv1", ["l1", "l2"]]})
+        self.assertEqual(snap["boot_id"], common.get_boot_id())
+
+    def test_diff_no_previous(self):
+        """Without a previous snapshot, everything has appeared"""
+        new = _snapshot("b1", {"1:100": ["argv1", ["l1"]]})
+        appeared, disappeared = state.diff_snapshots(None, new)
+        self.assertEqual(dict(appeared), {"argv1": (set(["1"]), set(["l1"]))})
+        self.assertEqual(dict(disappeared), {})
+
+    def test_diff_unchanged(self):
+        """A steady state yields no changes"""
+        snap = _snapshot("b1", {"1:100": ["argv1", ["l1"]]})
+        appeared, disappeared = state.diff_snapshots(snap, snap)
+        self.assertEqual(dict(appeared), {})
+        self.assertEqual(dict(disappeared), {})
+
+    def test_diff_changes(self):
+        """New files, new processes and exited processes are reported"""
+        old = _snapshot("b1", {"1:100": ["argv1", ["l1"]],
+                               "2:200": ["argv2", ["l1"]]})
+        new = _snapshot("b1", {"1:100": ["argv1", ["l1", "l2"]],
+                               "2:300": ["argv2", ["l1"]]})
+        appeared, disappeared = state.diff_snapshots(old, new)
+        self.assertEqual(dict(appeared),
+                         {"argv1": (set(["1"]), set(["l2"])),
+                          "argv2": (set(["2"]), set(["l1"]))})
+        self.assertEqual(dict(disappeared),
+                         {"argv2": (set(["2"]), set(["l1"]))})
+
+    def test_diff_reboot(self):
+        """A snapshot from another boot is disregarded"""
+        old = _snapshot("b1", {"1:100": ["argv1", ["l1"]]})
+        new = _snapshot("b2", {"1:100": ["argv1", ["l1"]]})
+        appeared, disappeared = state.diff_snapshots(old, new)
+        self.assertEqual(dict(appeared), {"argv1": (set(["1"]), set(["l1"]))})
+        self.assertEqual(dict(disappeared), {})
+
+
+class TestStillRunning(unittest.TestCase):
+
+    def setUp(self):
+        self._pid = str(os.getpid())
+        self._key = "%s:%s" % (self._pid, common.get_starttime(self._pid))
+        self._snap = _snapshot(common.get_boot_id(),
+                               {self._key: ["argv1", ["l1"]],
+                                "%s:1" % self._pid: ["argv2", ["l2"]],
+                                "this is not a pid:1": ["argv3", ["l3"]]})
+        self._snap["full_scan"] = 1000.0
+
+    def test_last_full_scan(self):
+        self.assertEqual(state.last_full_scan(self._snap), 1000.0)
+        self.assertEqual(state.last_full_scan(None), None)
+        self._snap["boot_id"] = "another boot"
+        self.assertEqual(state.last_full_scan(self._snap), None)
+
+    def test_still_running(self):
+        """Only processes with the same start time and argv are kept"""
+        self.assertEqual(state.still_running(self._snap, lambda _: "argv1"),
+                         {self._pid: ("argv1", set(["l1"]))})
+
+    def test_exec(self):
+        self.assertEqual(state.still_running(self._snap, lambda _: "argv4"),
+                         {})
+
+    def test_no_full_scan(self):
+        del self._snap["full_scan"]
+        self.assertEqual(state.still_running(self._snap, lambda _: "argv1"),
+                         {})
+        self.assertEqual(state.still_running(None, lambda _: "argv1"), {})
+
+
+class TestStateFile(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.mkdtemp()
+        self._filename = os.path.join(self._tmpdir, "state")
+
+    def tearDown(self):
+        shutil.rmtree(self._tmpdir)
+
+    def test_roundtrip(self):
+        snap = _snapshot("b1", {"1:100": ["argv1", ["l1"]]})
+        state.save_state(self._filename, snap)
+        self.assertEqual(state.load_state(self._filename), snap)
+        self.assertEqual(os.listdir(self._tmpdir), ["state"])
+
+    def test_missing(self):
+        self.assertEqual(state.load_state(self._filename), None)
+
+    def test_broken(self):
+        with open(self._filename, "w") as fd:
+            fd.write("{not json")
+        self.assertEqual(state.load_state(self._filename), None)
+
+
+class TestFmtChanges(unittest.TestCase):
+
+    def test_human(self):
+        options = _options()
+        appeared = {"argv1": (set(["1"]), set(["l1"]))}
+        disappeared = {"argv2": (set(["2"]), set(["l2"]))}
+        self.assertEqual(state.fmt_changes(appeared, disappeared, options),
+                         '+ 1 "argv1"\n- 2 "argv2"')
+
+    def test_machine(self):
+        options = _options()
+        options.machine_readable = True
+        appeared = {"argv1": (set(["1"]), set(["l1"]))}
+        self.assertEqual(state.fmt_changes(appeared, {}, options),
+                         '+;1;l1;argv1')
+
+    def test_nothing(self):
+        self.assertEqual(state.fmt_changes({}, {}, _options()), '')
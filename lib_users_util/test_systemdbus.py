@@ -0,0 +1,178 @@
+# -*- coding: utf8 -*-
+"""
+Test suite for systemdbus
+
+To be run through nose2, not executed directly.
+"""
+import io
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+from lib_users_util import systemdbus
+
+UNITS = {1: "init.scope", 42: "sshd.service", 43: "user@1000.service"}
+
+
+def _escape(name):
+    """Escape a unit name for an object path like systemd does"""
+    return "".join(char if char.isalnum() else "_%02x" % ord(char)
+                   for char in name)
+
+
+class _StandInBus(object):
+    """
+    Answers Hello and GetUnitByPID like the system bus with systemd on it.
+
+    It only replies after it has read the given number of calls to
+    GetUnitByPID, and then in reverse order, so clients that do not pipeline
+    their calls or mix up the replies fail.
+    """
+
+    def __init__(self, path, calls, auth=b"OK 0123456789abcdef\r\n",
+                 error=None):
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(path)
+        self._listener.listen(1)
+        self._calls = calls
+        self._auth = auth
+        self._error = error
+        self.received = []
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _serve(self):
+        conn, _ = self._listener.accept()
+        stream = conn.makefile("rb")
+        try:
+            self._handle(conn, stream)
+        except systemdbus.BusError:
+            pass
+        finally:
+            stream.close()
+            conn.close()
+            self._listener.close()
+
+    def _handle(self, conn, stream):
+        stream.read(1)
+        self.received.append(stream.readline())
+        conn.sendall(self._auth)
+        if not self._auth.startswith(b"OK"):
+            return
+        self.received.append(stream.readline())
+        hello = systemdbus.read_message(stream)
+        conn.sendall(systemdbus.marshal(
+            systemdbus.METHOD_RETURN, 1, {systemdbus.REPLY_SERIAL:
+                                          hello.serial}, "s", [":1.1"]))
+        conn.sendall(systemdbus.marshal(
+            systemdbus.SIGNAL, 2, {systemdbus.PATH: "/org/freedesktop/DBus",
+                                   systemdbus.MEMBER: "NameAcquired"},
+            "s", [":1.1"]))
+
+        calls = [systemdbus.read_message(stream) for _ in range(self._calls)]
+        self.received.extend(calls)
+        for serial, call in enumerate(reversed(calls), 3):
+            pid = call.body[0]
+            reply = {systemdbus.REPLY_SERIAL: call.serial}
+            if self._error:
+                reply[systemdbus.ERROR_NAME] = self._error
+                conn.sendall(systemdbus.marshal(systemdbus.ERROR, serial,
+                                                reply, "s", ["Oops"]))
+            elif pid in UNITS:
+                conn.sendall(systemdbus.marshal(
+                    systemdbus.METHOD_RETURN, serial, reply, "o",
+                    ["/org/freedesktop/systemd1/unit/%s" %
+                     _escape(UNITS[pid])]))
+            else:
+                reply[systemdbus.ERROR_NAME] = systemdbus.NOUNITERRORS[0]
+                conn.sendall(systemdbus.marshal(
+                    systemdbus.ERROR, serial, reply, "s",
+                    ["PID %d does not belong to any loaded unit." % pid]))
+
+    def join(self):
+        self._thread.join(5)
+
+
+class TestMarshalling(unittest.TestCase):
+
+    def test_roundtrip(self):
+        data = systemdbus.marshal(
+            systemdbus.METHOD_CALL, 7,
+            {systemdbus.PATH: systemdbus.SYSTEMDPATH,
+             systemdbus.MEMBER: "GetUnitByPID"}, "usg", [42, "foo", "as"])
+        self.assertEqual(len(data) % 4, 0)
+        msg = systemdbus.read_message(io.BytesIO(data))
+        self.assertEqual(msg.type, systemdbus.METHOD_CALL)
+        self.assertEqual(msg.serial, 7)
+        self.assertEqual(msg.fields, {systemdbus.PATH: systemdbus.SYSTEMDPATH,
+                                      systemdbus.MEMBER: "GetUnitByPID",
+                                      systemdbus.SIGNATURE: "usg"})
+        self.assertEqual(msg.body, [42, "foo", "as"])
+
+    def test_truncated(self):
+        data = systemdbus.marshal(systemdbus.METHOD_CALL, 7,
+                                  {systemdbus.MEMBER: "Hello"})
+        with self.assertRaises(systemdbus.BusError):
+            systemdbus.read_message(io.BytesIO(data[:-1]))
+
+    def test_unit_name(self):
+        self.assertEqual(systemdbus.unit_name(
+            "/org/freedesktop/systemd1/unit/user_401000_2eservice"),
+            "user@1000.service")
+
+
+class TestGetUnits(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.mkdtemp()
+        self._path = os.path.join(self._tmpdir, "bus")
+        self._address = "unix:path=%s" % self._path
+
+    def tearDown(self):
+        shutil.rmtree(self._tmpdir)
+
+    def test_get_units(self):
+        bus = _StandInBus(self._path, 4)
+        units = systemdbus.get_units(["1", "42", "43", "4711"], self._address)
+        bus.join()
+        self.assertEqual(units, {"1": "init.scope", "42": "sshd.service",
+                                 "43": "user@1000.service"})
+        self.assertEqual(bus.received[0], b"AUTH EXTERNAL %s\r\n" %
+                         str(os.geteuid()).encode().hex().encode())
+        self.assertEqual(bus.received[1], b"BEGIN\r\n")
+        self.assertEqual([call.body for call in bus.received[2:]],
+                         [[1], [42], [43], [4711]])
+
+    def test_batches(self):
+        orig_depth = systemdbus.PIPELINE_DEPTH
+        systemdbus.PIPELINE_DEPTH = 2
+        try:
+            bus = _StandInBus(self._path, 2)
+            # The stand-in hangs up after answering the first batch
+            with self.assertRaises((systemdbus.BusError, OSError)):
+                systemdbus.get_units(["1", "42", "43"], self._address)
+            bus.join()
+        finally:
+            systemdbus.PIPELINE_DEPTH = orig_depth
+
+    def test_no_systemd(self):
+        bus = _StandInBus(
+            self._path, 1,
+            error="org.freedesktop.DBus.Error.ServiceUnknown")
+        with self.assertRaises(systemdbus.BusError):
+            systemdbus.get_units(["1"], self._address)
+        bus.join()
+
+    def test_auth_rejected(self):
+        bus = _StandInBus(self._path, 0, auth=b"REJECTED EXTERNAL\r\n")
+        with self.assertRaises(systemdbus.BusError):
+            systemdbus.get_units(["1"], self._address)
+        bus.join()
+
+    def test_no_bus(self):
+        with self.assertRaises(OSError):
+            systemdbus.get_units(["1"], self._address)
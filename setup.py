@@ -10,5 +10,5 @@ setup(name='lib_users',
       author_email='klausman@schwarzvogel.de',
       url='https://github.com/klausman/lib_users',
       packages=['lib_users_util'],
-      scripts=['lib_users.py', 'fd_users.py'],
+      scripts=['lib_users.py', 'fd_users.py', 'lib_users_fleet.py'],
       )
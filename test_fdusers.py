@@ -46,8 +46,7 @@ class TestGetDeletedFiles(unittest.TestCase):
         self.options = _options()
 
         self.f_u = fd_users
-        self._orig_glob_glob = self.f_u.glob.glob
-        self._orig_os_readlink = self.f_u.os.readlink
+        self._orig_iter_links = self.f_u.common.iter_links
         self._orig_stderr = self.f_u.sys.stderr
         self._orig_stdout = self.f_u.sys.stderr
 
@@ -56,101 +55,93 @@ class TestGetDeletedFiles(unittest.TestCase):
 
     def tearDown(self):
         """Restore mocked out functions"""
-        self.f_u.glob.glob = self._orig_glob_glob
-        self.f_u.os.readlink = self._orig_os_readlink
+        self.f_u.common.iter_links = self._orig_iter_links
 
     def testSimpleCase(self):
-        self.f_u.glob.glob = MagicMock(return_value=["/nonexistant/1/fd/1"])
-        self.f_u.os.readlink = MagicMock(return_value="/some/other/file")
+        self.f_u.common.iter_links = MagicMock(
+            return_value=["/some/other/file"])
         res = self.f_u.get_deleted_files("/nonexistant/1/fd", [], [])
 
         self.assertEqual(res, [])
-        self.f_u.glob.glob.assert_called_once_with("/nonexistant/1/fd/*")
-        self.f_u.os.readlink.assert_called_once_with("/nonexistant/1/fd/1")
+        self.f_u.common.iter_links.assert_called_once_with(
+            "/nonexistant/1/fd")
 
     def testOneDeletedFile(self):
-        self.f_u.glob.glob = MagicMock(return_value=["/nonexistant/1/fd/1"])
-        self.f_u.os.readlink = MagicMock(
-            return_value="/some/other/file (deleted)")
+        self.f_u.common.iter_links = MagicMock(
+            return_value=["/some/other/file (deleted)"])
         res = self.f_u.get_deleted_files("/nonexistant/1/fd", [], [])
 
         self.assertEqual(res, ["/some/other/file"])
-        self.f_u.glob.glob.assert_called_once_with("/nonexistant/1/fd/*")
-        self.f_u.os.readlink.assert_called_once_with("/nonexistant/1/fd/1")
+        self.f_u.common.iter_links.assert_called_once_with(
+            "/nonexistant/1/fd")
 
     def testMixedFileStates(self):
-        fdlist = ["/nonexistant/1/fd/1", "/nonexistant/1/fd/2"]
-        self.f_u.glob.glob = MagicMock(return_value=fdlist)
-        self.f_u.os.readlink = MagicMock(
-            return_value="/some/other/file (deleted)")
-        self.f_u.os.readlink.side_effect = ["/some/other/file (deleted)",
-                                            "/some/other/file2"]
+        self.f_u.common.iter_links = MagicMock(
+            return_value=["/some/other/file (deleted)", "/some/other/file2"])
 
         res = self.f_u.get_deleted_files("/nonexistant/1/fd", [], [])
         self.assertEqual(res, ["/some/other/file"])
-        self.f_u.glob.glob.assert_called_once_with("/nonexistant/1/fd/*")
-        self.f_u.os.readlink.assert_has_calls(
-            unittest.mock.call(x) for x in fdlist)
+        self.f_u.common.iter_links.assert_called_once_with(
+            "/nonexistant/1/fd")
 
     def testMixedFileStatesWithLiteral(self):
-        fdlist = ["/nonexistant/1/fd/1", "/nonexistant/1/fd/2"]
-        self.f_u.glob.glob = MagicMock(return_value=fdlist)
-        self.f_u.os.readlink = MagicMock(
-            return_value="/some/other/file (deleted)")
-        self.f_u.os.readlink.side_effect = ["/some/other/file (deleted)",
-                                            "/some/other/file2"]
+        self.f_u.common.iter_links = MagicMock(
+            return_value=["/some/other/file (deleted)", "/some/other/file2"])
 
         res = self.f_u.get_deleted_files("/nonexistant/1/fd", [],
                                          ["/some/other/file"])
         self.assertEqual(res, [])
-        self.f_u.glob.glob.assert_called_once_with("/nonexistant/1/fd/*")
-        self.f_u.os.readlink.assert_has_calls(
-            unittest.mock.call(x) for x in fdlist)
+        self.f_u.common.iter_links.assert_called_once_with(
+            "/nonexistant/1/fd")
 
     def testMixedFileStatesWithLiteralNomatch(self):
-        fdlist = ["/nonexistant/1/fd/1", "/nonexistant/1/fd/2"]
-        self.f_u.glob.glob = MagicMock(return_value=fdlist)
-        self.f_u.os.readlink = MagicMock(
-            return_value="/some/other/file (deleted)")
-        self.f_u.os.readlink.side_effect = ["/some/other/file (deleted)",
-                                            "/some/other/file2"]
+        self.f_u.common.iter_links = MagicMock(
+            return_value=["/some/other/file (deleted)", "/some/other/file2"])
 
         res = self.f_u.get_deleted_files("/nonexistant/1/fd", [],
                                          ["/literal/doesnt/match"])
         self.assertEqual(res, ["/some/other/file"])
-        self.f_u.glob.glob.assert_called_once_with("/nonexistant/1/fd/*")
-        self.f_u.os.readlink.assert_has_calls(
-            unittest.mock.call(x) for x in fdlist)
+        self.f_u.common.iter_links.assert_called_once_with(
+            "/nonexistant/1/fd")
 
     def testMixedFileStatesWithPattern(self):
-        fdlist = ["/nonexistant/1/fd/1", "/nonexistant/1/fd/2"]
-        self.f_u.glob.glob = MagicMock(return_value=fdlist)
-        self.f_u.os.readlink = MagicMock(
-            return_value="/some/other/file (deleted)")
-        self.f_u.os.readlink.side_effect = ["/some/other/file (deleted)",
-                                            "/some/other/file2"]
+        self.f_u.common.iter_links = MagicMock(
+            return_value=["/some/other/file (deleted)", "/some/other/file2"])
 
         res = self.f_u.get_deleted_files("/nonexistant/1/fd",
                                          ["/some/other/fil*"], [])
         self.assertEqual(res, [])
-        self.f_u.glob.glob.assert_called_once_with("/nonexistant/1/fd/*")
-        self.f_u.os.readlink.assert_has_calls(
-            unittest.mock.call(x) for x in fdlist)
+        self.f_u.common.iter_links.assert_called_once_with(
+            "/nonexistant/1/fd")
+
+    def testIgnoredObserved(self):
+        self.f_u.common.iter_links = MagicMock(
+            return_value=["/some/other/file (deleted)",
+                          "/some/file (deleted)", "/some/file2"])
+        observer = MagicMock()
+        self.f_u.observe.register(observer)
+        try:
+            res = self.f_u.get_deleted_files("/nonexistant/1/fd",
+                                             ["/some/other/fil*"],
+                                             ["/some/file"])
+        finally:
+            self.f_u.observe.unregister()
+        self.assertEqual(res, [])
+        observer.ignored.assert_has_calls(
+            [unittest.mock.call("/some/other/file", "/some/other/fil*"),
+             unittest.mock.call("/some/file", "/some/file")])
+        observer.file_read.assert_called_once_with(
+            "/nonexistant/1/fd", 57)
 
     def testMixedFileStatesWithPatternNomatch(self):
-        fdlist = ["/nonexistant/1/fd/1", "/nonexistant/1/fd/2"]
-        self.f_u.glob.glob = MagicMock(return_value=fdlist)
-        self.f_u.os.readlink = MagicMock(
-            return_value="/some/other/file (deleted)")
-        self.f_u.os.readlink.side_effect = ["/some/other/file (deleted)",
-                                            "/some/other/file2"]
+        self.f_u.common.iter_links = MagicMock(
+            return_value=["/some/other/file (deleted)", "/some/other/file2"])
 
         res = self.f_u.get_deleted_files("/nonexistant/1/fd",
                                          ["/pattern/doesnt/match*"], [])
         self.assertEqual(res, ["/some/other/file"])
-        self.f_u.glob.glob.assert_called_once_with("/nonexistant/1/fd/*")
-        self.f_u.os.readlink.assert_has_calls(
-            unittest.mock.call(x) for x in fdlist)
+        self.f_u.common.iter_links.assert_called_once_with(
+            "/nonexistant/1/fd")
 
 
 class Testlibuserswithmocks(unittest.TestCase):
@@ -203,3 +194,8 @@ class Testlibuserswithmocks(unittest.TestCase):
     def test_givenlist(self):
         """Test main() in default mode"""
         self.assertEquals(self.f_u.main([]), None)
+
+    def test_replay_conflicts(self):
+        for flags in (["-S"], ["-g", "unit"], ["--daemon"]):
+            with self.assertRaises(SystemExit):
+                self.f_u.main(["--replay", "foo"] + flags)
@@ -4,16 +4,23 @@ Test suite for lib_users
 To be run through nose2, not executed directly.
 """
 # -*- coding: utf8 -*-
+import json
+import os
 import sys
+import mmap
 import locale
+import shutil
+import tempfile
 import lib_users
 import unittest
+import unittest.mock
 
 if sys.version.startswith("2"):
     from cStringIO import StringIO
 else:
     from io import StringIO
 
+MagicMock = unittest.mock.MagicMock
 
 # Some tests use sort() - make sure the sorting is the same regardless of
 # the users environment
@@ -56,6 +63,35 @@ class Testlibusers(unittest.TestCase):
         self.l_u.sys.stderr = self._orig_stderr
         self.l_u.sys.stdout = self._orig_stdout
 
+    def test_needs_full_scan(self):
+        """Ignored executables, like memfds, don't need a full scan"""
+        orig_check = self.l_u.fastcheck.check
+        try:
+            self.l_u.fastcheck.check = MagicMock(
+                return_value=set(["/memfd:runc_cloned:/proc/self/exe"]))
+            self.assertFalse(self.l_u.needs_full_scan("1", {}))
+            self.l_u.fastcheck.check.return_value.add("/usr/sbin/foo")
+            self.assertTrue(self.l_u.needs_full_scan("1", {}))
+        finally:
+            self.l_u.fastcheck.check = orig_check
+
+    def test_nonlibs_observed(self):
+        """Ignored mappings are reported to the observer"""
+        observer = MagicMock()
+        self.l_u.observe.register(observer)
+        try:
+            res = self.l_u.get_deleted_libs([
+                "7f02a4202000-7f02a6202000 rw-s 00000000 00:04 425984 "
+                "/dev/zero (deleted)",
+                "7f02a4202000-7f02a6202000 rw-s 00000000 00:04 425984 "
+                "/dev/shm/foo (deleted)"])
+        finally:
+            self.l_u.observe.unregister()
+        self.assertEqual(res, EMPTYSET)
+        observer.ignored.assert_has_calls(
+            [unittest.mock.call("/dev/zero", "/dev/zero"),
+             unittest.mock.call("/dev/shm/foo", "/dev/shm/*")])
+
     def test_nonlibs(self):
         """Test detection of mappings that aren't libs"""
         pseudofile = []
@@ -168,6 +204,177 @@ class Testlibusers(unittest.TestCase):
         self.assertEquals(lib_users.get_deleted_libs(pseudofile), EMPTYSET)
 
 
+class Testprocmapquery(unittest.TestCase):
+    """Compare the PROCMAP_QUERY ioctl and text parser implementations"""
+
+    def setUp(self):
+        self._tmpdir = tempfile.mkdtemp()
+        libname = os.path.join(self._tmpdir, "libdeleted.so")
+        with open(libname, "wb") as fd:
+            fd.write(b"\0" * mmap.PAGESIZE)
+        self._lib = open(libname, "rb")
+        self._map = mmap.mmap(self._lib.fileno(), mmap.PAGESIZE,
+                              prot=mmap.PROT_READ)
+        os.unlink(libname)
+        self._libname = libname
+
+    def tearDown(self):
+        self._map.close()
+        self._lib.close()
+        shutil.rmtree(self._tmpdir)
+
+    def test_identical_results(self):
+        """Both implementations find the same deleted libs"""
+        with open("/proc/self/maps") as mapsfile:
+            try:
+                res_ioctl = lib_users._get_deleted_libs_ioctl(mapsfile)
+            except lib_users.procmap.Unsupported:
+                self.skipTest("PROCMAP_QUERY not supported by this kernel")
+        with open("/proc/self/maps") as mapsfile:
+            res_text = lib_users._get_deleted_libs_text(mapsfile)
+        self.assertIn(self._libname, res_ioctl)
+        self.assertEqual(res_ioctl, res_text)
+
+    def test_fallback(self):
+        """Files without a file descriptor are parsed as text"""
+        with open("/proc/self/maps") as mapsfile:
+            pseudofile = StringIO(mapsfile.read())
+        self.assertIn(self._libname, lib_users.get_deleted_libs(pseudofile))
+
+    def test_mapped_files(self):
+        """Only mapped files that were not deleted are listed"""
+        mapped = lib_users.get_mapped_files("/proc/self/maps")
+        self.assertIn(os.readlink("/proc/self/exe"), mapped)
+        self.assertNotIn(self._libname, mapped)
+
+    def test_regular_file(self):
+        """Regular files are parsed as text, whichever file came first"""
+        orig_supported = lib_users.procmap.SUPPORTED
+        copy = os.path.join(self._tmpdir, "maps")
+        with open("/proc/self/maps") as mapsfile:
+            with open(copy, "w") as fd:
+                fd.write(mapsfile.read())
+        try:
+            for supported in (None, True):
+                lib_users.procmap.SUPPORTED = supported
+                with open(copy) as fd:
+                    self.assertIn(self._libname,
+                                  lib_users.get_deleted_libs(fd))
+                # A copy says nothing about the kernel
+                self.assertEqual(lib_users.procmap.SUPPORTED, supported)
+        finally:
+            lib_users.procmap.SUPPORTED = orig_supported
+
+
+class Testreplacedlibs(unittest.TestCase):
+    """Test detection of libs replaced without being marked as deleted"""
+
+    def setUp(self):
+        self._tmpdir = tempfile.mkdtemp()
+        self._jail = os.path.join(self._tmpdir, "jail")
+        os.mkdir(self._jail)
+        self._proc("self", "mnt:[1]", "/")
+        self._proc("1", "mnt:[1]", "/")
+        self._lib = os.path.join(self._tmpdir, "libfoo.so")
+        with open(self._lib, "w") as fd:
+            fd.write("foo")
+        self._inode = os.stat(self._lib).st_ino
+
+        self._orig_procfsbase = lib_users.common.PROCFSBASE
+        self._orig_get_fsview = lib_users.common.get_fsview
+        lib_users.common.PROCFSBASE = os.path.join(self._tmpdir, "proc")
+        lib_users.common.get_fsview = lambda pid: ("mnt:[1]", 1, 2)
+
+    def tearDown(self):
+        lib_users.common.PROCFSBASE = self._orig_procfsbase
+        lib_users.common.get_fsview = self._orig_get_fsview
+        shutil.rmtree(self._tmpdir)
+
+    def _maps(self, inode, name):
+        return StringIO("7f02a85f1000-7f02a85f2000 r-xp 00000000 09:01 %s "
+                        "%s\n" % (inode, name))
+
+    def _proc(self, pid, mntns, root):
+        """Make a process in the mount namespace mntns, chroot()'ed to root"""
+        os.makedirs(os.path.join(self._tmpdir, "proc", pid, "ns"))
+        os.symlink(mntns, os.path.join(self._tmpdir, "proc", pid, "ns",
+                                       "mnt"))
+        os.symlink(root, os.path.join(self._tmpdir, "proc", pid, "root"))
+
+    def test_unchanged(self):
+        res = lib_users.get_replaced_libs(
+            self._maps(self._inode, self._lib), "1", {})
+        self.assertEqual(res, EMPTYSET)
+
+    def test_replaced(self):
+        res = lib_users.get_replaced_libs(
+            self._maps(self._inode + 1, self._lib), "1", {})
+        self.assertEqual(res, set([self._lib]))
+
+    def test_gone(self):
+        res = lib_users.get_replaced_libs(
+            self._maps(self._inode, self._lib + ".1"), "1", {})
+        self.assertEqual(res, set([self._lib + ".1"]))
+
+    def test_chroot(self):
+        """
+        In our mount namespace, paths are shown as we see them, not relative
+        to the root of a chroot()'ed process
+        """
+        self._proc("2", "mnt:[1]", self._jail)
+        res = lib_users.get_replaced_libs(
+            self._maps(self._inode, self._lib), "2", {})
+        self.assertEqual(res, EMPTYSET)
+        res = lib_users.get_replaced_libs(
+            self._maps(self._inode + 1, self._lib), "2", {})
+        self.assertEqual(res, set([self._lib]))
+
+    def test_chroot_other_namespace(self):
+        """
+        In other mount namespaces, paths are shown relative to the root of
+        the namespace, here the symlink target
+        """
+        self._proc("2", "mnt:[2]", self._jail)
+        lib = os.path.join(self._jail, "libbar.so")
+        with open(lib, "w") as fd:
+            fd.write("bar")
+        inode = os.stat(lib).st_ino
+        res = lib_users.get_replaced_libs(self._maps(inode, lib), "2", {})
+        self.assertEqual(res, EMPTYSET)
+        res = lib_users.get_replaced_libs(self._maps(inode + 1, lib), "2", {})
+        self.assertEqual(res, set([lib]))
+        # Outside of the root directory of the process
+        res = lib_users.get_replaced_libs(
+            self._maps(self._inode + 1, self._lib), "2", {})
+        self.assertEqual(res, EMPTYSET)
+
+    def test_vanished(self):
+        res = lib_users.get_replaced_libs(
+            self._maps(self._inode + 1, self._lib), "2", {})
+        self.assertEqual(res, EMPTYSET)
+
+    def test_deleted_and_anon(self):
+        """Deleted and anonymous mappings are left to get_deleted_libs"""
+        pseudofile = StringIO(
+            "7f02a85f1000-7f02a85f2000 r-xp 00000000 09:01 12 "
+            "/lib64/libgone.so (deleted)\n"
+            "7f02a85f1000-7f02a85f2000 rw-p 00000000 00:00 0 [heap]\n")
+        self.assertEqual(lib_users.get_replaced_libs(pseudofile, "1", {}),
+                         EMPTYSET)
+
+    def test_cache(self):
+        """stat() results are shared between processes with the same view"""
+        statcache = {}
+        lib_users.get_replaced_libs(
+            self._maps(self._inode, self._lib), "1", statcache)
+        os.unlink(self._lib)
+        res = lib_users.get_replaced_libs(
+            self._maps(self._inode, self._lib), "1", statcache)
+        self.assertEqual(res, EMPTYSET)
+        self.assertEqual(statcache,
+                         {(("mnt:[1]", 1, 2), self._lib): self._inode})
+
+
 class Testlibuserswithmocks(unittest.TestCase):
 
     """Run tests that need mocks"""
@@ -220,3 +427,165 @@ class Testlibuserswithmocks(unittest.TestCase):
     def test_givenlist(self):
         """Test main() in default mode"""
         self.assertEquals(self.l_u.main([]), None)
+
+    def test_state(self):
+        """Test main() with a state file"""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            statefile = os.path.join(tmpdir, "state")
+            self.assertEqual(self.l_u.main(["--state", statefile]), None)
+            snap = self.l_u.state.load_state(statefile)
+            self.assertNotEqual(snap, None)
+            # We skip our own process, but our parent is still running
+            self.assertIn("%s:%s" % (os.getppid(),
+                                     self.l_u.common.get_starttime(
+                                         os.getppid())),
+                          snap["procs"])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_index(self):
+        """Test main() querying, saving and loading an index"""
+        tmpdir = tempfile.mkdtemp()
+        ppid = str(os.getppid())
+        exe = os.readlink("/proc/%s/exe" % ppid)
+
+        def query(args):
+            """Run main() with args, return the PIDs it lists"""
+            self.l_u.sys.stdout = StringIO()
+            self.assertEqual(self.l_u.main(["-m", "-q", exe] + args), None)
+            output = self.l_u.sys.stdout.getvalue()
+            return set(",".join(line.split(";")[0] for line in
+                                output.splitlines()).split(","))
+
+        try:
+            indexfile = os.path.join(tmpdir, "index")
+            self.assertIn(ppid, query(["--save-index", indexfile]))
+            self.assertIn(ppid, query(["--load-index", indexfile]))
+
+            # Pretend the process exited and its PID was reused
+            with open(indexfile) as fd:
+                data = json.load(fd)
+            procid = "%s:%s" % (ppid, self.l_u.common.get_starttime(ppid))
+            self.assertIn(procid, data["keys"])
+            data["keys"][procid + "0"] = data["keys"].pop(procid)
+            for procids in data["paths"].values():
+                procids[:] = [procid + "0" if entry == procid else entry
+                              for entry in procids]
+            with open(indexfile, "w") as fd:
+                json.dump(data, fd)
+            self.assertNotIn(ppid, query(["--load-index", indexfile]))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_gentle(self):
+        """Test main() in gentle mode"""
+        self.assertEqual(self.l_u.main(["--gentle", "--gentle-window", "0",
+                                        "--gentle-backoff", "0"]), None)
+
+    def test_replaced(self):
+        """Test main() looking for replaced libs"""
+        self.assertEqual(self.l_u.main(["-r"]), None)
+
+    def test_fast(self):
+        """Only flagged processes are scanned in fast mode"""
+        orig_needs_full_scan = self.l_u.needs_full_scan
+        orig_scan_maps = self.l_u.scan_maps
+        self.l_u.needs_full_scan = MagicMock(return_value=False)
+        self.l_u.scan_maps = MagicMock(side_effect=orig_scan_maps)
+        try:
+            self.assertEqual(self.l_u.main(["--fast"]), None)
+            self.assertTrue(self.l_u.needs_full_scan.called)
+            self.assertFalse(self.l_u.scan_maps.called)
+        finally:
+            self.l_u.needs_full_scan = orig_needs_full_scan
+            self.l_u.scan_maps = orig_scan_maps
+
+    def test_state_memory(self):
+        """With --state, memory is shown for processes with changes"""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            args = ["--state", os.path.join(tmpdir, "state"), "-M"]
+            self.l_u.sys.stdout = StringIO()
+            self.l_u.main(args)
+            self.assertIn("Memory held by deleted mappings",
+                          self.l_u.sys.stdout.getvalue())
+            self.l_u.sys.stdout = StringIO()
+            self.l_u.main(args)
+            self.assertNotIn("Memory held by deleted mappings",
+                             self.l_u.sys.stdout.getvalue())
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_fast_state(self):
+        """Fast scans keep what the last full scan found"""
+        orig_needs_full_scan = self.l_u.needs_full_scan
+        self.l_u.needs_full_scan = MagicMock(return_value=False)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            statefile = os.path.join(tmpdir, "state")
+            args = ["--fast", "--state", statefile, "--full-interval", "3600"]
+            # Without a previous full scan, this is one
+            self.l_u.main(args)
+            self.assertFalse(self.l_u.needs_full_scan.called)
+            full = self.l_u.state.load_state(statefile)
+            self.assertNotEqual(full["full_scan"], None)
+
+            self.l_u.main(args)
+            self.assertTrue(self.l_u.needs_full_scan.called)
+            fast = self.l_u.state.load_state(statefile)
+            self.assertEqual(fast["full_scan"], full["full_scan"])
+            key = "%s:%s" % (os.getppid(),
+                             self.l_u.common.get_starttime(os.getppid()))
+            self.assertEqual(fast["procs"][key], full["procs"][key])
+        finally:
+            self.l_u.needs_full_scan = orig_needs_full_scan
+            shutil.rmtree(tmpdir)
+
+    @unittest.skipUnless(lib_users.pidfd.SUPPORTED,
+                         "pidfds are not supported")
+    def test_pin(self):
+        """Test main() pinning processes, without keeping the pidfds"""
+        fds = len(os.listdir("/proc/self/fd"))
+        self.assertEqual(self.l_u.main(["--pin"]), None)
+        self.assertEqual(len(os.listdir("/proc/self/fd")), fds)
+
+    def test_replay_conflicts(self):
+        for flags in (["-r"], ["-S"], ["-g", "exe"], ["--daemon"],
+                      ["--serve", "foo"]):
+            with self.assertRaises(SystemExit):
+                self.l_u.main(["--replay", "foo"] + flags)
+
+    def test_serve_conflicts(self):
+        for flag in ("--daemon", "--state=foo", "-M", "-P", "-S", "--gentle",
+                     "-q/foo", "--load-index=foo"):
+            with self.assertRaises(SystemExit):
+                self.l_u.main(["--serve", "foo", flag])
+
+    def test_daemon_conflicts(self):
+        for flag in ("--state=foo", "-M", "--gentle", "-q/foo",
+                     "--save-index=foo", "--capture=foo"):
+            with self.assertRaises(SystemExit):
+                self.l_u.main(["--daemon", flag])
+
+    def test_full_interval_needs_state(self):
+        with self.assertRaises(SystemExit):
+            self.l_u.main(["--fast", "--full-interval", "60"])
+
+    def test_trace(self):
+        """Test main() writing a trace"""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            tracefile = os.path.join(tmpdir, "trace.json")
+            self.assertEqual(self.l_u.main(["--trace", tracefile]), None)
+            self.l_u.observe.OBSERVER.close()
+            with open(tracefile) as fd:
+                events = json.load(fd)["traceEvents"]
+        finally:
+            self.l_u.observe.unregister()
+            shutil.rmtree(tmpdir)
+        phases = [event["ph"] for event in events
+                  if event.get("cat") == "scan"]
+        self.assertTrue(phases)
+        self.assertEqual(phases.count("B"), phases.count("E"))
+        self.assertIn("format human", [event["name"] for event in events])
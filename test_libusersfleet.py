@@ -0,0 +1,141 @@
+"""
+Test suite for lib_users_fleet
+
+To be run through nose2, not executed directly.
+"""
+# -*- coding: utf8 -*-
+import io
+import json
+import os
+import shutil
+import tempfile
+import lib_users_fleet
+import unittest
+
+HOST1 = """\
+1,2;/lib64/libc.so.6,/lib64/libssl.so.3;/usr/sbin/nginx -g daemon off;
+3;/lib64/libc.so.6;/usr/sbin/sshd -D
+"""
+
+HOST2 = """\
+4;/lib64/libc.so.6;/usr/sbin/sshd -D
+5;/lib64/libc.so.6;/usr/sbin/sshd -D -f /etc/ssh/other
+"""
+
+HOST3 = json.dumps({"version": 1, "boot_id": "b1", "procs": {
+    "1:100": ["/usr/sbin/nginx -g daemon off;", ["/lib64/libssl.so.3"]]}})
+
+
+class _mock_stdx(object):
+    """A stand-in for sys.stdout/stderr"""
+
+    def write(self, *_, **_unused):
+        """Discard everything"""
+
+
+class TestParsing(unittest.TestCase):
+
+    def test_machine(self):
+        files, commands = lib_users_fleet.parse_stream(io.StringIO(HOST1))
+        self.assertEqual(files, set(["/lib64/libc.so.6",
+                                     "/lib64/libssl.so.3"]))
+        self.assertEqual(commands, set(["/usr/sbin/nginx", "/usr/sbin/sshd"]))
+
+    def test_state(self):
+        files, commands = lib_users_fleet.parse_stream(io.StringIO(HOST3))
+        self.assertEqual(files, set(["/lib64/libssl.so.3"]))
+        self.assertEqual(commands, set(["/usr/sbin/nginx"]))
+
+    def test_garbage(self):
+        files, commands = lib_users_fleet.parse_stream(
+            io.StringIO("Warning: Some files could not be read.\n"))
+        self.assertEqual(files, set())
+        self.assertEqual(commands, set())
+
+    def test_memory(self):
+        """The output of lib_users -m -M is not mistaken for processes"""
+        files, commands = lib_users_fleet.parse_stream(io.StringIO(
+            "3;/lib64/libc.so.6;/usr/sbin/sshd -D\n\n#pid;3;14449;0\n"
+            "#lib;/lib64/libc.so.6;14449;0\n#total;0;0\n"
+            "pid;3;14449;0\ntotal;0;0\n"))
+        self.assertEqual(files, set(["/lib64/libc.so.6"]))
+        self.assertEqual(commands, set(["/usr/sbin/sshd"]))
+
+    def test_empty(self):
+        files, commands = lib_users_fleet.parse_stream(io.StringIO(""))
+        self.assertEqual(files, set())
+
+    def test_broken_state(self):
+        for text in ('{"procs": [', '{"version": 1, "procs": {"1:2": ["x"]}}',
+                     '{"version": 1, "procs": []}', '{"version": 1}',
+                     '{"procs": {"1:2": ["x", [1]]}}'):
+            with self.assertRaises(ValueError):
+                lib_users_fleet.parse_stream(io.StringIO(text))
+
+
+class TestAggregation(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.mkdtemp()
+        for name, content in (("host1", HOST1), ("host2", HOST2),
+                              ("host3", HOST3)):
+            with open(os.path.join(self._tmpdir, name), "w") as fd:
+                fd.write(content)
+        self._orig_stdout = lib_users_fleet.sys.stdout
+        self._orig_stderr = lib_users_fleet.sys.stderr
+        lib_users_fleet.sys.stderr = _mock_stdx()
+
+    def tearDown(self):
+        lib_users_fleet.sys.stdout = self._orig_stdout
+        lib_users_fleet.sys.stderr = self._orig_stderr
+        shutil.rmtree(self._tmpdir)
+
+    def test_broken_state_file(self):
+        """Broken state files are reported, not counted as hosts"""
+        with open(os.path.join(self._tmpdir, "host4"), "w") as fd:
+            fd.write('{"version": 1, "procs": {"1:2": ["x"]}}')
+        with open(os.path.join(self._tmpdir, "host5"), "w") as fd:
+            fd.write('{"procs": [')
+        hosts, _, _, errors = lib_users_fleet.aggregate(
+            map(lib_users_fleet.parse_file,
+                lib_users_fleet.expand_dirs([self._tmpdir])))
+        self.assertEqual(hosts, 3)
+        self.assertEqual(len(errors), 2)
+        # Nor do they stop parallel parsing
+        self.assertEqual(self._run(["-m", "-j", "2", self._tmpdir]),
+                         self._run(["-m", "-j", "1", self._tmpdir]))
+
+    def test_aggregate(self):
+        filenames = lib_users_fleet.expand_dirs([self._tmpdir, "/nonexistant"])
+        hosts, filecounts, commandcounts, errors = lib_users_fleet.aggregate(
+            map(lib_users_fleet.parse_file, filenames))
+        self.assertEqual(hosts, 3)
+        self.assertEqual(dict(filecounts), {"/lib64/libc.so.6": 2,
+                                            "/lib64/libssl.so.3": 2})
+        self.assertEqual(dict(commandcounts), {"/usr/sbin/nginx": 2,
+                                               "/usr/sbin/sshd": 2})
+        self.assertEqual(len(errors), 1)
+
+    def _run(self, argv):
+        output = io.StringIO()
+        lib_users_fleet.sys.stdout = output
+        lib_users_fleet.main(argv)
+        return output.getvalue()
+
+    def test_main_parallel(self):
+        """Parallel and sequential parsing give the same result"""
+        sequential = self._run(["-m", "-j", "1", self._tmpdir])
+        parallel = self._run(["-m", "-j", "2", self._tmpdir])
+        self.assertEqual(sequential, parallel)
+        self.assertEqual(sequential.splitlines(), [
+            "hosts;3",
+            "file;2;/lib64/libc.so.6",
+            "file;2;/lib64/libssl.so.3",
+            "command;2;/usr/sbin/nginx",
+            "command;2;/usr/sbin/sshd"])
+
+    def test_main_human(self):
+        output = self._run([os.path.join(self._tmpdir, "host2")])
+        self.assertEqual(output.splitlines()[:4], [
+            "1 hosts", "", "Hosts per deleted file:",
+            "       1 /lib64/libc.so.6"])